@@ -1,15 +1,15 @@
 import logging
 from pymongo import MongoClient, ASCENDING
 from datetime import datetime, timedelta
-import hashlib
-import json
-import re
 import requests
-import time
-import random
-from config import MONGO_URI, MONGO_DB_NAME, MONGO_EMAILS_COLLECTION, MONGO_TODOS_COLLECTION, MONGO_USERS_COLLECTION
-from collections import OrderedDict
+from config import MONGO_URI, MONGO_DB_NAME, MONGO_EMAILS_COLLECTION, MONGO_TODOS_COLLECTION, MONGO_USERS_COLLECTION, MONGO_THREADS_COLLECTION, MONGO_SENDER_STATS_COLLECTION
 from services.nlp_service import detect_language  # Asumiendo que existe esta función
+from services.email_fields import normalize_subject
+from services.thread_store_service import get_thread, update_threads, remove_thread_member
+from services.llm_cache_service import get_cached_llm_response, cache_llm_response
+from services.ollama_client import ollama_generate, PRIORITY_AGATTA
+from services.structured_output_service import generate_structured
+from services.sender_stats_service import get_sender_stats
 
 # Configuración del logging
 logging.basicConfig(filename='agatta_tasks.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,59 +20,31 @@ db = client[MONGO_DB_NAME]
 emails_collection = db[MONGO_EMAILS_COLLECTION]
 tasks_collection = db[MONGO_TODOS_COLLECTION]
 users_collection = db[MONGO_USERS_COLLECTION]
+threads_collection = db[MONGO_THREADS_COLLECTION]
+sender_stats_collection = db[MONGO_SENDER_STATS_COLLECTION]
 
 # Configuración de Ollama
-OLLAMA_URL = "http://localhost:11434/api/generate"
 OLLAMA_MODEL = "mistral-custom"
 OLLAMA_TEMPERATURE = 0.7
 OLLAMA_MAX_TOKENS = 512
-OLLAMA_CONTEXT_SIZE = 32768
 
-# Caché para respuestas de Ollama
-response_cache = OrderedDict()
-cache_limit = 1000
+def call_mistral_api(prompt, format=None, accept=None):
+    options = {"temperature": OLLAMA_TEMPERATURE, "num_predict": OLLAMA_MAX_TOKENS}
+    if format is not None:
+        options["format"] = format
+    cache_key, cached = get_cached_llm_response(OLLAMA_MODEL, options, prompt)
+    if cached is not None and (accept is None or accept(cached)):
+        return cached
 
-def call_mistral_api(prompt):
-    prompt_hash = hashlib.md5(prompt.encode('utf-8')).hexdigest()
-    if prompt_hash in response_cache:
-        response_cache.move_to_end(prompt_hash)
-        return response_cache[prompt_hash]
-
-    payload = {
-        "model": OLLAMA_MODEL,
-        "prompt": prompt,
-        "stream": False,
-        "temperature": OLLAMA_TEMPERATURE,
-        "num_predict": OLLAMA_MAX_TOKENS,
-        "num_ctx": OLLAMA_CONTEXT_SIZE
-    }
-    
     max_retries = 3
-    base_delay = 2
-    for attempt in range(max_retries + 1):
-        try:
-            response = requests.post(OLLAMA_URL, json=payload, timeout=30)
-            response.raise_for_status()
-            result = response.json()['response']
-            if len(response_cache) >= cache_limit:
-                response_cache.popitem(last=False)
-            response_cache[prompt_hash] = result
-            return result
-        except requests.exceptions.RequestException as e:
-            if attempt < max_retries:
-                delay = base_delay * (2 ** attempt) + random.uniform(0, 0.1 * base_delay)
-                logging.warning(f"Intento {attempt + 1} fallido al contactar con Ollama: {e}. Reintentando en {delay:.2f} segundos...")
-                time.sleep(delay)
-            else:
-                logging.error(f"Error al contactar con Ollama tras {max_retries} intentos: {e}")
-                return f'{{"error": "API failure", "message": "{str(e)}"}}'
-
-def safe_parse_json(response, task_id):
     try:
-        return json.loads(response)
-    except json.JSONDecodeError as e:
-        logging.error(f"Error al parsear JSON para task_id {task_id}: {str(e)}. Respuesta: {response}")
-        return response.strip()
+        result = ollama_generate(prompt, options, PRIORITY_AGATTA, model=OLLAMA_MODEL, timeout=30, retries=max_retries)
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Error al contactar con Ollama tras {max_retries} intentos: {e}")
+        return None if format is not None else f'{{"error": "API failure", "message": "{str(e)}"}}'
+    if accept is None or accept(result):
+        cache_llm_response(cache_key, result)
+    return result
 
 def get_majority_language(thread_emails):
     """Detecta el idioma predominante en el hilo de correos."""
@@ -101,10 +73,10 @@ def generate_thread_summary(message_id, user_email):
     {thread_text[:2000]}
     """
 
-    response = call_mistral_api(prompt)
-    parsed_response = safe_parse_json(response, message_id)
-    if isinstance(parsed_response, dict) and "summary" in parsed_response:
+    parsed_response, _ = generate_structured('thread_summary', prompt, call_mistral_api)
+    if parsed_response is not None:
         return parsed_response["summary"]
+    logging.error(f"No se obtuvo un resumen válido para message_id {message_id}")
     return "Error en el resumen"
 
 def generate_proposed_action(message_id, user_email):
@@ -129,10 +101,10 @@ def generate_proposed_action(message_id, user_email):
     Cuerpo: {email.get('body', '')[:1000]}
     """
 
-    response = call_mistral_api(prompt)
-    parsed_response = safe_parse_json(response, message_id)
-    if isinstance(parsed_response, dict) and "action" in parsed_response:
+    parsed_response, _ = generate_structured('proposed_action', prompt, call_mistral_api)
+    if parsed_response is not None:
         return parsed_response["action"]
+    logging.error(f"No se obtuvo una acción propuesta válida para message_id {message_id}")
     return "Error en la acción propuesta"
 
 def assign_parent_thread_id(thread_emails):
@@ -146,11 +118,15 @@ def assign_parent_thread_id(thread_emails):
     sorted_emails = sorted(thread_emails, key=lambda x: x["date"])
     parent_thread_id = sorted_emails[0]["message_id"]
     
+    emails_collection.update_many(
+        {"message_id": {"$in": [email["message_id"] for email in thread_emails]}},
+        {"$set": {"parent_thread_id": parent_thread_id}}
+    )
+    # Igual que en la revisión de insert_emails: cada correo sale del hilo en el que estaba
     for email in thread_emails:
-        emails_collection.update_one(
-            {"message_id": email["message_id"]},
-            {"$set": {"parent_thread_id": parent_thread_id}}
-        )
+        if email.get("parent_thread_id") and email["parent_thread_id"] != parent_thread_id:
+            remove_thread_member(threads_collection, email["message_id"], email["parent_thread_id"], email.get("mailbox_id"))
+    update_threads(threads_collection, [{**email, "parent_thread_id": parent_thread_id} for email in thread_emails])
     
     logging.info(f"Asignado parent_thread_id {parent_thread_id} al hilo con {len(thread_emails)} correos")
     return parent_thread_id
@@ -163,6 +139,11 @@ def get_thread_emails(message_id):
     thread_emails = []
     parent_thread_id = email.get("parent_thread_id", None)
     
+    # Hilo materializado en la colección threads: una consulta al hilo y otra por message_id
+    thread = get_thread(threads_collection, parent_thread_id, email.get("mailbox_id"))
+    if thread and thread.get("message_count", 0) > 1:
+        return list(emails_collection.find({"message_id": {"$in": thread["message_ids"]}, "mailbox_id": email.get("mailbox_id")}))
+    
     if parent_thread_id:
         thread_emails = list(emails_collection.find({"parent_thread_id": parent_thread_id}))
     
@@ -176,11 +157,11 @@ def get_thread_emails(message_id):
         if not thread_emails:
             thread_emails = [email]
     
-    if len(thread_emails) <= 1:
-        cleaned_subject = re.sub(r'^(Re:|Fwd:)\s*', '', email['subject'], flags=re.IGNORECASE).strip()
+    normalized_subject = email.get("normalized_subject") or normalize_subject(email.get("subject", ""))
+    if len(thread_emails) <= 1 and normalized_subject:
         thread_emails = list(emails_collection.find({
-            "subject": {"$regex": f"^(Re:|Fwd:)?\s*{re.escape(cleaned_subject)}", "$options": "i"},
-            "mailbox_id": email['mailbox_id']
+            "mailbox_id": email['mailbox_id'],
+            "normalized_subject": normalized_subject
         }))
     
     if thread_emails:
@@ -203,9 +184,8 @@ def get_users_with_agatta_enabled():
     return users_with_agatta
 
 def analyze_emails_for_tasks(username, mailbox_id, days_back=30):
-    cutoff_date = (datetime.now() - timedelta(days=days_back)).isoformat()
     query = {
-        "date": {"$gte": cutoff_date},
+        "date_ts": {"$gte": datetime.utcnow() - timedelta(days=days_back)},
         "requires_response": True,
         "completed": {"$ne": True},
         "mailbox_id": mailbox_id,
@@ -231,6 +211,8 @@ def analyze_emails_for_tasks(username, mailbox_id, days_back=30):
             logging.info(f"No se crea tarea para {email.get('subject', 'Sin asunto')}: no hay acción pendiente")
             continue
         
+        # Reputación del remitente para priorizar las tareas: cuántos correos envía y qué parte se responde
+        sender_stats = get_sender_stats(sender_stats_collection, mailbox_id, email.get("from")) or {}
         task = {
             "username": username,
             "message_id": email["message_id"],
@@ -244,7 +226,9 @@ def analyze_emails_for_tasks(username, mailbox_id, days_back=30):
             "draft_id": None,
             "thread_summary": generate_thread_summary(email["message_id"], user_email),
             "proposed_action": proposed_action,
-            "parent_thread_id": email.get("parent_thread_id", None)
+            "parent_thread_id": email.get("parent_thread_id", None),
+            "sender_email_count": sender_stats.get("count", 0),
+            "sender_reply_rate": sender_stats.get("reply_rate", 0.0)
         }
         
         tasks_collection.update_one(
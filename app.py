@@ -16,6 +16,9 @@ from services.user_service import get_user_data, add_mailbox, change_password, u
 from services.threads_service import analyze_threads, export_threads, process_feedback
 from services.agatta_service import get_agatta_stats, mark_task_completed, create_draft, get_draft_count, get_outbox_count, get_draft_emails, get_outbox_emails, get_gmail_service
 from services.dashboard_service import get_agatta_todos
+from services.ollama_client import ollama_metrics
+from services.llm_cache_service import llm_cache_stats
+from services.structured_output_service import structured_output_stats
 import hashlib
 import uuid
 import json
@@ -959,6 +962,15 @@ def get_logs():
         logger.error(f"Error getting logs: {str(e)}", exc_info=True)
         return str(e), 500
 
+@app.route('/api/llm_metrics', methods=['GET'])
+@login_required
+def get_llm_metrics():
+    try:
+        return jsonify({'ollama': ollama_metrics(), 'cache': llm_cache_stats(), 'structured_output': structured_output_stats()})
+    except Exception as e:
+        logger.error(f"Error al obtener métricas del LLM: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/update_agatta_config', methods=['POST'])
 @login_required
 def update_agatta_config_endpoint():
@@ -11,6 +11,10 @@ MONGO_EMAILS_COLLECTION = 'emails'
 MONGO_FEEDBACK_COLLECTION = 'feedback'
 MONGO_TODOS_COLLECTION = 'agatta_todos'
 MONGO_USERS_COLLECTION = 'users'
+MONGO_THREADS_COLLECTION = 'threads'
+MONGO_ATTACHMENTS_COLLECTION = 'attachments'
+MONGO_SENDER_STATS_COLLECTION = 'sender_stats'
+MONGO_THEMES_COLLECTION = 'themes'
 
 # Configuración de Redis (para caché)
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
@@ -19,15 +23,36 @@ REDIS_DB = int(os.getenv('REDIS_DB', 0))
 CACHE_TTL = int(os.getenv('CACHE_TTL', 3600))  # Tiempo de vida del caché en segundos (1 hora)
 SUMMARY_CACHE_TTL = int(os.getenv('SUMMARY_CACHE_TTL', 604800))  # TTL para resúmenes LLM (7 días)
 
+# Caché de respuestas del LLM compartido por ingestión, AGATTA y la web
+LLM_CACHE_BACKEND = os.getenv('LLM_CACHE_BACKEND', 'sqlite')  # sqlite, redis o none
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', 'llm_cache.sqlite3')
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', 10000))
+
 # Configuración de Ollama (para el modelo mistral-custom)
 OLLAMA_URL = os.getenv('OLLAMA_URL', 'http://localhost:11434/api/generate')
 OLLAMA_MODEL = 'mistral-custom'
 OLLAMA_TEMPERATURE = float(os.getenv('OLLAMA_TEMPERATURE', 0.7))
 OLLAMA_MAX_TOKENS = int(os.getenv('OLLAMA_MAX_TOKENS', 512))
-OLLAMA_CONTEXT_SIZE = int(os.getenv('OLLAMA_CONTEXT_SIZE', 32768))
+OLLAMA_CONTEXT_SIZE = int(os.getenv('OLLAMA_CONTEXT_SIZE', 32768))  # Contexto máximo permitido
+OLLAMA_CONTEXT_BUCKETS = [int(size) for size in os.getenv('OLLAMA_CONTEXT_BUCKETS', '4096,8192,16384,32768').split(',')]  # Tamaños de num_ctx que se reutilizan
+OLLAMA_CHARS_PER_TOKEN = float(os.getenv('OLLAMA_CHARS_PER_TOKEN', 3.0))  # Estimación conservadora de caracteres por token
+OLLAMA_CONTEXT_STICKY_FACTOR = float(os.getenv('OLLAMA_CONTEXT_STICKY_FACTOR', 2.0))  # Se mantiene el último num_ctx si no supera este múltiplo del necesario
+OLLAMA_TIMEOUT = float(os.getenv('OLLAMA_TIMEOUT', 120))  # Segundos máximos por petición
+OLLAMA_MAX_IN_FLIGHT = int(os.getenv('OLLAMA_MAX_IN_FLIGHT', 2))  # Peticiones simultáneas por proceso (igual a OLLAMA_NUM_PARALLEL del servidor)
+OLLAMA_AGATTA_MAX_IN_FLIGHT = int(os.getenv('OLLAMA_AGATTA_MAX_IN_FLIGHT', 1))  # Límite del carril AGATTA
+OLLAMA_BACKFILL_MAX_IN_FLIGHT = int(os.getenv('OLLAMA_BACKFILL_MAX_IN_FLIGHT', 1))  # Límite del carril de ingestión y revisiones
+OLLAMA_MAX_QUEUE = int(os.getenv('OLLAMA_MAX_QUEUE', 100))  # Peticiones en espera por carril antes de rechazar
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv('OLLAMA_QUEUE_TIMEOUT', 300))  # Segundos máximos en la cola
+STRUCTURED_OUTPUT_MAX_ATTEMPTS = int(os.getenv('STRUCTURED_OUTPUT_MAX_ATTEMPTS', 2))  # Generaciones por prompt hasta obtener JSON válido según su esquema
+ENRICHMENT_MAX_TOKENS = int(os.getenv('ENRICHMENT_MAX_TOKENS', 1024))  # Tokens de salida de la llamada única de enriquecimiento de correos
 
 # Configuración del modelo de embeddings
 EMBEDDING_MODEL_NAME = 'paraphrase-multilingual-MiniLM-L12-v2'
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 32))  # Textos por llamada a encode
+EMBEDDING_BATCH_TIMEOUT = float(os.getenv('EMBEDDING_BATCH_TIMEOUT', 0.5))  # Segundos máximos esperando a completar un lote en el pipeline
+EMBEDDING_LENGTH_BUCKETING = os.getenv('EMBEDDING_LENGTH_BUCKETING', 'True') == 'True'  # Agrupar textos de longitud parecida en cada lote
+EMBEDDING_TORCH_THREADS = int(os.getenv('EMBEDDING_TORCH_THREADS', 0))  # 0 = valor por defecto de torch
+VECTOR_INDEX_TOP_K = int(os.getenv('VECTOR_INDEX_TOP_K', 10))  # Correos similares que se examinan al buscar un hilo por embedding
 
 # Configuración del modelo de aprendizaje de refuerzo
 FEEDBACK_MODEL_PATH = os.getenv('FEEDBACK_MODEL_PATH', './models/feedback_model.pkl')
@@ -45,26 +70,140 @@ TEMPLATES_DIR = 'templates'
 ELASTICSEARCH_HOST = os.getenv('ELASTICSEARCH_HOST', 'localhost')
 ELASTICSEARCH_PORT = int(os.getenv('ELASTICSEARCH_PORT', 9200))
 
-# Configuración de índices de MongoDB (para referencia, no se crean aquí)
+# Configuración del pipeline de ingestión (hilos por etapa y tamaño de las colas entre etapas)
+INGESTION_FETCH_WORKERS = int(os.getenv('INGESTION_FETCH_WORKERS', 4))
+INGESTION_ATTACHMENT_WORKERS = int(os.getenv('INGESTION_ATTACHMENT_WORKERS', 2))
+INGESTION_LLM_WORKERS = int(os.getenv('INGESTION_LLM_WORKERS', 2))
+INGESTION_EMBEDDING_WORKERS = int(os.getenv('INGESTION_EMBEDDING_WORKERS', 1))
+INGESTION_PERSIST_WORKERS = int(os.getenv('INGESTION_PERSIST_WORKERS', 2))
+INGESTION_QUEUE_SIZE = int(os.getenv('INGESTION_QUEUE_SIZE', 50))
+INGESTION_REPORT_INTERVAL = int(os.getenv('INGESTION_REPORT_INTERVAL', 60))  # Segundos entre informes de rendimiento
+
+# Enriquecimiento diferido: la ingestión guarda los correos con enrichment_status 'pending'
+# (buscables por sus campos en bruto) y una cola completa después el resumen, términos y clasificaciones
+DEFER_ENRICHMENT = os.getenv('DEFER_ENRICHMENT', 'True') == 'True'
+ENRICHMENT_CLAIM_SIZE = int(os.getenv('ENRICHMENT_CLAIM_SIZE', 20))  # Correos que reclama la cola en cada consulta
+ENRICHMENT_CLAIM_TIMEOUT = int(os.getenv('ENRICHMENT_CLAIM_TIMEOUT', 1800))  # Segundos tras los que un correo reclamado sin terminar vuelve a la cola
+ENRICHMENT_MAX_ATTEMPTS = int(os.getenv('ENRICHMENT_MAX_ATTEMPTS', 3))
+
+# Clasificadores locales (centroides y regresión logística sobre los embeddings) delante del LLM:
+# si todos superan el umbral, el LLM solo genera resumen y términos relevantes
+LOCAL_CLASSIFIER_ENABLED = os.getenv('LOCAL_CLASSIFIER_ENABLED', 'True') == 'True'
+LOCAL_CLASSIFIER_THRESHOLD = float(os.getenv('LOCAL_CLASSIFIER_THRESHOLD', 0.85))
+LOCAL_CLASSIFIER_MIN_EXAMPLES = int(os.getenv('LOCAL_CLASSIFIER_MIN_EXAMPLES', 20))  # Correos mínimos por dominio o clase para entrenar
+LOCAL_CLASSIFIER_MAX_TRAINING = int(os.getenv('LOCAL_CLASSIFIER_MAX_TRAINING', 5000))  # Correos enriquecidos más recientes usados para entrenar
+LOCAL_CLASSIFIER_RETRAIN_SECONDS = int(os.getenv('LOCAL_CLASSIFIER_RETRAIN_SECONDS', 3600))
+
+# Política de enriquecimiento: puntuación por cabeceras (List-Unsubscribe, Precedence), historial del
+# remitente, tamaño y clasificador de publicidad. Por debajo de MINIMAL_BELOW solo heurísticas; por
+# debajo de REDUCED_BELOW sin OCR
+ENRICHMENT_POLICY_ENABLED = os.getenv('ENRICHMENT_POLICY_ENABLED', 'True') == 'True'
+ENRICHMENT_POLICY_MINIMAL_BELOW = int(os.getenv('ENRICHMENT_POLICY_MINIMAL_BELOW', -3))
+ENRICHMENT_POLICY_REDUCED_BELOW = int(os.getenv('ENRICHMENT_POLICY_REDUCED_BELOW', 0))
+ENRICHMENT_POLICY_LARGE_BODY_CHARS = int(os.getenv('ENRICHMENT_POLICY_LARGE_BODY_CHARS', 50000))
+# Presupuesto por ejecución (0 = sin límite); al agotarse, los correos quedan pendientes para la cola
+ENRICHMENT_BUDGET_LLM_SECONDS = float(os.getenv('ENRICHMENT_BUDGET_LLM_SECONDS', 0))
+ENRICHMENT_BUDGET_OCR_PAGES = int(os.getenv('ENRICHMENT_BUDGET_OCR_PAGES', 0))
+
+# Casi duplicados (SimHash del cuerpo normalizado): un correo a distancia de Hamming <= MAX_DISTANCE
+# de otro ya enriquecido del buzón copia su enriquecimiento sin llamar al LLM. MAX_DISTANCE <= 3
+NEAR_DUPLICATE_ENABLED = os.getenv('NEAR_DUPLICATE_ENABLED', 'True') == 'True'
+NEAR_DUPLICATE_MAX_DISTANCE = int(os.getenv('NEAR_DUPLICATE_MAX_DISTANCE', 3))
+NEAR_DUPLICATE_MIN_SHINGLES = int(os.getenv('NEAR_DUPLICATE_MIN_SHINGLES', 8))  # Trigramas mínimos del cuerpo para calcular la huella
+SEARCH_COLLAPSE_DUPLICATES = os.getenv('SEARCH_COLLAPSE_DUPLICATES', 'True') == 'True'  # Agrupar casi duplicados en los resultados de búsqueda
+
+# Mensajes por petición de lote a la API de Gmail (máximo 100; Google recomienda no superar 50)
+GMAIL_BATCH_SIZE = int(os.getenv('GMAIL_BATCH_SIZE', 50))
+
+# Descarga IMAP: conexiones simultáneas por carpeta y mensajes por cada UID FETCH
+IMAP_CONNECTIONS_PER_FOLDER = int(os.getenv('IMAP_CONNECTIONS_PER_FOLDER', 2))
+IMAP_FETCH_CHUNK_SIZE = int(os.getenv('IMAP_FETCH_CHUNK_SIZE', 25))
+
+# Escritura en bloque de correos: documentos por escritura y segundos máximos entre escrituras
+PERSIST_BULK_SIZE = int(os.getenv('PERSIST_BULK_SIZE', 100))
+PERSIST_FLUSH_INTERVAL = float(os.getenv('PERSIST_FLUSH_INTERVAL', 5))
+
+# Extracción de texto de adjuntos: procesos del pool y límites por archivo
+ATTACHMENT_WORKERS = int(os.getenv('ATTACHMENT_WORKERS', 2))
+ATTACHMENT_TIMEOUT = float(os.getenv('ATTACHMENT_TIMEOUT', 60))  # Segundos máximos por adjunto
+ATTACHMENT_MAX_BYTES = int(os.getenv('ATTACHMENT_MAX_BYTES', 25 * 1024 * 1024))
+ATTACHMENT_MAX_PAGES = int(os.getenv('ATTACHMENT_MAX_PAGES', 50))
+ATTACHMENT_MAX_ROWS = int(os.getenv('ATTACHMENT_MAX_ROWS', 5000))
+ATTACHMENT_MAX_CHARS = int(os.getenv('ATTACHMENT_MAX_CHARS', 100000))
+
+# Índices de MongoDB por colección: nombre -> {'keys': [(campo, 1 | -1 | 'text')], y opciones de create_index}.
+# Los crea services/index_manager_service.ensure_indexes, que llaman initialize_collection y
+# tools/manage_indexes.py; la misma herramienta comprueba con explain() que las consultas habituales los usan.
 INDEXES = {
-    'text_index': [
-        ('from', 'text'),
-        ('to', 'text'),
-        ('subject', 'text'),
-        ('body', 'text'),
-        ('headers_text', 'text'),
-        ('attachments', 'text'),
-        ('attachments_content', 'text'),
-        ('summary', 'text'),
-        ('relevant_terms', 'text'),
-        ('semantic_domain', 'text')
-    ],
-    'date_index': [('date', 1)],
-    'message_id_1': [('message_id', 1)],
-    'common_filters_index': [
-        ('from', 1),
-        ('to', 1),
-        ('date', 1),
-        ('semantic_domain', 1)
-    ]
-}
\ No newline at end of file
+    MONGO_EMAILS_COLLECTION: {
+        'text_index': {
+            'keys': [
+                ('from', 'text'),
+                ('to', 'text'),
+                ('subject', 'text'),
+                ('body', 'text'),
+                ('headers_text', 'text'),
+                ('attachments', 'text'),
+                ('summary', 'text'),
+                ('relevant_terms_array', 'text'),
+                ('semantic_domain', 'text')
+            ],
+            'default_language': 'spanish'
+        },
+        'date_index': {'keys': [('date', 1)]},
+        'mailbox_date_ts_index': {'keys': [('mailbox_id', 1), ('date_ts', 1)]},
+        'mailbox_direction_date_ts_index': {'keys': [('mailbox_id', 1), ('direction', 1), ('date_ts', 1)]},
+        'mailbox_from_addr_index': {'keys': [('mailbox_id', 1), ('from_addr', 1), ('date_ts', 1)]},
+        'mailbox_to_addrs_index': {'keys': [('mailbox_id', 1), ('to_addrs', 1), ('date_ts', 1)]},
+        'mailbox_cc_addrs_index': {'keys': [('mailbox_id', 1), ('cc_addrs', 1)]},
+        # Tareas de AGATTA: correos del buzón que requieren respuesta en un rango de fechas
+        'mailbox_requires_response_index': {'keys': [('mailbox_id', 1), ('requires_response', 1), ('date_ts', 1)]},
+        'message_id_1': {'keys': [('message_id', 1)], 'unique': True},
+        'index_1': {'keys': [('index', 1)], 'unique': True, 'sparse': True},
+        'in_reply_to_index': {'keys': [('in_reply_to', 1)]},
+        'parent_thread_index': {'keys': [('parent_thread_id', 1)]},
+        'mailbox_normalized_subject_index': {'keys': [('mailbox_id', 1), ('normalized_subject', 1)]},
+        'mailbox_simhash_bands_index': {'keys': [('mailbox_id', 1), ('simhash_bands', 1)]},
+        # Correos que contienen un adjunto (búsqueda de texto en adjuntos de submit_bulk_feedback)
+        'attachment_refs_index': {'keys': [('attachment_refs', 1)]},
+        # Parcial: solo los correos marcados como respondidos por update_responded_status
+        'mailbox_responded_at_index': {
+            'keys': [('mailbox_id', 1), ('responded_at', 1)],
+            'partialFilterExpression': {'responded_at': {'$exists': True}}
+        },
+        # Parcial: solo los correos que están en la cola de enriquecimiento
+        'enrichment_queue_index': {
+            'keys': [('enrichment_status', 1), ('mailbox_id', 1), ('enrichment_claimed_at', 1)],
+            'partialFilterExpression': {'enrichment_status': {'$in': ['pending', 'processing']}}
+        },
+        'common_filters_index': {'keys': [('from', 1), ('to', 1), ('date', 1), ('relevant_terms.semantic_domain', 1)]},
+        'classification_index': {'keys': [('requires_response', 1), ('urgent', 1), ('important', 1), ('advertisement', 1), ('responded', 1)]}
+    },
+    MONGO_ATTACHMENTS_COLLECTION: {
+        'attachment_text_index': {'keys': [('text', 'text')], 'default_language': 'spanish'}
+    },
+    MONGO_THREADS_COLLECTION: {
+        'parent_thread_mailbox_index': {'keys': [('parent_thread_id', 1), ('mailbox_id', 1)], 'unique': True},
+        'mailbox_last_date_index': {'keys': [('mailbox_id', 1), ('last_date', 1)]}
+    },
+    MONGO_SENDER_STATS_COLLECTION: {
+        'mailbox_sender_index': {'keys': [('mailbox_id', 1), ('sender', 1)], 'unique': True},
+        'mailbox_count_index': {'keys': [('mailbox_id', 1), ('count', -1)]}
+    },
+    MONGO_TODOS_COLLECTION: {
+        'username_1': {'keys': [('username', 1)]},
+        'completed_1': {'keys': [('completed', 1)]},
+        'mailbox_id_1': {'keys': [('mailbox_id', 1)]},
+        'date_1': {'keys': [('date', 1)]}
+    },
+    MONGO_THEMES_COLLECTION: {
+        'user_theme_index': {'keys': [('user_id', 1), ('theme_id', 1)]},
+        'email_indices_index': {'keys': [('email_indices', 1)]}
+    },
+    MONGO_FEEDBACK_COLLECTION: {
+        'user_type_index': {'keys': [('user_id', 1), ('type', 1)]}
+    },
+    MONGO_USERS_COLLECTION: {
+        'username_unique_index': {'keys': [('username', 1)], 'unique': True}
+    }
+}
@@ -1,20 +1,9 @@
 import base64
-import mimetypes
-import os
-from PyPDF2 import PdfReader
-from PyPDF2.errors import FileNotDecryptedError
-import pytesseract
-from PIL import Image
-from docx import Document as DocxDocument
-import openpyxl
-import json
 import re
-from pymongo import MongoClient, TEXT, ASCENDING
+from pymongo import MongoClient, ASCENDING, UpdateOne
 from pymongo.errors import OperationFailure
-from bson import Binary, ObjectId
 import hashlib
 import requests
-from collections import OrderedDict
 from sentence_transformers import SentenceTransformer
 import numpy as np
 import zlib
@@ -26,11 +15,11 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.exceptions import RefreshError
 import time
 import random
+import threading
 from datetime import datetime, timezone, timedelta
 from email.utils import parsedate_to_datetime
 import argparse
 import logging
-from json_repair import repair_json
 import imaplib
 import email
 from sklearn.feature_extraction.text import CountVectorizer
@@ -39,6 +28,38 @@ from sklearn.pipeline import make_pipeline
 import pickle
 from bs4 import BeautifulSoup
 from elasticsearch import Elasticsearch
+from services.ingestion_pipeline import IngestionPipeline, PipelineStage
+from services.gmail_service import batch_get_messages
+from services.bulk_writer import EmailBulkWriter
+from services.embedding_service import generate_embeddings as generate_embeddings_batch, set_torch_threads
+from services.vector_index_service import get_mailbox_index
+from services.email_fields import normalize_subject, email_date_ts, address_fields, header_value, header_from_text, DIRECTION_OUTBOUND
+from services.thread_store_service import update_threads, remove_thread_member, rebuild_threads, RunThreadIndex
+from services.attachment_service import AttachmentExtractor
+from services.attachment_store_service import extract_with_cache, load_attachment_texts, attachment_search_text
+from services.llm_cache_service import get_cached_llm_response, cache_llm_response, llm_cache_stats
+from services.ollama_client import ollama_generate, ollama_metrics, PRIORITY_BACKFILL
+from services.structured_output_service import generate_structured, structured_output_stats
+from services.local_classifier_service import (
+    get_local_classifier, resolve_locally, record_resolution, cascade_stats, load_bayesian_model, classifier_text,
+    CLASSIFIED_BY_LLM, CLASSIFIED_BY_LOCAL, CLASSIFIED_BY_REUSED, CLASSIFIED_BY_POLICY
+)
+from services.enrichment_queue_service import (
+    claim_pending, complete_enrichments, release_claims, fail_claims, mark_exhausted, enrichment_backlog, STATUS_PENDING, STATUS_DONE, STATUS_SKIPPED
+)
+from services.enrichment_policy_service import (
+    EnrichmentPolicyEngine, EnrichmentBudget, POLICIES, POLICY_FULL, is_image, sender_address, advertisement_signal
+)
+from services.near_duplicate_service import body_fingerprint, find_near_duplicate, record_reuse, reuse_stats
+from services.responded_service import update_responded_status
+from services.index_manager_service import ensure_indexes
+from services.sync_state_service import (
+    get_mailbox_sync_state, advance_gmail_history_id, advance_imap_folder_state,
+    imap_folder_state_key, uid_ranges, uids_after, parse_uid_fetch_response
+)
+from services.sender_stats_service import (
+    ensure_sender_stats, rebuild_sender_stats, record_new_emails, record_sender_counter, record_replies, sender_history, top_senders
+)
 
 # Configuración del logging
 logging.basicConfig(filename='email_insertion.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -48,29 +69,34 @@ client = MongoClient('localhost', 27017)
 db = client['email_database_metis2']
 emails_collection = db['emails']
 users_collection = db['users']
-
-# Cargar modelo de embeddings en la CPU
-embedding_model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2', device='cpu')
-
-# Configuración de Tesseract
-pytesseract.pytesseract.tesseract_cmd = r'/usr/bin/tesseract'
-
-# Archivo y configuración del caché
-cache_file = 'mistral_cache.pkl'
-cache_limit = 1000
-
-# Cargar caché
-if os.path.exists(cache_file):
-    with open(cache_file, 'rb') as f:
-        response_cache = pickle.load(f)
-    if not isinstance(response_cache, OrderedDict):
-        response_cache = OrderedDict(response_cache)
-else:
-    response_cache = OrderedDict()
+threads_collection = db['threads']
+attachments_collection = db['attachments']
+sender_stats_collection = db['sender_stats']
+migrations_collection = db['migrations']
+
+# Marca de la migración de `date` a date_ts en la colección `migrations`
+DATE_MIGRATION = 'date_ts'
+# Prefijo de las marcas, por buzón, del cálculo de direcciones normalizadas y direction
+ADDRESS_MIGRATION = 'address_fields'
+
+# Modelo de embeddings en la CPU; se carga con el primer uso porque los procesos de
+# extracción de adjuntos (forkserver/spawn) vuelven a importar este script
+_embedding_model = None
+_embedding_model_lock = threading.Lock()
+
+def get_embedding_model():
+    global _embedding_model
+    with _embedding_model_lock:
+        if _embedding_model is None:
+            _embedding_model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2', device='cpu')
+        return _embedding_model
 
 # Archivo para el modelo bayesiano
 bayesian_model_file = 'bayesian_advertisement_model.pkl'
 
+# Indicadores de clasificación que devuelve el LLM
+CLASSIFICATION_KEYS = ['requires_response', 'urgent', 'important', 'advertisement']
+
 # Lista de remitentes cualificados
 qualified_senders = [
     'ayuntamiento@',
@@ -81,9 +107,36 @@ qualified_senders = [
 
 # Configuración de Elasticsearch desde config.py
 from config import ELASTICSEARCH_HOST, ELASTICSEARCH_PORT
+from config import (
+    INGESTION_FETCH_WORKERS, INGESTION_ATTACHMENT_WORKERS, INGESTION_LLM_WORKERS,
+    INGESTION_EMBEDDING_WORKERS, INGESTION_PERSIST_WORKERS, INGESTION_QUEUE_SIZE, INGESTION_REPORT_INTERVAL,
+    GMAIL_BATCH_SIZE, IMAP_CONNECTIONS_PER_FOLDER, IMAP_FETCH_CHUNK_SIZE, PERSIST_BULK_SIZE, PERSIST_FLUSH_INTERVAL,
+    EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_TIMEOUT, EMBEDDING_LENGTH_BUCKETING, EMBEDDING_TORCH_THREADS,
+    ENRICHMENT_MAX_TOKENS, VECTOR_INDEX_TOP_K,
+    DEFER_ENRICHMENT, ENRICHMENT_CLAIM_SIZE, ENRICHMENT_CLAIM_TIMEOUT, ENRICHMENT_MAX_ATTEMPTS,
+    LOCAL_CLASSIFIER_ENABLED, LOCAL_CLASSIFIER_THRESHOLD, LOCAL_CLASSIFIER_MIN_EXAMPLES, LOCAL_CLASSIFIER_MAX_TRAINING, LOCAL_CLASSIFIER_RETRAIN_SECONDS,
+    ENRICHMENT_POLICY_ENABLED, ENRICHMENT_POLICY_MINIMAL_BELOW, ENRICHMENT_POLICY_REDUCED_BELOW, ENRICHMENT_POLICY_LARGE_BODY_CHARS,
+    ENRICHMENT_BUDGET_LLM_SECONDS, ENRICHMENT_BUDGET_OCR_PAGES,
+    NEAR_DUPLICATE_ENABLED, NEAR_DUPLICATE_MAX_DISTANCE, NEAR_DUPLICATE_MIN_SHINGLES,
+    ATTACHMENT_WORKERS, ATTACHMENT_TIMEOUT, ATTACHMENT_MAX_BYTES, ATTACHMENT_MAX_PAGES, ATTACHMENT_MAX_ROWS, ATTACHMENT_MAX_CHARS
+)
+
+# Cabeceras mínimas para identificar un mensaje de Gmail sin descargar su cuerpo
+GMAIL_METADATA_HEADERS = ['Message-ID', 'Subject', 'From', 'To', 'Date']
 
 es = Elasticsearch([{'host': ELASTICSEARCH_HOST, 'port': ELASTICSEARCH_PORT, 'scheme': 'http'}])
 
+set_torch_threads(EMBEDDING_TORCH_THREADS)
+
+# Extracción de texto de adjuntos en procesos aparte, con límites por archivo
+attachment_extractor = AttachmentExtractor(ATTACHMENT_WORKERS, budgets={
+    'max_bytes': ATTACHMENT_MAX_BYTES,
+    'timeout': ATTACHMENT_TIMEOUT,
+    'max_pages': ATTACHMENT_MAX_PAGES,
+    'max_rows': ATTACHMENT_MAX_ROWS,
+    'max_chars': ATTACHMENT_MAX_CHARS
+})
+
 def parse_email_date(date_str):
     date_str = date_str.strip()
     iso_pattern = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}[+-]\d{2}:\d{2}$')
@@ -125,99 +178,57 @@ def parse_email_date(date_str):
     except (ValueError, TypeError):
         return None
 
-def migrate_date_formats(dry_run=False):
-    logging.info("Starting date format migration...")
+def migrate_dates(dry_run=False, batch_size=1000):
+    """Migración única y reanudable de `date` a ISO 8601 y al campo date_ts (fecha BSON en UTC).
+
+    Recorre los correos por _id y guarda el último procesado en la colección `migrations`,
+    así que una ejecución interrumpida continúa donde lo dejó y, una vez completada, las
+    siguientes solo leen la marca. Los correos nuevos reciben date_ts al guardarse.
+    """
+    state = migrations_collection.find_one({'_id': DATE_MIGRATION}) or {}
+    if state.get('completed_at'):
+        return
+    logging.info(f"Migrando fechas a date_ts{' desde ' + str(state['last_id']) if state.get('last_id') else ''}...")
+    query = {'_id': {'$gt': state['last_id']}} if state.get('last_id') else {}
+    operations = []
+    total_processed = 0
+    total_reformatted = 0
+    total_invalid = 0
+
+    def flush(last_id):
+        if not dry_run:
+            emails_collection.bulk_write(operations, ordered=False)
+            migrations_collection.update_one({'_id': DATE_MIGRATION}, {'$set': {'last_id': last_id, 'updated_at': datetime.now(timezone.utc)}}, upsert=True)
+        operations.clear()
+
     try:
-        cursor = emails_collection.find({}, {'_id': 1, 'message_id': 1, 'index': 1, 'date': 1})
-        total_updated = 0
-        total_skipped = 0
-        total_processed = 0
-        iso_pattern = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}[+-]\d{2}:\d{2}$')
-        
-        for doc in cursor:
+        for doc in emails_collection.find(query, {'_id': 1, 'date': 1}).sort('_id', ASCENDING):
             total_processed += 1
-            doc_id = str(doc['_id'])
-            message_id = doc.get('message_id', 'unknown')
-            index = doc.get('index', 'unknown')
-            raw_date = doc.get('date', '')
-            
-            if not raw_date or raw_date == 'Unknown':
-                total_skipped += 1
-                continue
-            
-            if iso_pattern.match(raw_date):
-                try:
-                    datetime.fromisoformat(raw_date)
-                    total_skipped += 1
-                    continue
-                except ValueError:
-                    pass
-            
-            parsed_date = parse_email_date(raw_date)
-            if not parsed_date:
-                total_skipped += 1
-                continue
-            iso_date = parsed_date.isoformat()
-            if not dry_run:
-                result = emails_collection.update_one(
-                    {'_id': doc['_id']},
-                    {'$set': {'date': iso_date}}
-                )
-                if result.modified_count > 0:
-                    total_updated += 1
-            else:
-                total_updated += 1
-        
-        logging.info(f"Date migration completed: {total_updated} documents updated, {total_skipped} documents skipped, {total_processed} documents processed")
+            raw_date = doc.get('date') or ''
+            updates = {'date_ts': email_date_ts(raw_date)}
+            if updates['date_ts'] is None and raw_date.strip().lower() != 'unknown':
+                # Fechas guardadas en otros formatos (RFC 2822...) se reescriben en ISO 8601
+                parsed_date = parse_email_date(raw_date) if raw_date else None
+                if parsed_date:
+                    updates['date'] = parsed_date.isoformat()
+                    updates['date_ts'] = email_date_ts(updates['date'])
+                    total_reformatted += 1
+            total_invalid += updates['date_ts'] is None
+            operations.append(UpdateOne({'_id': doc['_id']}, {'$set': updates}))
+            if len(operations) >= batch_size:
+                flush(doc['_id'])
+        if operations:
+            flush(doc['_id'])
+        if not dry_run:
+            migrations_collection.update_one({'_id': DATE_MIGRATION}, {'$set': {'completed_at': datetime.now(timezone.utc)}}, upsert=True)
+        logging.info(f"Migración de fechas {'simulada' if dry_run else 'completada'}: {total_processed} correos, {total_reformatted} reescritos en ISO 8601, {total_invalid} sin fecha válida")
     except Exception as e:
-        logging.error(f"Error during date migration: {e}")
+        logging.error(f"Error en la migración de fechas (se reanudará en la próxima ejecución): {e}")
 
 def initialize_collection():
-    existing_indexes = {index['name'] for index in emails_collection.list_indexes()}
-    
-    try:
-        for index in emails_collection.list_indexes():
-            if index['name'] != '_id_' and 'text' in index['key']:
-                emails_collection.drop_index(index['name'])
-    except Exception:
-        pass
-
-    if 'text_index' not in existing_indexes:
-        emails_collection.create_index([
-            ('from', TEXT),
-            ('to', TEXT),
-            ('subject', TEXT),
-            ('body', TEXT),
-            ('headers_text', TEXT),
-            ('attachments', TEXT),
-            ('attachments_content', TEXT),
-            ('summary', TEXT),
-            ('relevant_terms_array', TEXT),
-            ('semantic_domain', TEXT)
-        ], name='text_index', default_language='spanish')
-    if 'date_index' not in existing_indexes:
-        emails_collection.create_index([('date', ASCENDING)], name='date_index')
-    if 'message_id_1' not in existing_indexes:
-        emails_collection.create_index([('message_id', ASCENDING)], unique=True, name='message_id_1')
-    if 'common_filters_index' not in existing_indexes:
-        emails_collection.create_index([
-            ('from', ASCENDING),
-            ('to', ASCENDING),
-            ('date', ASCENDING),
-            ('relevant_terms.semantic_domain', ASCENDING)
-        ], name='common_filters_index')
-    if 'parent_thread_index' not in existing_indexes:
-        emails_collection.create_index([('parent_thread_id', ASCENDING)], name='parent_thread_index')
-    if 'index_1' not in existing_indexes:
-        emails_collection.create_index([('index', ASCENDING)], unique=True, sparse=True, name='index_1')
-    if 'classification_index' not in existing_indexes:
-        emails_collection.create_index([
-            ('requires_response', ASCENDING),
-            ('urgent', ASCENDING),
-            ('important', ASCENDING),
-            ('advertisement', ASCENDING),
-            ('responded', ASCENDING)
-        ], name='classification_index')
+    # Índices declarados en config.INDEXES para todas las colecciones; ensure_indexes
+    # recrea solo los que han cambiado de definición (por ejemplo, los campos del índice de texto)
+    ensure_indexes(db)
 
 def get_credentials_from_db(username, mailbox_id):
     user = users_collection.find_one({"username": username})
@@ -360,191 +371,22 @@ def text_optimization_attachments(text):
     text = re.sub(r'\s+', ' ', text).strip()
     return text[:1000]
 
-def generate_embedding(subject, body, summary):
-    text = f"{subject or ''} {body or ''} {summary or ''}".strip()
-    if not text:
-        return None
-    try:
-        embedding = embedding_model.encode(text).tolist()
-        return Binary(zlib.compress(np.array(embedding, dtype=np.float32).tobytes()))
-    except Exception as e:
-        logging.error(f"Error al generar embedding: {e}")
-        return None
-
-def infer_domain_heuristically(subject, body):
-    text = f"{subject} {body}".lower()
-    if "encuesta" in text or "feedback" in text or "satisfacción" in text:
-        return "feedback", 0.7
-    elif "viaje" in text or "reserva" in text or "hotel" in text:
-        return "viajes", 0.7
-    elif "negocio" in text or "propuesta" in text or "contrato" in text:
-        return "negocios", 0.7
-    elif "promoción" in text or "oferta" in text or "descuento" in text:
-        return "promociones", 0.7
-    elif "técnico" in text or "soporte" in text or "incidencia" in text:
-        return "técnico", 0.7
-    else:
-        return "general", 0.5
-
-def classify_heuristically(response_text):
-    classifications = {
-        'requires_response': False,
-        'urgent': False,
-        'important': False,
-        'advertisement': False
-    }
-    if re.search(r'"requires_response"\s*:\s*true', response_text, re.IGNORECASE):
-        classifications['requires_response'] = True
-    if re.search(r'"urgent"\s*:\s*true', response_text, re.IGNORECASE):
-        classifications['urgent'] = True
-    if re.search(r'"important"\s*:\s*true', response_text, re.IGNORECASE):
-        classifications['important'] = True
-    if re.search(r'"advertisement"\s*:\s*true', response_text, re.IGNORECASE):
-        classifications['advertisement'] = True
-    return classifications
-
-def is_likely_json(text):
-    text = text.strip()
-    if not text or len(text) < 2:
-        return False
-    if (text.startswith('{') and text.endswith('}')) or (text.startswith('[') and text.endswith(']')):
-        content = text[1:-1].strip()
-        return bool(content and (':' in text or ',' in text or (text.startswith('[') and len(content) > 0)))
-    return False
-
-def extract_json_from_text(text):
-    if isinstance(text, list):
-        for item in text:
-            if is_likely_json(item):
-                return item
-            elif '{' in item:
-                partial_json = item[item.index('{'):] + '}'
-                if is_likely_json(partial_json):
-                    return partial_json
-        return None
-    json_pattern = re.compile(r'(\{[^{}]*\}|\[[^\[\]]*\])', re.DOTALL)
-    matches = json_pattern.findall(text)
-    if matches:
-        for match in sorted(matches, key=len, reverse=True):
-            if is_likely_json(match):
-                return match
-    if '{' in text and '}' not in text:
-        partial_json = text[text.index('{'):] + '}'
-        if is_likely_json(partial_json):
-            return partial_json
-    return None
-
-def clean_json(raw_string):
-    cleaned = re.sub(r'\t', ' ', raw_string)
-    cleaned = re.sub(r'//.*$', '', cleaned, flags=re.MULTILINE)
-    cleaned = re.sub(r'^\s*[\r\n]+', '', cleaned, flags=re.MULTILINE)
-    if not cleaned.startswith('{'):
-        cleaned = '{' + cleaned
-    brace_count = cleaned.count('{') - cleaned.count('}')
-    if brace_count > 0:
-        cleaned += '}' * brace_count
-    cleaned = re.sub(r'(\w+)\s*:', r'"\1":', cleaned)
-    cleaned = re.sub(r',\s*([\]}])', r'\1', cleaned)
-    return "\n".join([line.strip() for line in cleaned.splitlines() if line.strip()])
-
-def safe_parse_json(response_text, message_id, subject):
-    if isinstance(response_text, list):
-        for item in response_text:
-            parsed = safe_parse_json(item, message_id, subject)
-            if parsed and "error" not in parsed:
-                return parsed
-        return {"error": "No valid JSON in list", "original": str(response_text[:200])}
-    
-    response_text = response_text.strip()
-    if not response_text:
-        logging.error(f"Respuesta vacía para message_id {message_id}, subject '{subject}'")
-        return {"error": "Empty response"}
-
-    if not is_likely_json(response_text):
-        possible_json = extract_json_from_text(response_text)
-        if not possible_json:
-            logging.error(f"No se encontró JSON válido en la respuesta para message_id {message_id}, subject '{subject}': {response_text[:200]}")
-            return {"error": "No valid JSON found", "original": response_text[:200]}
-        response_text = possible_json
-
-    attempts = [
-        response_text,
-        clean_json(response_text),
-        repair_json(response_text),
-        f'{{"error": "Reparación fallida", "original": "{response_text[:200]}"}}'
-    ]
-    
-    for i, attempt in enumerate(attempts):
-        try:
-            parsed = json.loads(attempt)
-            if i > 0:
-                logging.info(f"Reparación exitosa en intento {i+1} para message_id {message_id}, subject '{subject}'")
-            return parsed
-        except json.JSONDecodeError as e:
-            if i == len(attempts) - 1:
-                logging.error(f"Fallo total al parsear JSON para message_id {message_id}, subject '{subject}': {e}. Respuesta: {response_text[:500]}")
-                return {"error": "Parse failure", "original": response_text[:200]}
-            continue
-
-def process_api_response(response, message_id, subject, expected_keys):
-    if response is None or isinstance(response, (str, int, float)):
-        logging.error(f"Respuesta inválida para message_id {message_id}, subject '{subject}': {response}")
-        return None
-    if isinstance(response, list):
-        for item in response:
-            if isinstance(item, dict) and all(key in item for key in expected_keys):
-                return item
-            elif isinstance(item, str):
-                try:
-                    parsed_item = json.loads(item)
-                    if isinstance(parsed_item, dict) and all(key in parsed_item for key in expected_keys):
-                        return parsed_item
-                except json.JSONDecodeError:
-                    continue
-        logging.warning(f"No se encontró un JSON válido en la lista para message_id {message_id}, subject '{subject}': {response}")
-        return None
-    if isinstance(response, dict):
-        if "error" in response:
-            logging.warning(f"Respuesta con error para message_id {message_id}, subject '{subject}': {response}")
-            return None
-        if all(key in response for key in expected_keys):
-            return response
-        logging.error(f"Respuesta no contiene claves esperadas {expected_keys} para message_id {message_id}, subject '{subject}': {response}")
-    return None
-
-def infer_semantic_domain(subject, body, attachments_content, message_id):
-    text = f"{subject or ''} {body or ''} {' '.join(attachments_content) or ''}".strip()
-    if not text:
-        return 'general', 0.5
-
-    prompt = f"""
-    Analiza el siguiente texto de un correo electrónico y determina el dominio semántico más adecuado (ejemplo: "viajes", "negocios", "personal", "promociones", "técnico", "general").
-    Devuelve EXCLUSIVAMENTE un objeto JSON con:
-    - "semantic_domain": El dominio semántico identificado (cadena vacía si no se puede determinar).
-    - "confidence": Valor entre 0 y 1 que indica la confianza en la selección.
+def embedding_text(subject, body, summary):
+    return f"{subject or ''} {body or ''} {summary or ''}".strip()
 
-    Texto:
-    {text[:2000]}
-    """
+def generate_embeddings(texts):
+    """Genera en lote los embeddings comprimidos de una lista de textos."""
+    return generate_embeddings_batch(get_embedding_model(), texts, EMBEDDING_BATCH_SIZE, EMBEDDING_LENGTH_BUCKETING)
 
-    response = call_mistral_api(prompt)
-    parsed_response = safe_parse_json(response, message_id, subject)
-    processed_response = process_api_response(parsed_response, message_id, subject, ['semantic_domain', 'confidence'])
-    if processed_response:
-        return processed_response['semantic_domain'] or 'general', processed_response['confidence']
-    logging.warning(f"No se pudo inferir dominio semántico para message_id {message_id}, subject '{subject}'. Usando heurística.")
-    return infer_domain_heuristically(subject, body)
+def generate_embedding(subject, body, summary):
+    return generate_embeddings([embedding_text(subject, body, summary)])[0]
 
-def classify_email(email, message_id, top_senders):
+def adjust_classifications(classifications, email, message_id, top_senders):
+    """Ajusta las clasificaciones del LLM con el modelo bayesiano, las cabeceras y los remitentes frecuentes."""
     subject = email.get('subject', '')
-    body = email.get('body', '')
-    attachments_content = ' '.join(email.get('attachments_content', []))
+    text = f"{subject} {email.get('body', '')} {' '.join(email.get('attachments_content', []))}".strip()
     from_ = email.get('from', '')
 
-    text = f"{subject} {body} {attachments_content}".strip()
-    if not text:
-        return {'requires_response': False, 'urgent': False, 'important': False, 'advertisement': False}
-
     # Verificar encabezados para urgencia e importancia
     headers = email.get('headers', {})
     priority = headers.get('X-Priority', '').lower()
@@ -554,98 +396,54 @@ def classify_email(email, message_id, top_senders):
 
     # Determinar si el remitente es cualificado o frecuente
     is_qualified_sender = any(qs in from_.lower() for qs in qualified_senders)
-    is_top_sender = from_ in top_senders
-
-    # Prompt mejorado para Mistral
-    prompt = f"""
-    Analiza el siguiente texto de un correo electrónico y clasifica sus características. Devuelve EXCLUSIVAMENTE un objeto JSON con:
-    - "requires_response": Booleano, verdadero si el correo solicita una respuesta explícita.
-    - "urgent": Booleano, verdadero si el correo indica urgencia o requiere acción inmediata.
-    - "important": Booleano, verdadero si el correo es importante o contiene información trascendente.
-    - "advertisement": Booleano, verdadero si el correo parece publicidad, ofertas, promociones, etc.
-
-    Considera lo siguiente al clasificar:
-    - Publicidad: Busca ofertas, precios, mensajes impactantes, tiempos limitados, incentivos para comprar, etc.
-    - Urgencia: Busca palabras como "urgente", "inmediato", "pronto", o plazos cortos.
-    - Importancia: Busca decisiones trascendentes, información crítica, o temas de alta relevancia.
-
-    Texto:
-    {text[:2000]}
-    """
-
-    response = call_mistral_api(prompt)
-    parsed_response = safe_parse_json(response, message_id, subject)
-    mistral_classifications = process_api_response(parsed_response, message_id, subject, ['requires_response', 'urgent', 'important', 'advertisement'])
-
-    if mistral_classifications:
-        # Clasificación de publicidad con modelo bayesiano
-        if os.path.exists(bayesian_model_file):
-            with open(bayesian_model_file, 'rb') as f:
-                bayesian_model = pickle.load(f)
-            text_vector = bayesian_model['vectorizer'].transform([text])
-            bayesian_prob = bayesian_model['classifier'].predict_proba(text_vector)[0][1]  # Probabilidad de ser publicidad
-            mistral_ad_prob = 1 if mistral_classifications['advertisement'] else 0
-            avg_ad_prob = (mistral_ad_prob + bayesian_prob) / 2
-            mistral_classifications['advertisement'] = avg_ad_prob >= 0.8
-        else:
-            logging.warning(f"Modelo bayesiano no encontrado para message_id {message_id}, subject '{subject}'. Usando solo Mistral para publicidad.")
+    is_top_sender = sender_address(from_) in top_senders
+
+    # Clasificación de publicidad con modelo bayesiano (se carga una vez por proceso)
+    bayesian_model = load_bayesian_model(bayesian_model_file)
+    if bayesian_model:
+        text_vector = bayesian_model['vectorizer'].transform([text])
+        bayesian_prob = bayesian_model['classifier'].predict_proba(text_vector)[0][1]  # Probabilidad de ser publicidad
+        mistral_ad_prob = 1 if classifications['advertisement'] else 0
+        avg_ad_prob = (mistral_ad_prob + bayesian_prob) / 2
+        classifications['advertisement'] = avg_ad_prob >= 0.8
+    else:
+        logging.warning(f"Modelo bayesiano no encontrado para message_id {message_id}, subject '{subject}'. Usando solo Mistral para publicidad.")
 
-        # Ajustar urgencia e importancia
-        if is_urgent or (mistral_classifications['urgent'] and (is_qualified_sender or is_top_sender)):
-            mistral_classifications['urgent'] = True
-        if is_important or (mistral_classifications['important'] and (is_qualified_sender or is_top_sender)):
-            mistral_classifications['important'] = True
+    # Ajustar urgencia e importancia
+    if is_urgent or (classifications['urgent'] and (is_qualified_sender or is_top_sender)):
+        classifications['urgent'] = True
+    if is_important or (classifications['important'] and (is_qualified_sender or is_top_sender)):
+        classifications['important'] = True
 
-        # Publicidad no puede ser urgente ni importante
-        if mistral_classifications['advertisement']:
-            mistral_classifications['urgent'] = False
-            mistral_classifications['important'] = False
+    # Publicidad no puede ser urgente ni importante
+    if classifications['advertisement']:
+        classifications['urgent'] = False
+        classifications['important'] = False
 
-        return mistral_classifications
+    return classifications
 
-    logging.warning(f"No se pudo clasificar correo para message_id {message_id}, subject '{subject}'. Usando heurística.")
-    return classify_heuristically(response)
+def classify_with_cascade(mailbox_id, embedding, subject='', body=''):
+    """Dominio y clasificaciones de los clasificadores locales del buzón, o None si no son fiables.
 
-def check_responded_status(service, user_id, msg, message_id, mailbox_id):
-    try:
-        headers = {header['name']: header['value'] for header in msg['payload']['headers']}
-        in_reply_to = headers.get('In-Reply-To')
-        thread_id = msg.get('threadId')
-
-        if in_reply_to:
-            results = service.users().messages().list(userId='me', q=f"from:{mailbox_id} in_reply_to:{in_reply_to}", maxResults=1).execute()
-            if results.get('messages', []):
-                return True
-
-        if thread_id:
-            thread = service.users().threads().get(userId='me', id=thread_id).execute()
-            messages = thread.get('messages', [])
-            msg_date = headers.get('Date')
-            if not msg_date:
-                return False
-            parsed_date = parse_email_date(msg_date)
-            if not parsed_date:
-                return False
-            msg_timestamp = parsed_date.timestamp()
-            for thread_msg in messages:
-                thread_headers = {h['name']: h['value'] for h in thread_msg['payload']['headers']}
-                thread_from = thread_headers.get('From', '')
-                thread_date = thread_headers.get('Date', '')
-                if mailbox_id in thread_from.lower() and thread_date:
-                    parsed_thread_date = parse_email_date(thread_date)
-                    if parsed_thread_date and parsed_thread_date.timestamp() > msg_timestamp:
-                        return True
-        return False
-    except HttpError as e:
-        if e.resp.status == 401:
-            raise
-        logging.error(f"Error al verificar estado de respuesta para message_id {message_id}: {e}")
-        return False
-    except Exception as e:
-        logging.error(f"Error inesperado al verificar estado de respuesta para message_id {message_id}: {e}")
-        return False
-
-def process_email_with_mistral(email, message_id):
+    Solo se aplica a correos que ya tienen embedding: la cola de enriquecimiento, las
+    revisiones y el pipeline en línea, que calcula los embeddings antes de la etapa LLM.
+    """
+    local = None
+    if LOCAL_CLASSIFIER_ENABLED and embedding:
+        classifier = get_local_classifier(emails_collection, mailbox_id, LOCAL_CLASSIFIER_MIN_EXAMPLES, LOCAL_CLASSIFIER_MAX_TRAINING, LOCAL_CLASSIFIER_RETRAIN_SECONDS)
+        local = resolve_locally(classifier, embedding, LOCAL_CLASSIFIER_THRESHOLD, classifier_text(subject, body))
+    record_resolution(local is not None)
+    return local
+
+def enrich_email_with_mistral(email, message_id, top_senders, local=None):
+    """Obtiene en una sola llamada al LLM el resumen, los términos relevantes, el dominio semántico y las clasificaciones.
+
+    La respuesta se pide con el esquema 'email_enrichment' y llega ya validada. Con local
+    (resultado de classify_with_cascade) el LLM solo genera resumen y términos ('email_summary').
+    Devuelve (summary, relevant_terms, semantic_domain, domain_confidence, classifications),
+    o None si el LLM no responde o ningún intento produce una respuesta válida: el correo
+    sigue sin enriquecer y se reintenta más tarde.
+    """
     subject = email.get('subject', '')
     from_ = email.get('from', '')
     to = email.get('to', '')
@@ -653,8 +451,33 @@ def process_email_with_mistral(email, message_id):
     attachments = ' '.join([a for a in email.get('attachments', []) if a is not None])
     attachments_content = ' '.join([c for c in email.get('attachments_content', []) if c is not None])
 
+    if not f"{subject} {body} {attachments_content}".strip():
+        return "Resumen no disponible", {}, 'general', 0.5, dict.fromkeys(CLASSIFICATION_KEYS, False)
+
     optimized_text = f"{text_optimization(subject)} {text_optimization(from_)} {text_optimization(to)} {text_optimization(body)} {text_optimization(attachments)} {text_optimization_attachments(attachments_content)}"
 
+    if local:
+        prompt = f"""
+    Analiza el siguiente texto de un correo electrónico y devuelve EXCLUSIVAMENTE un objeto JSON válido con:
+    1. "summary": Un resumen con temas clave, nombres propios y términos específicos del dominio. Este resumen debe estar en el mismo idioma que el texto del correo.
+    2. "relevant_terms": Un diccionario donde las claves son términos relevantes y los valores son objetos con:
+       - "frequency": Número entero de veces que aparece.
+       - "context": Breve descripción de su significado o uso.
+       - "type": "acción", "nombre_propio", "url" o "definición_temporal".
+
+    Texto:
+    {optimized_text}
+    """
+        parsed_response, _ = generate_structured(
+            'email_summary', prompt,
+            lambda prompt, format, accept: call_mistral_api(prompt, num_predict=ENRICHMENT_MAX_TOKENS, format=format, accept=accept)
+        )
+        if parsed_response is None:
+            logging.warning(f"Respuesta de resumen no válida para message_id {message_id}, subject '{subject}'. El correo queda sin enriquecer.")
+            return None
+        classifications = adjust_classifications(dict(local['classifications']), email, message_id, top_senders)
+        return parsed_response['summary'] or "Resumen no disponible", parsed_response['relevant_terms'], local['semantic_domain'], local['domain_confidence'], classifications
+
     prompt = f"""
     Analiza el siguiente texto de un correo electrónico y devuelve EXCLUSIVAMENTE un objeto JSON válido con:
     1. "summary": Un resumen con temas clave, nombres propios y términos específicos del dominio. Este resumen debe estar en el mismo idioma que el texto del correo.
@@ -662,147 +485,236 @@ def process_email_with_mistral(email, message_id):
        - "frequency": Número entero de veces que aparece.
        - "context": Breve descripción de su significado o uso.
        - "type": "acción", "nombre_propio", "url" o "definición_temporal".
-    
+    3. "semantic_domain": El dominio semántico más adecuado (ejemplo: "viajes", "negocios", "personal", "promociones", "técnico", "general"; cadena vacía si no se puede determinar).
+    4. "confidence": Valor entre 0 y 1 que indica la confianza en el dominio semántico.
+    5. "requires_response": Booleano, verdadero si el correo solicita una respuesta explícita.
+    6. "urgent": Booleano, verdadero si el correo indica urgencia o requiere acción inmediata.
+    7. "important": Booleano, verdadero si el correo es importante o contiene información trascendente.
+    8. "advertisement": Booleano, verdadero si el correo parece publicidad, ofertas, promociones, etc.
+
+    Considera lo siguiente al clasificar:
+    - Publicidad: Busca ofertas, precios, mensajes impactantes, tiempos limitados, incentivos para comprar, etc.
+    - Urgencia: Busca palabras como "urgente", "inmediato", "pronto", o plazos cortos.
+    - Importancia: Busca decisiones trascendentes, información crítica, o temas de alta relevancia.
+
     Texto:
     {optimized_text}
     """
 
-    response = call_mistral_api(prompt)
-    parsed_response = safe_parse_json(response, message_id, subject)
-    processed_response = process_api_response(parsed_response, message_id, subject, ['summary', 'relevant_terms'])
-    if processed_response:
-        summary = processed_response.get("summary", "Resumen no disponible")
-        relevant_terms = processed_response.get("relevant_terms", {})
-        if not isinstance(relevant_terms, dict):
-            relevant_terms = {}
-        return summary, relevant_terms
-    logging.warning(f"No se pudo procesar respuesta para message_id {message_id}, subject '{subject}'. Usando predeterminados.")
-    return "Resumen no disponible", {}
-
-def call_mistral_api(prompt):
-    prompt_hash = hashlib.md5(prompt.encode('utf-8')).hexdigest()
-    if prompt_hash in response_cache:
-        response_cache.move_to_end(prompt_hash)
-        return response_cache[prompt_hash]
-
-    url = "http://localhost:11434/api/generate"
-    payload = {
-        "model": "mistral-custom",
-        "prompt": prompt,
-        "stream": False,
-        "temperature": 0.7,
-        "num_predict": 512,
-        "num_ctx": 32768
-    }
-    
+    parsed_response, _ = generate_structured(
+        'email_enrichment', prompt,
+        lambda prompt, format, accept: call_mistral_api(prompt, num_predict=ENRICHMENT_MAX_TOKENS, format=format, accept=accept)
+    )
+    if parsed_response is None:
+        logging.warning(f"Respuesta de enriquecimiento no válida para message_id {message_id}, subject '{subject}'. El correo queda sin enriquecer.")
+        return None
+
+    summary = parsed_response["summary"] or "Resumen no disponible"
+    relevant_terms = parsed_response["relevant_terms"]
+    semantic_domain = parsed_response["semantic_domain"] or 'general'
+    domain_confidence = float(parsed_response["confidence"])
+    classifications = adjust_classifications({key: parsed_response[key] for key in CLASSIFICATION_KEYS}, email, message_id, top_senders)
+    return summary, relevant_terms, semantic_domain, domain_confidence, classifications
+
+def call_mistral_api(prompt, num_predict=512, priority=PRIORITY_BACKFILL, format=None, accept=None):
+    """Llama al LLM con caché compartido.
+
+    Con format (esquema JSON) la generación queda restringida a ese esquema; solo se
+    guardan en caché las respuestas que acepta accept y, si la API falla, devuelve None.
+    """
+    options = {"temperature": 0.7, "num_predict": num_predict}
+    if format is not None:
+        options["format"] = format
+    cache_key, cached = get_cached_llm_response("mistral-custom", options, prompt)
+    if cached is not None and (accept is None or accept(cached)):
+        return cached
+
     max_retries = 3
-    base_delay = 2
-    for attempt in range(max_retries + 1):
-        try:
-            response = requests.post(url, json=payload, timeout=30)
-            response.raise_for_status()
-            result = response.json()['response']
-            if len(response_cache) >= cache_limit:
-                response_cache.popitem(last=False)
-            response_cache[prompt_hash] = result
-            with open(cache_file, 'wb') as f:
-                pickle.dump(response_cache, f)
-            return result
-        except requests.exceptions.RequestException as e:
-            if attempt < max_retries:
-                delay = base_delay * (2 ** attempt) + random.uniform(0, 0.1 * base_delay)
-                logging.warning(f"Intento {attempt + 1} fallido al contactar con la API: {e}. Reintentando en {delay:.2f} segundos...")
-                time.sleep(delay)
-            else:
-                logging.error(f"Error al contactar con la API tras {max_retries} intentos: {e}")
-                return f'{{"error": "API failure", "message": "{str(e)}"}}'
-
-def normalize_subject(subject):
-    """Normaliza el asunto eliminando prefijos como RE:, FWD:, etc."""
-    prefixes = ['re:', 'fwd:', 'fw:', 'rv:']
-    subject_lower = subject.lower()
-    for prefix in prefixes:
-        if subject_lower.startswith(prefix):
-            subject = subject[len(prefix):].strip()
-            break
-    return subject
+    try:
+        result = ollama_generate(prompt, options, priority, model="mistral-custom", timeout=30, retries=max_retries)
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Error al contactar con la API tras {max_retries} intentos: {e}")
+        return None if format is not None else f'{{"error": "API failure", "message": "{str(e)}"}}'
+    if accept is None or accept(result):
+        cache_llm_response(cache_key, result)
+    return result
 
 def find_thread_by_subject(subject, mailbox_id):
     """Busca un hilo existente basado en el asunto normalizado"""
     normalized_subject = normalize_subject(subject)
-    existing_thread = emails_collection.find_one({
-        'mailbox_id': mailbox_id,
-        'subject': {'$regex': f"^{re.escape(normalized_subject)}", '$options': 'i'}
-    })
+    if not normalized_subject:
+        return None
+    existing_thread = emails_collection.find_one(
+        {'mailbox_id': mailbox_id, 'normalized_subject': normalized_subject},
+        {'parent_thread_id': 1}
+    )
     if existing_thread:
         return existing_thread.get('parent_thread_id')
     return None
 
-def calculate_similarity(embedding1, embedding2):
-    """Calcula la similitud cosino entre dos embeddings"""
-    if embedding1 is None or embedding2 is None:
-        return 0.0
-    emb1 = np.frombuffer(zlib.decompress(embedding1), dtype=np.float32)
-    emb2 = np.frombuffer(zlib.decompress(embedding2), dtype=np.float32)
-    return np.dot(emb1, emb2) / (np.linalg.norm(emb1) * np.linalg.norm(emb2))
+def backfill_emails(query, projection, update_for, dry_run=False, batch_size=1000):
+    """Recorre los correos de query y les aplica en bloque el $set que devuelve update_for(doc).
 
-def find_similar_thread(email_embedding, from_, to, mailbox_id, threshold=0.8):
+    Devuelve el número de correos actualizados (en dry run, los que se actualizarían).
+    """
+    operations = []
+    total_updated = 0
+    for doc in emails_collection.find(query, {'_id': 1, **projection}):
+        operations.append(UpdateOne({'_id': doc['_id']}, {'$set': update_for(doc)}))
+        if len(operations) >= batch_size:
+            total_updated += len(operations) if dry_run else emails_collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        total_updated += len(operations) if dry_run else emails_collection.bulk_write(operations, ordered=False).modified_count
+    return total_updated
+
+def backfill_normalized_subjects(mailbox_id, dry_run=False, batch_size=1000):
+    """Calcula normalized_subject en los correos del buzón que aún no lo tienen."""
+    logging.info(f"Calculando normalized_subject para los correos de {mailbox_id}...")
+    total_updated = backfill_emails(
+        {'mailbox_id': mailbox_id, 'normalized_subject': {'$exists': False}}, {'subject': 1},
+        lambda doc: {'normalized_subject': normalize_subject(doc.get('subject', ''))},
+        dry_run=dry_run, batch_size=batch_size
+    )
+    logging.info(f"normalized_subject {'pendiente en' if dry_run else 'calculado para'} {total_updated} correos de {mailbox_id}")
+
+def backfill_fingerprints(mailbox_id, dry_run=False, batch_size=1000):
+    """Calcula la huella SimHash del cuerpo en los correos del buzón que aún no la tienen.
+
+    Los correos con cuerpo demasiado corto se marcan con simhash None para no volver a procesarlos.
+    """
+    logging.info(f"Calculando huellas de casi duplicados para los correos de {mailbox_id}...")
+    total_updated = backfill_emails(
+        {'mailbox_id': mailbox_id, 'simhash': {'$exists': False}}, {'body': 1},
+        lambda doc: body_fingerprint(doc.get('body', ''), NEAR_DUPLICATE_MIN_SHINGLES) or {'simhash': None},
+        dry_run=dry_run, batch_size=batch_size
+    )
+    logging.info(f"Huella SimHash {'pendiente en' if dry_run else 'calculada para'} {total_updated} correos de {mailbox_id}")
+
+def backfill_address_fields(mailbox_id, dry_run=False, batch_size=1000):
+    """Calcula from_addr, to_addrs, cc_addrs y direction en los correos del buzón que aún no los tienen.
+
+    El Cc no se guardaba como campo propio, así que se recupera de headers_text.
+    """
+    total_updated = backfill_emails(
+        {'mailbox_id': mailbox_id, 'direction': {'$exists': False}}, {'from': 1, 'to': 1, 'headers_text': 1},
+        lambda doc: address_fields(doc.get('from'), doc.get('to'), header_from_text(doc.get('headers_text'), 'Cc'), mailbox_id),
+        dry_run=dry_run, batch_size=batch_size
+    )
+    if total_updated:
+        logging.info(f"Direcciones normalizadas {'pendientes en' if dry_run else 'calculadas para'} {total_updated} correos de {mailbox_id}")
+    return total_updated
+
+def migrate_address_fields(mailbox_id, dry_run=False):
+    """Cálculo único de las direcciones normalizadas de los correos antiguos del buzón.
+
+    Se marca como completado en la colección `migrations`, así que las siguientes ingestiones
+    solo leen la marca; si se interrumpe, se reanuda porque solo recorre los correos sin
+    direction. Los correos nuevos reciben los campos al guardarse; -backfill_addresses
+    fuerza el recorrido completo.
+    """
+    migration_id = f"{ADDRESS_MIGRATION}:{mailbox_id}"
+    if (migrations_collection.find_one({'_id': migration_id}) or {}).get('completed_at'):
+        return
+    try:
+        backfill_address_fields(mailbox_id, dry_run=dry_run)
+    except Exception as e:
+        logging.error(f"Error al calcular las direcciones de {mailbox_id} (se reanudará en la próxima ejecución): {e}")
+        return
+    if not dry_run:
+        migrations_collection.update_one({'_id': migration_id}, {'$set': {'completed_at': datetime.now(timezone.utc)}}, upsert=True)
+
+def find_similar_thread(email_embedding, from_, to, mailbox_id, threshold=0.8, message_id=None):
     """Busca un hilo similar basado en la similitud de embeddings y coincidencia de remitentes/destinatarios"""
-    cursor = emails_collection.find({'mailbox_id': mailbox_id, 'embedding': {'$ne': None}})
-    for doc in cursor:
-        similarity = calculate_similarity(email_embedding, doc['embedding'])
-        if similarity > threshold and (doc['from'] == from_ or doc['to'] == to):
-            return doc.get('parent_thread_id')
+    if email_embedding is None:
+        return None
+    index = get_mailbox_index(emails_collection, mailbox_id)
+    for similarity, parent_thread_id in index.search(email_embedding, k=VECTOR_INDEX_TOP_K, threshold=threshold, from_=from_, to=to, exclude_message_id=message_id):
+        if parent_thread_id:
+            return parent_thread_id
     return None
 
 def review_existing_emails(username, mailbox_id=None, force_update_elastic=False):
     query = {'mailbox_id': mailbox_id} if mailbox_id else {'from': username}
     cursor = emails_collection.find(query)
     top_senders = get_top_senders(mailbox_id)
+    cascade_before = cascade_stats()
+    # Los correos se revisan de uno en uno, pero los textos de adjuntos se leen y los
+    # embeddings que faltan se generan por lotes
+    docs = []
     for doc in cursor:
+        docs.append(doc)
+        if len(docs) >= EMBEDDING_BATCH_SIZE:
+            load_attachment_texts(attachments_collection, docs)
+            apply_email_reviews([review_email_metadata(doc, top_senders) for doc in docs], mailbox_id, force_update_elastic)
+            docs = []
+    if docs:
+        load_attachment_texts(attachments_collection, docs)
+        apply_email_reviews([review_email_metadata(doc, top_senders) for doc in docs], mailbox_id, force_update_elastic)
+    log_cascade_stats(cascade_before, mailbox_id, 'revisión')
+
+def review_email_metadata(doc, top_senders):
+    """Revisa resumen, dominio y clasificaciones de un correo y devuelve los cambios propuestos."""
+    message_id = doc.get('message_id', 'unknown')
+    subject = doc.get('subject', '')
+    from_ = doc.get('from', '')
+    to = doc.get('to', '')
+    body = doc.get('body', '')
+    attachments_content = doc.get('attachments_content', [])
+    headers = doc.get('headers', {})
+
+    email_dict = {
+        'subject': subject,
+        'from': from_,
+        'to': to,
+        'body': body,
+        'attachments_content': attachments_content,
+        'headers': headers
+    }
+
+    updates = {}
+    
+    local = classify_with_cascade(doc.get('mailbox_id'), doc.get('embedding'), subject, body)
+    enrichment = enrich_email_with_mistral(email_dict, message_id, top_senders, local=local)
+    if enrichment is None:
+        # Sin respuesta del LLM se conserva el enriquecimiento actual; solo se revisa el hilo
+        return {'doc': doc, 'updates': updates, 'summary': doc.get('summary', '')}
+    summary, relevant_terms, semantic_domain, confidence, classifications = enrichment
+
+    # Revisar y corregir resumen y términos relevantes
+    updates['summary'] = summary
+    updates['relevant_terms'] = relevant_terms
+    updates['relevant_terms_array'] = list(relevant_terms.keys())
+
+    # Revisar y corregir dominio semántico
+    if doc.get('semantic_domain') == 'general' and doc.get('domain_confidence') == 0.5:
+        updates['semantic_domain'] = semantic_domain
+        updates['domain_confidence'] = confidence
+
+    # Revisar y corregir clasificaciones
+    if any(key not in doc or not isinstance(doc[key], bool) for key in CLASSIFICATION_KEYS):
+        updates['requires_response'] = bool(classifications.get('requires_response', False))
+        updates['urgent'] = bool(classifications.get('urgent', False))
+        updates['important'] = bool(classifications.get('important', False))
+        updates['advertisement'] = bool(classifications.get('advertisement', False))
+        updates['classified_by'] = CLASSIFIED_BY_LOCAL if local else CLASSIFIED_BY_LLM
+
+    return {'doc': doc, 'updates': updates, 'summary': summary}
+
+def apply_email_reviews(reviews, mailbox_id, force_update_elastic=False):
+    """Completa los embeddings que faltan en un único lote, revisa el hilo y guarda los cambios."""
+    missing = [review for review in reviews if review['doc'].get('embedding') is None]
+    embeddings = generate_embeddings([embedding_text(review['doc'].get('subject', ''), review['doc'].get('body', ''), review['summary']) for review in missing])
+    for review, embedding in zip(missing, embeddings):
+        review['updates']['embedding'] = embedding
+
+    for review in reviews:
+        doc, updates, summary = review['doc'], review['updates'], review['summary']
         message_id = doc.get('message_id', 'unknown')
         subject = doc.get('subject', '')
         from_ = doc.get('from', '')
         to = doc.get('to', '')
         body = doc.get('body', '')
-        attachments_content = doc.get('attachments_content', [])
-        headers = doc.get('headers', {})
-
-        email_dict = {
-            'subject': subject,
-            'from': from_,
-            'to': to,
-            'body': body,
-            'attachments_content': attachments_content,
-            'headers': headers
-        }
-
-        updates = {}
-        
-        # Revisar y corregir resumen y términos relevantes
-        summary, relevant_terms = process_email_with_mistral(email_dict, message_id)
-        updates['summary'] = summary
-        updates['relevant_terms'] = relevant_terms
-        updates['relevant_terms_array'] = list(relevant_terms.keys())
-
-        # Revisar y corregir dominio semántico
-        if doc.get('semantic_domain') == 'general' and doc.get('domain_confidence') == 0.5:
-            semantic_domain, confidence = infer_semantic_domain(subject, body, attachments_content, message_id)
-            updates['semantic_domain'] = semantic_domain
-            updates['domain_confidence'] = confidence
-
-        # Revisar y corregir clasificaciones
-        if any(key not in doc or not isinstance(doc[key], bool) for key in ['requires_response', 'urgent', 'important', 'advertisement']):
-            classifications = classify_email(email_dict, message_id, top_senders)
-            updates['requires_response'] = bool(classifications.get('requires_response', False))
-            updates['urgent'] = bool(classifications.get('urgent', False))
-            updates['important'] = bool(classifications.get('important', False))
-            updates['advertisement'] = bool(classifications.get('advertisement', False))
-
-        # Revisar y corregir embedding
-        if 'embedding' not in doc or doc['embedding'] is None:
-            embedding = generate_embedding(subject, body, summary)
-            updates['embedding'] = embedding
 
         # Revisar y corregir hilo
         current_parent_thread_id = doc.get('parent_thread_id')
@@ -812,9 +724,11 @@ def review_existing_emails(username, mailbox_id=None, force_update_elastic=False
                 updates['parent_thread_id'] = thread_by_subject
             else:
                 embedding = updates.get('embedding', doc.get('embedding'))
-                similar_thread = find_similar_thread(embedding, from_, to, mailbox_id)
+                similar_thread = find_similar_thread(embedding, from_, to, mailbox_id, message_id=message_id)
                 if similar_thread:
                     updates['parent_thread_id'] = similar_thread
+        if 'embedding' in updates or 'parent_thread_id' in updates:
+            get_mailbox_index(emails_collection, mailbox_id).add(message_id, updates.get('embedding', doc.get('embedding')), from_, to, updates.get('parent_thread_id', current_parent_thread_id))
 
         if updates or force_update_elastic:
             emails_collection.update_one(
@@ -822,6 +736,10 @@ def review_existing_emails(username, mailbox_id=None, force_update_elastic=False
                 {'$set': updates}
             )
             logging.info(f"Updated metadata for message_id {message_id}: {list(updates.keys())}")
+            if 'parent_thread_id' in updates:
+                if current_parent_thread_id:
+                    remove_thread_member(threads_collection, message_id, current_parent_thread_id, mailbox_id)
+                update_threads(threads_collection, [{**doc, **updates}])
 
             # Sincronizar con Elasticsearch, incluyendo mailbox_id
             es_doc = {
@@ -834,6 +752,7 @@ def review_existing_emails(username, mailbox_id=None, force_update_elastic=False
                 'from': from_,
                 'to': to,
                 'date': doc.get('date', 'unknown'),
+                'attachments_content': attachment_search_text(doc),
                 'semantic_domain': updates.get('semantic_domain', doc.get('semantic_domain', 'general')),
                 'embedding': np.frombuffer(zlib.decompress(updates.get('embedding', doc.get('embedding'))), dtype=np.float32).tolist() if updates.get('embedding', doc.get('embedding')) else []
             }
@@ -852,15 +771,10 @@ def review_existing_emails(username, mailbox_id=None, force_update_elastic=False
                 )
 
 def download_attachment(service, user_id, msg_id, part):
+    """Descarga un adjunto de Gmail y devuelve su contenido en memoria (None si falla)."""
     try:
         attachment = service.users().messages().attachments().get(userId=user_id, messageId=msg_id, id=part['body']['attachmentId']).execute()
-        file_data = base64.urlsafe_b64decode(attachment['data'].encode('UTF-8'))
-        filename = part.get('filename', 'unnamed_attachment')
-        path = f'./attachments/{filename}'
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'wb') as f:
-            f.write(file_data)
-        return path
+        return base64.urlsafe_b64decode(attachment['data'].encode('UTF-8'))
     except HttpError as e:
         if e.resp.status == 401:
             raise
@@ -870,62 +784,13 @@ def download_attachment(service, user_id, msg_id, part):
         logging.error(f"Error downloading attachment: {e}")
         return None
 
-def save_attachment(part):
-    filename = part.get_filename()
-    if not filename:
-        filename = 'unnamed_attachment'
-    path = f'./attachments/{filename}'
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, 'wb') as f:
-        f.write(part.get_payload(decode=True))
-    return path
-
-def analyze_attachment(file_path):
-    if not file_path:
-        return "No se pudo descargar el adjunto"
-    mime = mimetypes.guess_type(file_path)[0]
-    if mime == 'text/plain':
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read()
-    elif mime == 'application/pdf':
-        try:
-            reader = PdfReader(file_path)
-            return "".join(page.extract_text() for page in reader.pages)
-        except Exception:
-            return "Error al analizar PDF"
-    elif mime.startswith('image/'):
-        try:
-            return pytesseract.image_to_string(Image.open(file_path))
-        except Exception:
-            return "Error en OCR"
-    elif mime == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
-        try:
-            doc = DocxDocument(file_path)
-            return '\n'.join(paragraph.text for paragraph in doc.paragraphs)
-        except Exception:
-            return "Error al analizar Word"
-    elif mime == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet':
-        try:
-            workbook = openpyxl.load_workbook(file_path)
-            sheet = workbook.active
-            return '\n'.join(', '.join(str(cell) for cell in row) for row in sheet.iter_rows(values_only=True))
-        except Exception:
-            return "Error al analizar Excel"
-    return "Tipo de archivo no soportado"
-
 def extract_urls(text):
     url_pattern = re.compile(r'https?://\S+')
     return [{'action': 'visit', 'description': 'Link encontrado', 'url': url} for url in url_pattern.findall(text)]
 
 def get_top_senders(mailbox_id):
-    pipeline = [
-        {'$match': {'mailbox_id': mailbox_id}},
-        {'$group': {'_id': '$from', 'count': {'$sum': 1}}},
-        {'$sort': {'count': -1}},
-        {'$limit': 10}
-    ]
-    top_senders = [doc['_id'] for doc in emails_collection.aggregate(pipeline)]
-    return top_senders
+    """Direcciones de los 10 remitentes más frecuentes del buzón (colección sender_stats)."""
+    return top_senders(sender_stats_collection, mailbox_id)
 
 def get_email_body(payload):
     body = ''
@@ -966,148 +831,587 @@ def get_email_body(payload):
     
     return body.strip() if body.strip() else ''
 
-def process_and_insert_email(msg, service, user_id, mailbox_id, dry_run=False, force_update_elastic=False):
-    try:
-        headers = {header['name']: header['value'] for header in msg['payload']['headers']}
-        subject = headers.get('Subject', 'No Subject')
-        from_ = headers.get('From', 'Unknown')
-        to = headers.get('To', 'Unknown')
-        raw_date = headers.get('Date', 'Unknown')
-        message_id = headers.get('Message-ID', hashlib.sha256(f"{subject}{from_}{to}{raw_date}".encode('utf-8')).hexdigest())
-        gmail_message_id = msg['id']
-        in_reply_to = headers.get('In-Reply-To')
-        references = headers.get('References')
-        thread_id = msg.get('threadId', None)
-        index = hashlib.sha256(message_id.encode('utf-8')).hexdigest()
-        
-        existing_email = emails_collection.find_one({'$or': [{'message_id': message_id}, {'index': index}]})
-        parsed_date = parse_email_date(raw_date)
-        date = parsed_date.isoformat() if parsed_date else 'unknown'
-        
-        body = get_email_body(msg['payload'])
-        headers_text = '\n'.join(f"{h['name']}: {h['value']}" for h in msg['payload']['headers'])
-
-        attachments = []
-        attachments_content = []
-        if 'parts' in msg['payload']:
-            for part in msg['payload']['parts']:
-                if part.get('filename') and part.get('body', {}).get('attachmentId'):
-                    attachments.append(part['filename'])
-                    attachment_path = download_attachment(service, user_id, msg['id'], part)
-                    attachments_content.append(analyze_attachment(attachment_path))
-
-        email_dict = {
-            'subject': subject,
-            'from': from_,
-            'to': to,
-            'body': body,
-            'attachments': attachments,
-            'attachments_content': attachments_content,
-            'headers': headers
-        }
-        
-        summary, relevant_terms = process_email_with_mistral(email_dict, message_id)
-        semantic_domain, domain_confidence = infer_semantic_domain(subject, body, attachments_content, message_id)
-        top_senders = get_top_senders(mailbox_id)
-        classifications = classify_email(email_dict, message_id, top_senders)
-        responded = check_responded_status(service, user_id, msg, message_id, mailbox_id)
-
-        relevant_terms_array = list(relevant_terms.keys())
-        embedding = generate_embedding(subject, body, summary)
-        urls = extract_urls(f"{headers_text}\n{subject}\n{from_}\n{to}\n{body}\n{' '.join(attachments_content)}")
-        
-        # Reconstrucción avanzada de hilos
-        parent_thread_id = thread_id if thread_id else in_reply_to or message_id
-        if not parent_thread_id or parent_thread_id == message_id:
-            thread_by_subject = find_thread_by_subject(subject, mailbox_id)
-            if thread_by_subject:
-                parent_thread_id = thread_by_subject
-            else:
-                similar_thread = find_similar_thread(embedding, from_, to, mailbox_id)
-                if similar_thread:
-                    parent_thread_id = similar_thread
-
-        email_document = {
-            'from': from_,
-            'to': to,
-            'subject': subject,
-            'date': date,
-            'body': body,
-            'headers_text': headers_text,
-            'attachments': attachments,
-            'attachments_content': attachments_content,
-            'message_id': message_id,
-            'gmail_message_id': gmail_message_id,
-            'in_reply_to': in_reply_to,
-            'references': references,
-            'parent_thread_id': parent_thread_id,
-            'urls': urls,
-            'summary': summary,
-            'relevant_terms': relevant_terms,
-            'relevant_terms_array': relevant_terms_array,
-            'embedding': embedding,
-            'semantic_domain': semantic_domain,
-            'domain_confidence': domain_confidence,
-            'index': index,
-            'requires_response': bool(classifications.get('requires_response', False)),
-            'urgent': bool(classifications.get('urgent', False)),
-            'important': bool(classifications.get('important', False)),
-            'advertisement': bool(classifications.get('advertisement', False)),
-            'responded': bool(responded),
-            'mailbox_id': mailbox_id
-        }
-        
-        if dry_run:
-            action = "update" if existing_email else "insert"
-            logging.info(f"[DRY RUN] Would {action} email - message_id: {message_id}, index: {index}, date: {date}, subject: {subject}, mailbox_id: {mailbox_id}")
+def gmail_message_id_from_headers(headers):
+    """Message-ID del correo o, si falta, un hash estable de sus cabeceras principales."""
+    subject = headers.get('Subject', 'No Subject')
+    from_ = headers.get('From', 'Unknown')
+    to = headers.get('To', 'Unknown')
+    raw_date = headers.get('Date', 'Unknown')
+    return headers.get('Message-ID', hashlib.sha256(f"{subject}{from_}{to}{raw_date}".encode('utf-8')).hexdigest())
+
+def filter_new_gmail_messages(get_service, gmail_ids, mailbox_id):
+    """Sincronización por metadatos: descarta los mensajes que ya están en MongoDB.
+
+    Solo se piden las cabeceras necesarias para calcular el message_id, de modo que el
+    formato `full` (cuerpo y adjuntos) se descarga únicamente para los correos nuevos.
+    """
+    new_ids = []
+    for start in range(0, len(gmail_ids), 500):
+        chunk = gmail_ids[start:start + 500]
+        metadata = call_with_reauth(get_service, lambda service: batch_get_messages(
+            service, chunk, format='metadata', metadata_headers=GMAIL_METADATA_HEADERS, batch_size=GMAIL_BATCH_SIZE
+        ))
+        keys = {}
+        for gmail_id, msg in metadata.items():
+            headers = {header['name']: header['value'] for header in msg.get('payload', {}).get('headers', [])}
+            message_id = gmail_message_id_from_headers(headers)
+            keys[gmail_id] = (message_id, hashlib.sha256(message_id.encode('utf-8')).hexdigest())
+        existing = set()
+        for doc in emails_collection.find(
+            {'$or': [
+                {'message_id': {'$in': [message_id for message_id, _ in keys.values()]}},
+                {'index': {'$in': [index for _, index in keys.values()]}}
+            ]},
+            {'message_id': 1, 'index': 1, '_id': 0}
+        ):
+            existing.add(doc.get('message_id'))
+            existing.add(doc.get('index'))
+        new_ids.extend(
+            gmail_id for gmail_id in chunk
+            if gmail_id in keys and keys[gmail_id][0] not in existing and keys[gmail_id][1] not in existing
+        )
+    logging.info(f"Sincronización por metadatos en {mailbox_id}: {len(new_ids)} de {len(gmail_ids)} mensajes son nuevos")
+    return new_ids
+
+def parse_gmail_message(msg, mailbox_id):
+    """Extrae los campos básicos de un mensaje devuelto por la API de Gmail."""
+    headers = {header['name']: header['value'] for header in msg['payload']['headers']}
+    subject = headers.get('Subject', 'No Subject')
+    from_ = headers.get('From', 'Unknown')
+    to = headers.get('To', 'Unknown')
+    raw_date = headers.get('Date', 'Unknown')
+    message_id = gmail_message_id_from_headers(headers)
+    parsed_date = parse_email_date(raw_date)
+    body = get_email_body(msg['payload'])
+
+    attachment_parts = []
+    if 'parts' in msg['payload']:
+        for part in msg['payload']['parts']:
+            if part.get('filename') and part.get('body', {}).get('attachmentId'):
+                attachment_parts.append(part)
+
+    return {
+        'source': 'gmail',
+        'mailbox_id': mailbox_id,
+        'message_id': message_id,
+        'index': hashlib.sha256(message_id.encode('utf-8')).hexdigest(),
+        'gmail_message_id': msg['id'],
+        'thread_id': msg.get('threadId', None),
+        'subject': subject,
+        'from': from_,
+        'to': to,
+        'date': parsed_date.isoformat() if parsed_date else 'unknown',
+        'in_reply_to': headers.get('In-Reply-To'),
+        'references': headers.get('References'),
+        'headers': headers,
+        'headers_text': '\n'.join(f"{h['name']}: {h['value']}" for h in msg['payload']['headers']),
+        'body': body,
+        'attachment_parts': attachment_parts,
+        'attachments': [],
+        'attachment_refs': [],
+        'attachments_content': [],
+        'responded': False,
+        **body_fingerprint(body, NEAR_DUPLICATE_MIN_SHINGLES)
+    }
+
+def extract_record_attachments(record, service=None, user_id='me'):
+    """Obtiene en memoria los adjuntos del correo (Gmail o IMAP) y extrae su texto.
+
+    Solo se analizan en el pool de procesos los adjuntos cuyo SHA-256 no está todavía en
+    la colección `attachments`; el resto reutiliza el texto guardado. Si la política del
+    correo no incluye OCR, las imágenes nuevas no se analizan.
+    """
+    ocr = record.get('enrichments', POLICIES[POLICY_FULL])['ocr']
+    attachments = []
+    for part in record.get('attachment_parts', []):
+        if record['source'] == 'gmail':
+            attachments.append((part['filename'], download_attachment(service, user_id, record['gmail_message_id'], part)))
         else:
-            if existing_email:
-                emails_collection.update_one(
-                    {'$or': [{'message_id': message_id}, {'index': index}]},
-                    {'$set': email_document}
-                )
-                logging.info(f"Updated email with message_id: {message_id} for mailbox {mailbox_id}")
-            else:
-                emails_collection.insert_one(email_document)
-                logging.info(f"Inserted email with message_id: {message_id} for mailbox {mailbox_id}")
+            attachments.append((part.get_filename() or 'unnamed_attachment', part.get_payload(decode=True)))
+    record['attachments'] = [filename for filename, _ in attachments]
+    record['attachment_refs'], record['attachments_content'] = [], []
+    if attachments:
+        record['attachment_refs'], record['attachments_content'] = extract_with_cache(attachments_collection, attachment_extractor, attachments, skip=None if ocr else is_image)
+    record.pop('attachment_parts', None)
+    return record
+
+def get_sender_history(mailbox_id):
+    """Correos previos y correos de publicidad por dirección de remitente en el buzón."""
+    return sender_history(sender_stats_collection, mailbox_id)
+
+def advertisement_probability(text):
+    bayesian_model = load_bayesian_model(bayesian_model_file)
+    if not bayesian_model:
+        return None
+    return bayesian_model['classifier'].predict_proba(bayesian_model['vectorizer'].transform([text]))[0][1]
+
+def build_policy_engine(mailbox_id):
+    """Motor de políticas de una ejecución, con su propio presupuesto de LLM y OCR."""
+    budget = EnrichmentBudget(ENRICHMENT_BUDGET_LLM_SECONDS, ENRICHMENT_BUDGET_OCR_PAGES)
+    if not ENRICHMENT_POLICY_ENABLED:
+        # Sin política todos los correos reciben el tratamiento completo; el presupuesto se mantiene
+        return EnrichmentPolicyEngine(mailbox_id, budget=budget, minimal_below=float('-inf'), reduced_below=float('-inf'))
+    return EnrichmentPolicyEngine(
+        mailbox_id, get_sender_history(mailbox_id), advertisement_probability, qualified_senders, budget,
+        ENRICHMENT_POLICY_MINIMAL_BELOW, ENRICHMENT_POLICY_REDUCED_BELOW, ENRICHMENT_POLICY_LARGE_BODY_CHARS
+    )
 
-            # Sincronizar con Elasticsearch, incluyendo mailbox_id
-            es_doc = {
-                'message_id': message_id,
-                'mailbox_id': mailbox_id,
-                'body': body,
-                'summary': summary,
-                'relevant_terms_array': relevant_terms_array,
-                'subject': subject,
-                'from': from_,
-                'to': to,
-                'date': date,
-                'semantic_domain': semantic_domain,
-                'embedding': np.frombuffer(zlib.decompress(embedding), dtype=np.float32).tolist() if embedding else []
+def attachment_filename(record, part):
+    return part.get('filename') if record['source'] == 'gmail' else part.get_filename()
+
+def apply_enrichment_policy(record, policy_engine):
+    """Etapa de política: decide los enriquecimientos del correo antes de descargar adjuntos.
+
+    Los correos con política minimal no pasan por el LLM ni por la cola de enriquecimiento:
+    se guardan como skipped, sin resumen, dominio ni clasificaciones inventadas, y solo se
+    marcan como publicidad si hay señales reales (advertisement_signal).
+    """
+    image_count = sum(1 for part in record.get('attachment_parts', []) if is_image(attachment_filename(record, part)))
+    policy, enrichments, score, reasons = policy_engine.decide(record, image_count)
+    record['enrichment_policy'] = policy
+    record['enrichments'] = enrichments
+    if not enrichments['llm']:
+        record['advertisement'] = advertisement_signal(record['headers'], reasons)
+    logging.debug(f"Política {policy} (puntuación {score}: {', '.join(reasons) or 'sin señales'}) para message_id {record['message_id']}")
+    return record
+
+def build_email_dict(record):
+    return {
+        'subject': record['subject'],
+        'from': record['from'],
+        'to': record['to'],
+        'body': record['body'],
+        'attachments': record['attachments'],
+        'attachments_content': record['attachments_content'],
+        'headers': record['headers']
+    }
+
+def reuse_near_duplicate(record):
+    """Copia el enriquecimiento del correo ya enriquecido del buzón más parecido (SimHash), si lo hay."""
+    if not NEAR_DUPLICATE_ENABLED:
+        return False
+    if record.get('simhash') is None:
+        record_reuse('no_fingerprint')
+        return False
+    match = find_near_duplicate(emails_collection, record['mailbox_id'], record, NEAR_DUPLICATE_MAX_DISTANCE, exclude_message_id=record['message_id'])
+    if not match:
+        record_reuse('missed')
+        return False
+    record['summary'] = match['summary']
+    record['relevant_terms'] = match.get('relevant_terms') or {}
+    record['semantic_domain'] = match.get('semantic_domain', 'general')
+    record['domain_confidence'] = match.get('domain_confidence', 0.0)
+    record['classifications'] = {key: bool(match.get(key, False)) for key in CLASSIFICATION_KEYS}
+    record['enrichment_source'] = {'message_id': match['message_id'], 'distance': match['distance']}
+    record['classified_by'] = CLASSIFIED_BY_REUSED
+    record_reuse('reused')
+    logging.debug(f"Enriquecimiento de message_id {record['message_id']} copiado de {match['message_id']} (distancia {match['distance']})")
+    return True
+
+def enrich_record(record, policy_engine=None):
+    """Etapa LLM: resumen, términos relevantes, dominio semántico y clasificaciones.
+
+    Los correos que la política excluye del LLM pasan sin cambios y los casi
+    duplicados de un correo ya enriquecido copian su enriquecimiento; si se ha agotado el
+    presupuesto de LLM el correo sigue sin enriquecer y queda pendiente. Si el LLM falla
+    tampoco se asigna resumen y el correo se marca con enrichment_failed.
+    """
+    if 'summary' in record or not record.get('enrichments', POLICIES[POLICY_FULL])['llm']:
+        return record
+    if reuse_near_duplicate(record) or (policy_engine and not policy_engine.llm_allowed()):
+        return record
+    top_senders = get_top_senders(record['mailbox_id'])
+    local = classify_with_cascade(record['mailbox_id'], record.get('embedding'), record.get('subject'), record.get('body'))
+    start = time.monotonic()
+    enrichment = enrich_email_with_mistral(build_email_dict(record), record['message_id'], top_senders, local=local)
+    if policy_engine:
+        policy_engine.charge_llm(time.monotonic() - start)
+    if enrichment is None:
+        record['enrichment_failed'] = True
+        return record
+
+    summary, relevant_terms, semantic_domain, domain_confidence, classifications = enrichment
+    record['summary'] = summary
+    record['relevant_terms'] = relevant_terms
+    record['semantic_domain'] = semantic_domain
+    record['domain_confidence'] = domain_confidence
+    record['classifications'] = classifications
+    record['classified_by'] = CLASSIFIED_BY_LOCAL if local else CLASSIFIED_BY_LLM
+    return record
+
+def embed_records(records):
+    # Los correos aún sin enriquecer se vectorizan sin resumen y se recalculan al enriquecerlos
+    embeddings = generate_embeddings([embedding_text(record['subject'], record['body'], record.get('summary')) for record in records])
+    for record, embedding in zip(records, embeddings):
+        record['embedding'] = embedding
+        record['embedded_summary'] = 'summary' in record
+    return records
+
+def embed_summarized_records(records):
+    """Vuelve a vectorizar, ya con el resumen, los correos que lo han obtenido en la etapa LLM."""
+    stale = [record for record in records if 'summary' in record and not record.get('embedded_summary')]
+    if stale:
+        embed_records(stale)
+    return records
+
+def enrichment_fields(record):
+    """Campos de MongoDB que produce el enriquecimiento con LLM de un correo."""
+    classifications = record['classifications']
+    fields = {
+        'summary': record['summary'],
+        'relevant_terms': record['relevant_terms'],
+        'relevant_terms_array': list(record['relevant_terms'].keys()),
+        'semantic_domain': record['semantic_domain'],
+        'domain_confidence': record['domain_confidence'],
+        'requires_response': bool(classifications.get('requires_response', False)),
+        'urgent': bool(classifications.get('urgent', False)),
+        'important': bool(classifications.get('important', False)),
+        'advertisement': bool(classifications.get('advertisement', False)),
+        'classified_by': record['classified_by']
+    }
+    if 'enrichment_source' in record:
+        # Correo cuyo enriquecimiento se copió de un casi duplicado
+        fields['enrichment_source'] = record['enrichment_source']
+    return fields
+
+def persist_record(record, writer=None, dry_run=False, thread_index=None):
+    """Reconstruye el hilo y entrega el correo al escritor en bloque de MongoDB y Elasticsearch.
+
+    Si el correo no pasó por la etapa LLM (enriquecimiento diferido) se guarda sin los
+    campos enriquecidos y, si es nuevo, con enrichment_status 'pending'. thread_index
+    (RunThreadIndex) da los hilos por asunto de los correos de la misma ejecución, que
+    el escritor en bloque aún no ha guardado.
+    """
+    mailbox_id = record['mailbox_id']
+    message_id = record['message_id']
+    index = record['index']
+    subject = record['subject']
+    from_ = record['from']
+    to = record['to']
+    body = record['body']
+    date = record['date']
+    in_reply_to = record['in_reply_to']
+    embedding = record['embedding']
+    urls = extract_urls(f"{record['headers_text']}\n{subject}\n{from_}\n{to}\n{body}\n{' '.join(record['attachments_content'])}")
+
+    # Reconstrucción avanzada de hilos
+    normalized_subject = normalize_subject(subject)
+    parent_thread_id = record['thread_id'] or in_reply_to or message_id
+    if not parent_thread_id or parent_thread_id == message_id:
+        thread_by_subject = (thread_index and thread_index.find(mailbox_id, normalized_subject)) or find_thread_by_subject(subject, mailbox_id)
+        if thread_by_subject:
+            parent_thread_id = thread_by_subject
+        else:
+            similar_thread = find_similar_thread(embedding, from_, to, mailbox_id, message_id=message_id)
+            if similar_thread:
+                parent_thread_id = similar_thread
+    if thread_index:
+        thread_index.add(mailbox_id, normalized_subject, parent_thread_id)
+
+    email_document = {
+        'from': from_,
+        'to': to,
+        'subject': subject,
+        'normalized_subject': normalized_subject,
+        'date': date,
+        'date_ts': email_date_ts(date),
+        **address_fields(from_, to, header_value(record['headers'], 'Cc'), mailbox_id),
+        'body': body,
+        'headers_text': record['headers_text'],
+        'attachments': record['attachments'],
+        'attachment_refs': record['attachment_refs'],
+        'message_id': message_id,
+        'in_reply_to': in_reply_to,
+        'references': record['references'],
+        'parent_thread_id': parent_thread_id,
+        'urls': urls,
+        'embedding': embedding,
+        'index': index,
+        'mailbox_id': mailbox_id
+    }
+    if record['source'] == 'gmail':
+        email_document['gmail_message_id'] = record['gmail_message_id']
+    if record.get('simhash') is not None:
+        email_document['simhash'] = record['simhash']
+        email_document['simhash_bands'] = record['simhash_bands']
+    enriched = 'summary' in record
+    # Sin enriquecimiento nuevo, el estado de la cola solo se escribe al insertar: un correo
+    # ya existente conserva su enriquecimiento (o su sitio en la cola) al volver a guardarse
+    # `responded` lo mantiene update_responded_status; al volver a guardar un correo no se toca
+    insert_only, unset_fields = {'responded': bool(record['responded'])}, None
+    if enriched:
+        email_document.update(enrichment_fields(record))
+        email_document['enrichment_status'] = STATUS_DONE
+        if 'enrichment_policy' in record:
+            email_document['enrichment_policy'] = record['enrichment_policy']
+    elif not record.get('enrichments', POLICIES[POLICY_FULL])['llm']:
+        insert_only['enrichment_status'] = STATUS_SKIPPED
+        insert_only['enrichment_policy'] = record['enrichment_policy']
+        insert_only['advertisement'] = record['advertisement']
+        insert_only['classified_by'] = CLASSIFIED_BY_POLICY
+        unset_fields = ('attachments_content',)
+    else:
+        insert_only['enrichment_status'] = STATUS_PENDING
+        insert_only['enrichment_headers'] = {name: record['headers'][name] for name in ('X-Priority', 'Importance') if name in record['headers']}
+        if 'enrichment_policy' in record:
+            insert_only['enrichment_policy'] = record['enrichment_policy']
+        unset_fields = ('attachments_content',)
+
+    if dry_run:
+        logging.info(f"[DRY RUN] Would upsert email - message_id: {message_id}, index: {index}, date: {date}, subject: {subject}, mailbox_id: {mailbox_id}")
+        return record
+
+    # Documento para Elasticsearch, incluyendo mailbox_id; el escritor asigna el es_doc_id
+    es_doc = {
+        'message_id': message_id,
+        'mailbox_id': mailbox_id,
+        'body': body,
+        'subject': subject,
+        'from': from_,
+        'to': to,
+        'date': date,
+        'attachments_content': attachment_search_text(record),
+        'simhash': record.get('simhash'),
+        'embedding': np.frombuffer(zlib.decompress(embedding), dtype=np.float32).tolist() if embedding else []
+    }
+    if enriched:
+        es_doc.update({
+            'summary': email_document['summary'],
+            'relevant_terms_array': email_document['relevant_terms_array'],
+            'semantic_domain': email_document['semantic_domain']
+        })
+    writer.add(email_document, es_doc, insert_only=insert_only, unset_fields=unset_fields)
+    get_mailbox_index(emails_collection, mailbox_id).add(message_id, embedding, from_, to, parent_thread_id)
+    return record
+
+def build_ingestion_pipeline(mailbox_id, fetch_stage, attachment_stage, writer=None, dry_run=False, batched_fetch=False, fetch_workers=None, defer_enrichment=DEFER_ENRICHMENT, policy_engine=None, thread_index=None):
+    """Pipeline por etapas: descarga, política, adjuntos, embeddings, LLM y persistencia.
+
+    Con batched_fetch=True la etapa de descarga recibe lotes de identificadores y
+    devuelve la lista de correos de cada lote. Con defer_enrichment=True se omite la
+    etapa LLM y los correos quedan en la cola de enriquecimiento (enrich_pending_emails).
+    Los embeddings se calculan antes de la etapa LLM para que los clasificadores locales
+    (classify_with_cascade) puedan resolver dominio y clasificaciones; los correos que
+    obtienen resumen en esa etapa se vuelven a vectorizar con él, como en la cola.
+    """
+    stages = [PipelineStage('fetch', fetch_stage, fetch_workers or INGESTION_FETCH_WORKERS, INGESTION_QUEUE_SIZE, fan_out=batched_fetch)]
+    if policy_engine:
+        stages.append(PipelineStage('policy', lambda record: apply_enrichment_policy(record, policy_engine), 1, INGESTION_QUEUE_SIZE))
+    stages += [
+        PipelineStage('attachments', attachment_stage, INGESTION_ATTACHMENT_WORKERS, INGESTION_QUEUE_SIZE),
+        PipelineStage('embedding', embed_records, INGESTION_EMBEDDING_WORKERS, INGESTION_QUEUE_SIZE, batch_size=EMBEDDING_BATCH_SIZE, batch_timeout=EMBEDDING_BATCH_TIMEOUT)
+    ]
+    if not defer_enrichment:
+        stages += [
+            PipelineStage('llm_enrichment', lambda record: enrich_record(record, policy_engine), INGESTION_LLM_WORKERS, INGESTION_QUEUE_SIZE),
+            PipelineStage('summary_embedding', embed_summarized_records, INGESTION_EMBEDDING_WORKERS, INGESTION_QUEUE_SIZE, batch_size=EMBEDDING_BATCH_SIZE, batch_timeout=EMBEDDING_BATCH_TIMEOUT)
+        ]
+    stages.append(PipelineStage('persistence', lambda record: persist_record(record, writer=writer, dry_run=dry_run, thread_index=thread_index), INGESTION_PERSIST_WORKERS, INGESTION_QUEUE_SIZE))
+    return IngestionPipeline(stages, name=f"ingestion:{mailbox_id}", report_interval=INGESTION_REPORT_INTERVAL)
+
+def enrich_queued_email(doc, policy_engine=None):
+    """Etapa LLM de la cola: enriquece un correo ya guardado."""
+    doc.setdefault('attachments', [])
+    doc.setdefault('attachments_content', [])
+    doc['headers'] = doc.get('enrichment_headers', {})
+    return enrich_record(doc, policy_engine)
+
+def save_enriched_emails(records):
+    """Etapa de persistencia de la cola: guarda el enriquecimiento en bloque y actualiza el índice vectorial.
+
+    Los correos que no se enriquecieron vuelven a la cola: sin gastar un intento si se
+    agotó el presupuesto de LLM y gastándolo si falló el LLM, de modo que tras
+    ENRICHMENT_MAX_ATTEMPTS fallos quedan como failed.
+    """
+    pending = [record for record in records if 'summary' not in record]
+    release_claims(emails_collection, [record['_id'] for record in pending if not record.get('enrichment_failed')])
+    fail_claims(emails_collection, [record['_id'] for record in pending if record.get('enrichment_failed')], ENRICHMENT_MAX_ATTEMPTS)
+    records = [record for record in records if 'summary' in record]
+    results = []
+    for record in records:
+        updates = {**enrichment_fields(record), 'embedding': record['embedding']}
+        results.append({
+            '_id': record['_id'],
+            'es_doc_id': record.get('es_doc_id'),
+            'updates': updates,
+            'es_updates': {
+                'summary': updates['summary'],
+                'relevant_terms_array': updates['relevant_terms_array'],
+                'semantic_domain': updates['semantic_domain'],
+                'embedding': np.frombuffer(zlib.decompress(record['embedding']), dtype=np.float32).tolist() if record['embedding'] else []
             }
-            if force_update_elastic or not existing_email:
-                res = es.index(index='email_index', body=es_doc)
-                es_doc_id = res['_id']
-                emails_collection.update_one(
-                    {'message_id': message_id},
-                    {'$set': {'es_doc_id': es_doc_id}}
-                )
-            else:
-                if 'es_doc_id' in existing_email:
-                    es.update(index='email_index', id=existing_email['es_doc_id'], body={'doc': es_doc}, ignore=[404])
-                else:
-                    res = es.index(index='email_index', body=es_doc)
-                    es_doc_id = res['_id']
-                    emails_collection.update_one(
-                        {'message_id': message_id},
-                        {'$set': {'es_doc_id': es_doc_id}}
-                    )
+        })
+    complete_enrichments(emails_collection, es, results)
+    # Al insertarlos aún no tenían clasificación de publicidad
+    for mailbox_id in {record['mailbox_id'] for record in records}:
+        record_sender_counter(sender_stats_collection, mailbox_id, [record['from'] for record in records if record['mailbox_id'] == mailbox_id and record['classifications'].get('advertisement')], 'ads')
+    for record in records:
+        get_mailbox_index(emails_collection, record['mailbox_id']).add(record['message_id'], record['embedding'], record['from'], record['to'], record.get('parent_thread_id'))
+    return records
+
+def enrich_pending_emails(mailbox_id=None, max_emails=None):
+    """Vacía la cola de enriquecimiento del buzón (o de todos) con el mismo pipeline por etapas.
+
+    Los correos se reclaman por lotes, de modo que varios procesos pueden trabajar sobre
+    la misma cola. Un correo cuyo worker muere vuelve a la cola pasado
+    ENRICHMENT_CLAIM_TIMEOUT y, tras ENRICHMENT_MAX_ATTEMPTS intentos, queda como failed.
+    """
+    mark_exhausted(emails_collection, ENRICHMENT_MAX_ATTEMPTS, ENRICHMENT_CLAIM_TIMEOUT)
+    policy_engine = EnrichmentPolicyEngine(mailbox_id, budget=EnrichmentBudget(ENRICHMENT_BUDGET_LLM_SECONDS))
+    claimed = 0
+
+    def claimed_batches():
+        nonlocal claimed
+        while (max_emails is None or claimed < max_emails) and not policy_engine.budget.exhausted('llm_seconds'):
+            limit = ENRICHMENT_CLAIM_SIZE if max_emails is None else min(ENRICHMENT_CLAIM_SIZE, max_emails - claimed)
+            # Sin los campos de un enriquecimiento anterior: su presencia marca el correo como enriquecido
+            batch = claim_pending(emails_collection, mailbox_id, limit, ENRICHMENT_CLAIM_TIMEOUT, ENRICHMENT_MAX_ATTEMPTS, projection=dict.fromkeys(('summary', 'relevant_terms', 'relevant_terms_array', 'semantic_domain', 'domain_confidence'), 0))
+            if not batch:
+                return
+            claimed += len(batch)
+            yield batch
+
+    pipeline = IngestionPipeline([
+        PipelineStage('attachments', lambda batch: load_attachment_texts(attachments_collection, batch), 1, INGESTION_QUEUE_SIZE, fan_out=True),
+        PipelineStage('llm_enrichment', lambda doc: enrich_queued_email(doc, policy_engine), INGESTION_LLM_WORKERS, INGESTION_QUEUE_SIZE),
+        PipelineStage('embedding', embed_records, INGESTION_EMBEDDING_WORKERS, INGESTION_QUEUE_SIZE, batch_size=EMBEDDING_BATCH_SIZE, batch_timeout=EMBEDDING_BATCH_TIMEOUT),
+        PipelineStage('persistence', save_enriched_emails, INGESTION_PERSIST_WORKERS, INGESTION_QUEUE_SIZE, batch_size=PERSIST_BULK_SIZE, batch_timeout=PERSIST_FLUSH_INTERVAL)
+    ], name=f"enrichment:{mailbox_id or 'all'}", report_interval=INGESTION_REPORT_INTERVAL)
+    cascade_before, reuse_before = cascade_stats(), reuse_stats()
+    stats = pipeline.run(claimed_batches())
+    log_pipeline_stats(stats, mailbox_id or 'all', 'enriquecimiento')
+    log_cascade_stats(cascade_before, mailbox_id or 'all', 'enriquecimiento')
+    log_reuse_stats(reuse_before, mailbox_id or 'all', 'enriquecimiento')
+    log_policy_stats(policy_engine, mailbox_id or 'all', 'enriquecimiento')
+    logging.info(f"Cola de enriquecimiento de {mailbox_id or 'todos los buzones'}: {claimed} correos reclamados, pendientes {enrichment_backlog(emails_collection, mailbox_id)}")
+    return stats
+
+def run_ingestion_pipeline(items, mailbox_id, source, fetch_stage, attachment_stage, dry_run=False, batched_fetch=False, fetch_workers=None):
+    """Ejecuta el pipeline de ingestión y vacía el escritor en bloque al terminar.
+
+    Al final se recalcula en bloque el estado de respuesta a partir de los correos
+    enviados guardados en esta ejecución. Devuelve las métricas por etapa y el número
+    de fallos (errores de cualquier etapa y de la escritura en MongoDB/Elasticsearch),
+    que los llamantes usan para decidir si pueden avanzar su marca de sincronización.
+    """
+    outbound_message_ids = set()
+
+    def after_flush(documents):
+        update_threads(threads_collection, documents)
+        outbound_message_ids.update(document['message_id'] for document in documents if document['direction'] == DIRECTION_OUTBOUND)
+
+    writer = None if dry_run else EmailBulkWriter(
+        emails_collection, es, 'email_index', PERSIST_BULK_SIZE, PERSIST_FLUSH_INTERVAL,
+        after_flush=after_flush,
+        unset_fields=('attachments_content', 'enrichment_headers', 'enrichment_attempts', 'enrichment_source'),
+        on_insert=lambda documents: record_new_emails(sender_stats_collection, documents)
+    )
+    policy_engine = build_policy_engine(mailbox_id)
+    pipeline = build_ingestion_pipeline(mailbox_id, fetch_stage, attachment_stage, writer=writer, dry_run=dry_run, batched_fetch=batched_fetch, fetch_workers=fetch_workers, policy_engine=policy_engine, thread_index=RunThreadIndex())
+    cascade_before, reuse_before = cascade_stats(), reuse_stats()
+    try:
+        stats = pipeline.run(items)
+    finally:
+        writer_stats = writer.close() if writer else None
+    if writer:
+        refresh_responded_status(mailbox_id, outbound_message_ids)
+    log_pipeline_stats(stats, mailbox_id, source)
+    log_cascade_stats(cascade_before, mailbox_id, source)
+    log_reuse_stats(reuse_before, mailbox_id, source)
+    log_policy_stats(policy_engine, mailbox_id, source)
+    if writer_stats:
+        logging.info(
+            f"Persistencia {source} {mailbox_id}: {writer_stats['mongo_upserted']} insertados, {writer_stats['mongo_modified']} actualizados, "
+            f"{writer_stats['mongo_errors']} errores en MongoDB, {writer_stats['es_indexed']} indexados y {writer_stats['es_errors']} errores en Elasticsearch "
+            f"({writer_stats['flushes']} escrituras en bloque)"
+        )
+    cache_stats = llm_cache_stats()
+    logging.info(
+        f"Caché LLM tras {source} {mailbox_id}: {cache_stats['hits']} aciertos, {cache_stats['misses']} fallos "
+        f"({cache_stats['hit_rate']:.1%}), {cache_stats['evictions']} expulsiones"
+    )
+    enrichment = structured_output_stats().get('email_enrichment')
+    if enrichment:
+        logging.info(
+            f"Salida estructurada tras {source} {mailbox_id}: {enrichment['attempts']} intentos, {enrichment['parse_failures']} fallos de parseo, "
+            f"{enrichment['schema_failures']} fuera de esquema, {enrichment['exhausted']} correos con heurísticas"
+        )
+    lane = ollama_metrics()['lanes']['backfill']
+    logging.info(
+        f"Ollama tras {source} {mailbox_id}: {lane['requests']} peticiones, {lane['errors']} errores, {lane['rejected']} rechazadas, "
+        f"espera media en cola {lane['avg_queue_wait_seconds']} s, latencia media {lane['avg_latency_seconds']} s"
+    )
+    failures = sum(stage['errors'] for stage in stats)
+    if writer_stats:
+        failures += writer_stats['mongo_errors'] + writer_stats['es_errors']
+    return stats, failures
+
+def log_policy_stats(policy_engine, mailbox_id, source):
+    policy_stats = policy_engine.stats()
+    counters, budget = policy_stats['counters'], policy_stats['budget']
+    logging.info(
+        f"Política de enriquecimiento en {source} {mailbox_id}: {counters['full']} completos, {counters['reduced']} reducidos, {counters['minimal']} mínimos; "
+        f"omitidos {counters['skipped_llm']} LLM, {counters['skipped_ocr']} OCR; "
+        f"presupuesto LLM {budget['llm_seconds']['spent']}/{budget['llm_seconds']['limit'] or '∞'} s "
+        f"({counters['budget_llm']} aplazados), OCR {budget['ocr_pages']['spent']}/{budget['ocr_pages']['limit'] or '∞'} páginas ({counters['budget_ocr']} sin OCR)"
+    )
+
+def log_cascade_stats(before, mailbox_id, source):
+    """Proporción de correos de la ejecución cuyo dominio y clasificaciones se resolvieron sin el LLM."""
+    after = cascade_stats()
+    local = after['local'] - before['local']
+    total = local + after['llm'] - before['llm']
+    if total:
+        logging.info(f"Clasificadores locales en {source} {mailbox_id}: {local} de {total} correos resueltos sin el LLM ({local / total:.1%})")
+
+def refresh_responded_status(mailbox_id, outbound_message_ids=None):
+    """Marca los correos respondidos y suma las respuestas a las estadísticas de sus remitentes."""
+    responded_at = update_responded_status(emails_collection, mailbox_id, outbound_message_ids=outbound_message_ids)
+    if responded_at:
+        replied = record_replies(emails_collection, sender_stats_collection, mailbox_id, responded_at)
+        logging.info(f"{replied} correos de {mailbox_id} marcados como respondidos")
+
+def log_reuse_stats(before, mailbox_id, source):
+    """Correos de la ejecución que copiaron el enriquecimiento de un casi duplicado en vez de llamar al LLM."""
+    after = reuse_stats()
+    delta = {name: after[name] - before[name] for name in after}
+    total = sum(delta.values())
+    if total:
+        logging.info(
+            f"Casi duplicados en {source} {mailbox_id}: {delta['reused']} de {total} correos reutilizaron un enriquecimiento "
+            f"({delta['reused'] / total:.1%}), {delta['no_fingerprint']} sin huella"
+        )
+
+def log_pipeline_stats(stats, mailbox_id, source):
+    for stage_stats in stats:
+        logging.info(
+            f"Pipeline {source} {mailbox_id} - etapa {stage_stats['stage']}: {stage_stats['processed']} procesados, "
+            f"{stage_stats['dropped']} descartados, {stage_stats['errors']} errores, "
+            f"{stage_stats['throughput_per_second']} correos/s con {stage_stats['workers']} hilos "
+            f"(latencia media {stage_stats['avg_latency_seconds']} s)"
+        )
+
+def thread_local_gmail_service(username, mailbox_id):
+    """Devuelve una función que entrega un cliente de Gmail propio de cada hilo (los clientes no son thread-safe)."""
+    local = threading.local()
+    def get_service(refresh=False):
+        if refresh or getattr(local, 'service', None) is None:
+            creds = get_credentials_from_db(username, mailbox_id)
+            if not creds:
+                raise RuntimeError(f"No se pudieron obtener credenciales válidas para {mailbox_id}")
+            local.service = build_service(creds)
+        return local.service
+    return get_service
+
+def call_with_reauth(get_service, func):
+    """Ejecuta func(service) y, ante un 401, reconstruye el cliente del hilo y reintenta una vez."""
+    try:
+        return func(get_service())
     except HttpError as e:
-        if e.resp.status == 401:
+        if e.resp.status != 401 and 'invalid_grant' not in str(e):
             raise
-        logging.error(f"Error procesando mensaje {message_id} para mailbox {mailbox_id}: {e}")
-    except Exception as e:
-        logging.error(f"Error procesando mensaje {message_id} para mailbox {mailbox_id}: {e}")
+        logging.info("Error de autenticación (401 o invalid_grant) detectado, reconstruyendo servicio de Gmail...")
+        return func(get_service(refresh=True))
 
 def fix_empty_bodies(username, mailbox_id):
     creds = get_credentials_from_db(username, mailbox_id)
@@ -1224,47 +1528,137 @@ def connect_to_imap(creds):
         logging.error(f"Error al conectar a IMAP: {e}")
         return None
 
-def fetch_and_process_emails_imap(imap, folders, username, mailbox_id, desired_max_results=5000, dry_run=False, date_start=None, force_update_elastic=False):
+def thread_local_imap_connection(creds, folder):
+    """Devuelve una función que entrega una conexión IMAP propia de cada hilo con la carpeta seleccionada."""
+    local = threading.local()
+    connections = []
+    lock = threading.Lock()
+    def get_connection():
+        if getattr(local, 'imap', None) is None:
+            imap = connect_to_imap(creds)
+            if not imap:
+                raise RuntimeError(f"No se pudo abrir una conexión IMAP para la carpeta {folder}")
+            imap.select(folder, readonly=True)
+            local.imap = imap
+            with lock:
+                connections.append(imap)
+        return local.imap
+    def close_all():
+        with lock:
+            for imap in connections:
+                try:
+                    imap.logout()
+                except Exception:
+                    pass
+            connections.clear()
+    return get_connection, close_all
+
+def imap_message_id_from_headers(email_message):
+    """Message-ID del correo o, si falta, el mismo hash que usa parse_imap_message."""
+    subject = email_message['Subject'] or 'No Subject'
+    from_ = email_message['From'] or 'Unknown'
+    to = email_message['To'] or 'Unknown'
+    raw_date = email_message['Date'] or 'Unknown'
+    return email_message['Message-ID'] or hashlib.sha256(f"{subject}{from_}{to}{raw_date}".encode('utf-8')).hexdigest()
+
+def imap_fetch_headers(imap, uids, fields, chunk_size=500):
+    """Descarga solo las cabeceras indicadas de los UIDs dados, sin marcar los mensajes como leídos."""
+    headers_by_uid = {}
+    for start in range(0, len(uids), chunk_size):
+        chunk = uids[start:start + chunk_size]
+        status, data = imap.uid('FETCH', uid_ranges(chunk), f"(UID BODY.PEEK[HEADER.FIELDS ({' '.join(fields)})])")
+        if status != 'OK':
+            logging.warning(f"UID FETCH de cabeceras fallido para {len(chunk)} mensajes: {status}")
+            continue
+        for uid, header_bytes in parse_uid_fetch_response(data):
+            headers_by_uid[uid] = email.message_from_bytes(header_bytes)
+    return headers_by_uid
+
+def filter_new_imap_uids(imap, uids, mailbox_id):
+    """Descarga las cabeceras de los UIDs y descarta los mensajes que ya están en MongoDB."""
+    headers_by_uid = imap_fetch_headers(imap, uids, ['MESSAGE-ID', 'SUBJECT', 'FROM', 'TO', 'DATE'])
+    keys = {}
+    for uid, header_message in headers_by_uid.items():
+        message_id = imap_message_id_from_headers(header_message)
+        keys[uid] = (message_id, hashlib.sha256(message_id.encode('utf-8')).hexdigest())
+    existing = set()
+    for start in range(0, len(uids), 500):
+        chunk_keys = [keys[uid] for uid in uids[start:start + 500] if uid in keys]
+        for doc in emails_collection.find(
+            {'$or': [
+                {'message_id': {'$in': [message_id for message_id, _ in chunk_keys]}},
+                {'index': {'$in': [index for _, index in chunk_keys]}}
+            ]},
+            {'message_id': 1, 'index': 1, '_id': 0}
+        ):
+            existing.add(doc.get('message_id'))
+            existing.add(doc.get('index'))
+    return [uid for uid in uids if uid in keys and keys[uid][0] not in existing and keys[uid][1] not in existing]
+
+def fetch_and_process_emails_imap(imap, folders, username, mailbox_id, desired_max_results=5000, dry_run=False, date_start=None, force_update_elastic=False, incremental=False):
+    creds = get_credentials_from_db(username, mailbox_id)
+    folder_states = get_mailbox_sync_state(users_collection, username, mailbox_id).get('imap_folders', {})
     for folder in folders:
         try:
-            imap.select(folder)
-            if date_start:
-                since_date = date_start.strftime('%d-%b-%Y')
-                status, messages = imap.search(None, f'(SINCE "{since_date}")')
+            status, _ = imap.select(folder, readonly=True)
+            if status != 'OK':
+                logging.error(f"No se pudo seleccionar la carpeta {folder} para {mailbox_id}")
+                continue
+            uidvalidity = int(imap.response('UIDVALIDITY')[1][0])
+            state = folder_states.get(imap_folder_state_key(folder))
+
+            if incremental and state and state.get('uidvalidity') == uidvalidity:
+                last_uid = state.get('last_uid', 0)
+                status, messages = imap.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+                uids = uids_after(messages[0], last_uid)
+                logging.info(f"Sincronización incremental de {mailbox_id}/{folder} desde UID {last_uid}: {len(uids)} mensajes nuevos")
             else:
-                status, messages = imap.search(None, 'ALL')
-            message_ids = messages[0].split()
-            total_fetched = 0
-            for msg_id in message_ids:
-                if total_fetched >= desired_max_results:
-                    break
-                status, msg_data = imap.fetch(msg_id, '(RFC822)')
+                if incremental and state:
+                    logging.warning(f"UIDVALIDITY de {mailbox_id}/{folder} ha cambiado, se requiere sincronización completa")
+                last_uid = 0
+                if date_start:
+                    since_date = date_start.strftime('%d-%b-%Y')
+                    status, messages = imap.uid('SEARCH', None, f'(SINCE "{since_date}")')
+                else:
+                    status, messages = imap.uid('SEARCH', None, 'ALL')
+                uids = sorted(map(int, messages[0].split()))
+            uids = uids[:desired_max_results]
+            if not uids:
+                continue
+
+            new_uids = uids if force_update_elastic else filter_new_imap_uids(imap, uids, mailbox_id)
+            logging.info(f"{len(new_uids)} de {len(uids)} mensajes de {mailbox_id}/{folder} requieren descarga completa")
+            chunks = [new_uids[start:start + IMAP_FETCH_CHUNK_SIZE] for start in range(0, len(new_uids), IMAP_FETCH_CHUNK_SIZE)]
+            get_connection, close_all = thread_local_imap_connection(creds, folder)
+
+            def fetch_stage(chunk):
+                status, msg_data = get_connection().uid('FETCH', uid_ranges(chunk), '(UID BODY.PEEK[])')
                 if status != 'OK':
-                    continue
-                raw_email = msg_data[0][1]
-                email_message = email.message_from_bytes(raw_email)
-                process_and_insert_email_imap(email_message, username, mailbox_id, dry_run=dry_run, force_update_elastic=force_update_elastic)
-                total_fetched += 1
-            logging.info(f"Processed {total_fetched} emails from folder {folder} for {mailbox_id}")
+                    # Se lanza para que el pipeline lo cuente como error y no se avance la marca
+                    raise imaplib.IMAP4.error(f"UID FETCH fallido para {len(chunk)} mensajes de {folder}: {status}")
+                return [parse_imap_message(email.message_from_bytes(raw_email), mailbox_id) for _, raw_email in parse_uid_fetch_response(msg_data)]
+
+            try:
+                stats, failures = run_ingestion_pipeline(chunks, mailbox_id, f"IMAP/{folder}", fetch_stage, extract_record_attachments, dry_run=dry_run, batched_fetch=True, fetch_workers=IMAP_CONNECTIONS_PER_FOLDER)
+            finally:
+                close_all()
+            logging.info(f"Processed {stats[-1]['processed']} emails from folder {folder} for {mailbox_id}")
+            # Si hubo fallos, la próxima sincronización vuelve a buscar desde la marca anterior; los ya guardados los descarta filter_new_imap_uids
+            advance_imap_folder_state(users_collection, username, mailbox_id, folder, uidvalidity, last_uid, uids, failures, dry_run=dry_run)
         except Exception as e:
             logging.error(f"Error al procesar carpeta {folder} para {mailbox_id}: {e}")
 
-def process_and_insert_email_imap(email_message, username, mailbox_id, dry_run=False, force_update_elastic=False):
+def parse_imap_message(email_message, mailbox_id):
+    """Extrae los campos básicos de un mensaje IMAP ya parseado."""
     subject = email_message['Subject'] or 'No Subject'
     from_ = email_message['From'] or 'Unknown'
     to = email_message['To'] or 'Unknown'
     raw_date = email_message['Date'] or 'Unknown'
     message_id = email_message['Message-ID'] or hashlib.sha256(f"{subject}{from_}{to}{raw_date}".encode('utf-8')).hexdigest()
-    in_reply_to = email_message.get('In-Reply-To')
-    references = email_message.get('References')
-    index = hashlib.sha256(message_id.encode('utf-8')).hexdigest()
-    
     parsed_date = parse_email_date(raw_date)
-    date = parsed_date.isoformat() if parsed_date else 'unknown'
-    
+
     body = ''
-    attachments = []
-    attachments_content = []
+    attachment_parts = []
     if email_message.is_multipart():
         for part in email_message.walk():
             content_type = part.get_content_type()
@@ -1275,118 +1669,32 @@ def process_and_insert_email_imap(email_message, username, mailbox_id, dry_run=F
                 soup = BeautifulSoup(html_content, 'html.parser')
                 body = soup.get_text()
             elif part.get_filename():
-                attachments.append(part.get_filename())
-                attachment_path = save_attachment(part)
-                attachments_content.append(analyze_attachment(attachment_path))
+                attachment_parts.append(part)
     else:
         body = email_message.get_payload(decode=True).decode('utf-8', errors='ignore')
-    
-    email_dict = {
-        'subject': subject,
-        'from': from_,
-        'to': to,
-        'body': body,
-        'attachments': attachments,
-        'attachments_content': attachments_content,
-        'headers': dict(email_message.items())
-    }
-    
-    summary, relevant_terms = process_email_with_mistral(email_dict, message_id)
-    semantic_domain, domain_confidence = infer_semantic_domain(subject, body, attachments_content, message_id)
-    top_senders = get_top_senders(mailbox_id)
-    classifications = classify_email(email_dict, message_id, top_senders)
-    responded = False
-
-    relevant_terms_array = list(relevant_terms.keys())
-    embedding = generate_embedding(subject, body, summary)
-    headers_text = str(email_message.items())
-    urls = extract_urls(f"{headers_text}\n{subject}\n{from_}\n{to}\n{body}\n{' '.join(attachments_content)}")
-    
-    # Reconstrucción avanzada de hilos para IMAP
-    parent_thread_id = in_reply_to or message_id
-    if not in_reply_to:
-        thread_by_subject = find_thread_by_subject(subject, mailbox_id)
-        if thread_by_subject:
-            parent_thread_id = thread_by_subject
-        else:
-            similar_thread = find_similar_thread(embedding, from_, to, mailbox_id)
-            if similar_thread:
-                parent_thread_id = similar_thread
 
-    email_document = {
+    return {
+        'source': 'imap',
+        'mailbox_id': mailbox_id,
+        'message_id': message_id,
+        'index': hashlib.sha256(message_id.encode('utf-8')).hexdigest(),
+        'thread_id': None,
+        'subject': subject,
         'from': from_,
         'to': to,
-        'subject': subject,
-        'date': date,
+        'date': parsed_date.isoformat() if parsed_date else 'unknown',
+        'in_reply_to': email_message.get('In-Reply-To'),
+        'references': email_message.get('References'),
+        'headers': dict(email_message.items()),
+        'headers_text': str(email_message.items()),
         'body': body,
-        'headers_text': headers_text,
-        'attachments': attachments,
-        'attachments_content': attachments_content,
-        'message_id': message_id,
-        'in_reply_to': in_reply_to,
-        'references': references,
-        'parent_thread_id': parent_thread_id,
-        'urls': urls,
-        'summary': summary,
-        'relevant_terms': relevant_terms,
-        'relevant_terms_array': relevant_terms_array,
-        'embedding': embedding,
-        'semantic_domain': semantic_domain,
-        'domain_confidence': domain_confidence,
-        'index': index,
-        'requires_response': bool(classifications.get('requires_response', False)),
-        'urgent': bool(classifications.get('urgent', False)),
-        'important': bool(classifications.get('important', False)),
-        'advertisement': bool(classifications.get('advertisement', False)),
-        'responded': bool(responded),
-        'mailbox_id': mailbox_id
+        'attachment_parts': attachment_parts,
+        'attachments': [],
+        'attachment_refs': [],
+        'attachments_content': [],
+        'responded': False,
+        **body_fingerprint(body, NEAR_DUPLICATE_MIN_SHINGLES)
     }
-    
-    if dry_run:
-        logging.info(f"[DRY RUN] Would insert/update email - message_id: {message_id}, index: {index}, date: {date}, subject: {subject}, mailbox_id: {mailbox_id}")
-    else:
-        existing_email = emails_collection.find_one({'$or': [{'message_id': message_id}, {'index': index}]})
-        if existing_email:
-            emails_collection.update_one(
-                {'$or': [{'message_id': message_id}, {'index': index}]},
-                {'$set': email_document}
-            )
-            logging.info(f"Updated email with message_id: {message_id} for mailbox {mailbox_id}")
-        else:
-            emails_collection.insert_one(email_document)
-            logging.info(f"Inserted email with message_id: {message_id} for mailbox {mailbox_id}")
-
-        # Sincronizar con Elasticsearch, incluyendo mailbox_id
-        es_doc = {
-            'message_id': message_id,
-            'mailbox_id': mailbox_id,
-            'body': body,
-            'summary': summary,
-            'relevant_terms_array': relevant_terms_array,
-            'subject': subject,
-            'from': from_,
-            'to': to,
-            'date': date,
-            'semantic_domain': semantic_domain,
-            'embedding': np.frombuffer(zlib.decompress(embedding), dtype=np.float32).tolist() if embedding else []
-        }
-        if force_update_elastic or not existing_email:
-            res = es.index(index='email_index', body=es_doc)
-            es_doc_id = res['_id']
-            emails_collection.update_one(
-                {'message_id': message_id},
-                {'$set': {'es_doc_id': es_doc_id}}
-            )
-        else:
-            if 'es_doc_id' in existing_email:
-                es.update(index='email_index', id=existing_email['es_doc_id'], body={'doc': es_doc}, ignore=[404])
-            else:
-                res = es.index(index='email_index', body=es_doc)
-                es_doc_id = res['_id']
-                emails_collection.update_one(
-                    {'message_id': message_id},
-                    {'$set': {'es_doc_id': es_doc_id}}
-                )
 
 def train_bayesian_model(service, user_id, mailbox_id):
     logging.info(f"Iniciando entrenamiento del modelo bayesiano para mailbox {mailbox_id}...")
@@ -1398,19 +1706,16 @@ def train_bayesian_model(service, user_id, mailbox_id):
     texts = []
     labels = []
 
-    for msg in promo_messages:
-        msg_data = service.users().messages().get(userId='me', id=msg['id']).execute()
-        body = get_email_body(msg_data['payload'])
-        texts.append(body)
-        labels.append(1)
-        logging.info(f"Procesado correo de 'Promotions' con ID {msg['id']}")
-
-    for msg in non_promo_messages:
-        msg_data = service.users().messages().get(userId='me', id=msg['id']).execute()
-        body = get_email_body(msg_data['payload'])
-        texts.append(body)
-        labels.append(0)
-        logging.info(f"Procesado correo de 'Inbox' con ID {msg['id']}")
+    for messages, label, label_name in [(promo_messages, 1, 'Promotions'), (non_promo_messages, 0, 'Inbox')]:
+        msg_data_by_id = batch_get_messages(service, [msg['id'] for msg in messages], format='full', batch_size=GMAIL_BATCH_SIZE)
+        for msg in messages:
+            msg_data = msg_data_by_id.get(msg['id'])
+            if not msg_data:
+                continue
+            body = get_email_body(msg_data['payload'])
+            texts.append(body)
+            labels.append(label)
+            logging.info(f"Procesado correo de '{label_name}' con ID {msg['id']}")
 
     logging.info(f"Total de correos para entrenamiento: {len(texts)} (publicidad: {labels.count(1)}, no publicidad: {labels.count(0)})")
 
@@ -1423,11 +1728,99 @@ def train_bayesian_model(service, user_id, mailbox_id):
         pickle.dump({'vectorizer': vectorizer, 'classifier': classifier}, f)
     logging.info(f"Modelo bayesiano entrenado y guardado exitosamente para mailbox {mailbox_id}.")
 
-def fetch_and_process_emails(service, labels, username, mailbox_id, desired_max_results=5000, dry_run=False, train_advertisement=False, date_start=None, force_update_elastic=False):
+def list_gmail_history_changes(service, start_history_id, labels, mailbox_id):
+    """Lista los mensajes añadidos o re-etiquetados con alguna de las etiquetas desde start_history_id.
+
+    Devuelve (ids de Gmail, último historyId) o None si el historial ha caducado
+    (Gmail responde 404) y hace falta una resincronización completa.
+    """
+    gmail_ids = []
+    page_token = None
+    latest_history_id = start_history_id
+    labels = set(labels)
+    while True:
+        try:
+            results = service.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                historyTypes=['messageAdded', 'labelAdded'],
+                pageToken=page_token
+            ).execute()
+        except HttpError as e:
+            if e.resp.status == 404:
+                logging.warning(f"El historial de Gmail desde {start_history_id} ha caducado para {mailbox_id}, se requiere sincronización completa")
+                return None
+            raise
+        for history in results.get('history', []):
+            for added in history.get('messagesAdded', []):
+                if labels & set(added['message'].get('labelIds', [])):
+                    gmail_ids.append(added['message']['id'])
+            for labeled in history.get('labelsAdded', []):
+                if labels & set(labeled.get('labelIds', [])):
+                    gmail_ids.append(labeled['message']['id'])
+        latest_history_id = results.get('historyId', latest_history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    return list(dict.fromkeys(gmail_ids)), latest_history_id
+
+def process_gmail_message_ids(gmail_ids, username, mailbox_id, source, dry_run=False, force_update_elastic=False):
+    """Ejecuta el pipeline de ingestión sobre una lista de ids de mensajes de Gmail.
+
+    Devuelve el número de fallos: errores del pipeline y de la escritura más los
+    mensajes que batch_get_messages no pudo descargar (los omite sin lanzar).
+    """
+    get_service = thread_local_gmail_service(username, mailbox_id)
+    if not force_update_elastic:
+        gmail_ids = filter_new_gmail_messages(get_service, gmail_ids, mailbox_id)
+    chunks = [gmail_ids[start:start + GMAIL_BATCH_SIZE] for start in range(0, len(gmail_ids), GMAIL_BATCH_SIZE)]
+    missing = []
+
+    def fetch_stage(chunk):
+        full_messages = call_with_reauth(get_service, lambda service: batch_get_messages(service, chunk, format='full', batch_size=GMAIL_BATCH_SIZE))
+        missing.extend(gmail_id for gmail_id in chunk if gmail_id not in full_messages)
+        return [parse_gmail_message(full_messages[gmail_id], mailbox_id) for gmail_id in chunk if gmail_id in full_messages]
+
+    def attachment_stage(record):
+        return call_with_reauth(get_service, lambda service: extract_record_attachments(record, service, 'me'))
+
+    logging.info(f"Processing {len(gmail_ids)} messages from {source} for {mailbox_id}...")
+    _, failures = run_ingestion_pipeline(chunks, mailbox_id, f"Gmail/{source}", fetch_stage, attachment_stage, dry_run=dry_run, batched_fetch=True)
+    if missing:
+        logging.warning(f"{len(missing)} mensajes de {source} no se pudieron descargar para {mailbox_id}")
+    return failures + len(missing)
+
+def sync_gmail_history(service, labels, username, mailbox_id, dry_run=False, force_update_elastic=False):
+    """Sincronización incremental a partir de la marca historyId guardada en el buzón.
+
+    Devuelve False si no hay marca o si el historial ha caducado, en cuyo caso el
+    llamante debe hacer una sincronización completa.
+    """
+    history_id = get_mailbox_sync_state(users_collection, username, mailbox_id).get('history_id')
+    if not history_id:
+        logging.info(f"No hay marca historyId para {mailbox_id}, se hará una sincronización completa")
+        return False
+    changes = list_gmail_history_changes(service, history_id, labels, mailbox_id)
+    if changes is None:
+        return False
+    gmail_ids, latest_history_id = changes
+    logging.info(f"Sincronización incremental de {mailbox_id} desde historyId {history_id}: {len(gmail_ids)} mensajes nuevos o re-etiquetados")
+    failures = process_gmail_message_ids(gmail_ids, username, mailbox_id, 'history', dry_run=dry_run, force_update_elastic=force_update_elastic) if gmail_ids else 0
+    advance_gmail_history_id(users_collection, username, mailbox_id, latest_history_id, failures, dry_run=dry_run)
+    return True
+
+def fetch_and_process_emails(service, labels, username, mailbox_id, desired_max_results=5000, dry_run=False, train_advertisement=False, date_start=None, force_update_elastic=False, incremental=False):
     if train_advertisement:
         train_bayesian_model(service, 'me', mailbox_id)
         return
 
+    if incremental and sync_gmail_history(service, labels, username, mailbox_id, dry_run=dry_run, force_update_elastic=force_update_elastic):
+        return
+
+    # La marca se toma antes de listar para no perder cambios ocurridos durante la sincronización completa
+    start_history_id = service.users().getProfile(userId='me').execute().get('historyId')
+    failures = 0
+
     for label in labels:
         messages = []
         page_token = None
@@ -1483,37 +1876,11 @@ def fetch_and_process_emails(service, labels, username, mailbox_id, desired_max_
             if not page_token:
                 break
 
-        for i, message in enumerate(messages, 1):
-            logging.info(f"Processing message {i}/{len(messages)} from {label} for {mailbox_id}...")
-            retries = 0
-            while retries <= max_retries:
-                try:
-                    msg = service.users().messages().get(userId='me', id=message['id']).execute()
-                    process_and_insert_email(msg, service, 'me', mailbox_id, dry_run=dry_run, force_update_elastic=force_update_elastic)
-                    break
-                except HttpError as e:
-                    if e.resp.status in [401, 429, 503]:
-                        if e.resp.status == 401 or 'invalid_grant' in str(e):
-                            logging.info(f"Error de autenticación (401 o invalid_grant) detectado al procesar mensaje para {mailbox_id}, intentando reautorizar...")
-                            creds = get_credentials_from_db(username, mailbox_id)
-                            if not creds:
-                                logging.error(f"No se pudieron obtener credenciales válidas para {mailbox_id}")
-                                break
-                            service = build_service(creds)
-                            logging.info(f"Servicio reconstruido con nuevas credenciales para {mailbox_id}")
-                            continue
-                        elif e.resp.status in [429, 503]:
-                            retries += 1
-                            delay = min(base_delay * 2 ** (retries - 1), 32)
-                            time.sleep(delay + random.uniform(0, 0.1 * delay))
-                    else:
-                        logging.error(f"Error processing message {message['id']} for {mailbox_id}: {e}")
-                        break
-                except Exception as e:
-                    logging.error(f"Unexpected error processing message {message['id']} for {mailbox_id}: {e}")
-                    break
+        failures += process_gmail_message_ids([message['id'] for message in messages], username, mailbox_id, label, dry_run=dry_run, force_update_elastic=force_update_elastic)
+
+    advance_gmail_history_id(users_collection, username, mailbox_id, start_history_id, failures, dry_run=dry_run)
 
-def process_user_mailboxes(username, mailbox_id=None, dry_run=False, review=False, populate=False, train_advertisement=False, num_emails=5000, date_start=None, force_update_elastic=False, fix_empty=False):
+def process_user_mailboxes(username, mailbox_id=None, dry_run=False, review=False, populate=False, train_advertisement=False, num_emails=5000, date_start=None, force_update_elastic=False, fix_empty=False, incremental=False, backfill_subjects=False, rebuild_thread_collection=False, enrich_pending=False, skip_enrichment=False, backfill_simhash=False, refresh_responded=False, refresh_sender_stats=False, backfill_addresses=False):
     user = users_collection.find_one({"username": username})
     if not user:
         logging.error(f"Usuario {username} no encontrado")
@@ -1528,6 +1895,11 @@ def process_user_mailboxes(username, mailbox_id=None, dry_run=False, review=Fals
     
     for mailbox in mailboxes:
         mailbox_id = mailbox['mailbox_id']
+        if not dry_run and not refresh_sender_stats:
+            ensure_sender_stats(emails_collection, sender_stats_collection, mailbox_id)
+        if enrich_pending:
+            enrich_pending_emails(mailbox_id)
+            continue
         if mailbox['type'] == 'gmail':
             creds = get_credentials_from_db(username, mailbox_id)
             if not creds:
@@ -1541,9 +1913,25 @@ def process_user_mailboxes(username, mailbox_id=None, dry_run=False, review=Fals
                 populate_thread_fields(service, 'me', mailbox_id)
             elif fix_empty:
                 fix_empty_bodies(username, mailbox_id)
+            elif backfill_subjects:
+                backfill_normalized_subjects(mailbox_id, dry_run=dry_run)
+            elif backfill_simhash:
+                backfill_fingerprints(mailbox_id, dry_run=dry_run)
+            elif backfill_addresses:
+                backfill_address_fields(mailbox_id, dry_run=dry_run)
+            elif refresh_responded:
+                migrate_address_fields(mailbox_id)
+                refresh_responded_status(mailbox_id)
+            elif refresh_sender_stats:
+                rebuild_sender_stats(emails_collection, sender_stats_collection, mailbox_id)
+            elif rebuild_thread_collection:
+                rebuild_threads(emails_collection, threads_collection, mailbox_id)
             else:
-                migrate_date_formats(dry_run=dry_run)
-                fetch_and_process_emails(service, ['INBOX', 'SENT'], username, mailbox_id, desired_max_results=num_emails, dry_run=dry_run, train_advertisement=train_advertisement, date_start=date_start, force_update_elastic=force_update_elastic)
+                migrate_dates(dry_run=dry_run)
+                migrate_address_fields(mailbox_id, dry_run=dry_run)
+                fetch_and_process_emails(service, ['INBOX', 'SENT'], username, mailbox_id, desired_max_results=num_emails, dry_run=dry_run, train_advertisement=train_advertisement, date_start=date_start, force_update_elastic=force_update_elastic, incremental=incremental)
+                if DEFER_ENRICHMENT and not dry_run and not skip_enrichment:
+                    enrich_pending_emails(mailbox_id)
         elif mailbox['type'] == 'imap':
             creds = get_credentials_from_db(username, mailbox_id)
             if not creds:
@@ -1557,16 +1945,33 @@ def process_user_mailboxes(username, mailbox_id=None, dry_run=False, review=Fals
                 populate_thread_fields_imap(imap, username, mailbox_id)
             elif fix_empty:
                 logging.warning(f"Corrección de cuerpos vacíos no implementada para IMAP en mailbox {mailbox_id}")
+            elif backfill_subjects:
+                backfill_normalized_subjects(mailbox_id, dry_run=dry_run)
+            elif backfill_simhash:
+                backfill_fingerprints(mailbox_id, dry_run=dry_run)
+            elif backfill_addresses:
+                backfill_address_fields(mailbox_id, dry_run=dry_run)
+            elif refresh_responded:
+                migrate_address_fields(mailbox_id)
+                refresh_responded_status(mailbox_id)
+            elif refresh_sender_stats:
+                rebuild_sender_stats(emails_collection, sender_stats_collection, mailbox_id)
+            elif rebuild_thread_collection:
+                rebuild_threads(emails_collection, threads_collection, mailbox_id)
             else:
-                migrate_date_formats(dry_run=dry_run)
-                fetch_and_process_emails_imap(imap, ['INBOX', 'Sent'], username, mailbox_id, desired_max_results=num_emails, dry_run=dry_run, date_start=date_start, force_update_elastic=force_update_elastic)
+                migrate_dates(dry_run=dry_run)
+                migrate_address_fields(mailbox_id, dry_run=dry_run)
+                fetch_and_process_emails_imap(imap, ['INBOX', 'Sent'], username, mailbox_id, desired_max_results=num_emails, dry_run=dry_run, date_start=date_start, force_update_elastic=force_update_elastic, incremental=incremental)
                 imap.logout()
+                if DEFER_ENRICHMENT and not dry_run and not skip_enrichment:
+                    enrich_pending_emails(mailbox_id)
         else:
             logging.error(f"Tipo de buzón no soportado: {mailbox['type']}")
 
 def populate_thread_fields(service, user_id, mailbox_id):
     logging.info(f"Iniciando población de campos de hilo para mailbox {mailbox_id}...")
     cursor = emails_collection.find({'mailbox_id': mailbox_id}, {'message_id': 1, 'gmail_message_id': 1, '_id': 0})
+    message_id_by_gmail_id = {}
     for doc in cursor:
         message_id = doc['message_id']
         gmail_message_id = doc.get('gmail_message_id', None)
@@ -1591,10 +1996,28 @@ def populate_thread_fields(service, user_id, mailbox_id):
             except HttpError as e:
                 logging.error(f"Error al buscar mensaje por Message-ID {message_id}: {e}")
                 continue
-        
+        message_id_by_gmail_id[gmail_message_id] = message_id
+
+    # Solo se necesitan las cabeceras de hilo: se piden en formato metadata y por lotes
+    gmail_ids = list(message_id_by_gmail_id)
+    for start in range(0, len(gmail_ids), 500):
+        chunk = gmail_ids[start:start + 500]
         try:
-            msg = service.users().messages().get(userId=user_id, id=gmail_message_id).execute()
-            headers = {header['name']: header['value'] for header in msg['payload']['headers']}
+            metadata = batch_get_messages(service, chunk, format='metadata', metadata_headers=['In-Reply-To', 'References'], batch_size=GMAIL_BATCH_SIZE)
+        except HttpError as e:
+            logging.error(f"Error al recuperar lote de mensajes desde Gmail: {e}")
+            metadata = {}
+        for gmail_message_id in chunk:
+            message_id = message_id_by_gmail_id[gmail_message_id]
+            msg = metadata.get(gmail_message_id)
+            if not msg:
+                logging.warning(f"No se pudo recuperar mensaje {gmail_message_id} desde Gmail. Usando message_id como parent_thread_id.")
+                emails_collection.update_one(
+                    {'message_id': message_id},
+                    {'$set': {'parent_thread_id': message_id}}
+                )
+                continue
+            headers = {header['name']: header['value'] for header in msg.get('payload', {}).get('headers', [])}
             in_reply_to = headers.get('In-Reply-To')
             references = headers.get('References')
             thread_id = msg.get('threadId', None)
@@ -1609,57 +2032,47 @@ def populate_thread_fields(service, user_id, mailbox_id):
                 }}
             )
             logging.info(f"Actualizados campos de hilo para message_id {message_id}")
-        except HttpError as e:
-            logging.warning(f"No se pudo recuperar mensaje {gmail_message_id} desde Gmail: {e}. Usando message_id como parent_thread_id.")
-            emails_collection.update_one(
-                {'message_id': message_id},
-                {'$set': {'parent_thread_id': message_id}}
-            )
+    rebuild_threads(emails_collection, threads_collection, mailbox_id)
     logging.info(f"Población de campos de hilo completada para mailbox {mailbox_id}.")
 
 def populate_thread_fields_imap(imap, username, mailbox_id):
     logging.info(f"Iniciando población de campos de hilo para mailbox {mailbox_id}...")
+    # Una única descarga de cabeceras de hilo para toda la carpeta en lugar de un SEARCH por correo
+    thread_headers = {}
+    try:
+        imap.select('INBOX', readonly=True)
+        status, messages = imap.uid('SEARCH', None, 'ALL')
+        uids = sorted(map(int, messages[0].split())) if status == 'OK' else []
+        for header_message in imap_fetch_headers(imap, uids, ['MESSAGE-ID', 'IN-REPLY-TO', 'REFERENCES']).values():
+            if header_message['Message-ID']:
+                thread_headers[header_message['Message-ID'].strip()] = header_message
+    except Exception as e:
+        logging.warning(f"No se pudieron descargar las cabeceras de hilo desde IMAP para {mailbox_id}: {e}")
+
     cursor = emails_collection.find({'mailbox_id': mailbox_id}, {'message_id': 1, '_id': 0})
     for doc in cursor:
         message_id = doc['message_id']
-        try:
-            imap.select('INBOX')
-            status, messages = imap.search(None, f'(HEADER Message-ID "{message_id}")')
-            if status == 'OK' and messages[0]:
-                msg_id = messages[0].split()[0]
-                status, msg_data = imap.fetch(msg_id, '(RFC822)')
-                if status == 'OK':
-                    raw_email = msg_data[0][1]
-                    email_message = email.message_from_bytes(raw_email)
-                    in_reply_to = email_message.get('In-Reply-To')
-                    references = email_message.get('References')
-                    parent_thread_id = in_reply_to or message_id
+        header_message = thread_headers.get(message_id.strip()) if message_id else None
+        if header_message is not None:
+            in_reply_to = header_message.get('In-Reply-To')
+            references = header_message.get('References')
+            parent_thread_id = in_reply_to or message_id
 
-                    emails_collection.update_one(
-                        {'message_id': message_id},
-                        {'$set': {
-                            'in_reply_to': in_reply_to,
-                            'references': references,
-                            'parent_thread_id': parent_thread_id
-                        }}
-                    )
-                    logging.info(f"Actualizados campos de hilo para message_id {message_id}")
-                else:
-                    emails_collection.update_one(
-                        {'message_id': message_id},
-                        {'$set': {'parent_thread_id': message_id}}
-                    )
-            else:
-                emails_collection.update_one(
-                    {'message_id': message_id},
-                    {'$set': {'parent_thread_id': message_id}}
-                )
-        except Exception as e:
-            logging.warning(f"No se pudo procesar mensaje {message_id} desde IMAP: {e}. Usando message_id como parent_thread_id.")
+            emails_collection.update_one(
+                {'message_id': message_id},
+                {'$set': {
+                    'in_reply_to': in_reply_to,
+                    'references': references,
+                    'parent_thread_id': parent_thread_id
+                }}
+            )
+            logging.info(f"Actualizados campos de hilo para message_id {message_id}")
+        else:
             emails_collection.update_one(
                 {'message_id': message_id},
                 {'$set': {'parent_thread_id': message_id}}
             )
+    rebuild_threads(emails_collection, threads_collection, mailbox_id)
     logging.info(f"Población de campos de hilo completada para mailbox {mailbox_id}.")
 
 def main():
@@ -1674,6 +2087,15 @@ def main():
     parser.add_argument('-num_emails', type=int, default=5000, help="Número de correos a procesar (default: 5000)")
     parser.add_argument('-date_start', help="Fecha de inicio para procesar correos (formato: YYYY-MM-DD)", type=lambda s: datetime.strptime(s, '%Y-%m-%d'))
     parser.add_argument('-force_update_elastic', action='store_true', help="Forzar la actualización de documentos en Elasticsearch")
+    parser.add_argument('-backfill_subjects', action='store_true', help="Calcular normalized_subject en los correos existentes")
+    parser.add_argument('-backfill_fingerprints', action='store_true', help="Calcular la huella SimHash del cuerpo en los correos existentes (casi duplicados)")
+    parser.add_argument('-backfill_addresses', action='store_true', help="Calcular from_addr, to_addrs, cc_addrs y direction en los correos existentes")
+    parser.add_argument('-update_responded', action='store_true', help="Recalcular el estado de respuesta de todos los correos del buzón")
+    parser.add_argument('-rebuild_sender_stats', action='store_true', help="Recalcular las estadísticas de remitentes del buzón a partir de los correos")
+    parser.add_argument('-rebuild_threads', action='store_true', help="Reconstruir la colección de hilos a partir de los correos existentes")
+    parser.add_argument('-incremental', action='store_true', help="Sincronización incremental desde la última marca guardada (historyId en Gmail, último UID en IMAP)")
+    parser.add_argument('-enrich_pending', action='store_true', help="Solo procesar la cola de enriquecimiento con LLM (correos con enrichment_status pending)")
+    parser.add_argument('-skip_enrichment', action='store_true', help="No vaciar la cola de enriquecimiento tras la ingestión (la procesará otro proceso con -enrich_pending)")
     args = parser.parse_args()
 
     initialize_collection()
@@ -1687,7 +2109,16 @@ def main():
         num_emails=args.num_emails,
         date_start=args.date_start,
         force_update_elastic=args.force_update_elastic,
-        fix_empty=args.fix_empty
+        fix_empty=args.fix_empty,
+        incremental=args.incremental,
+        backfill_subjects=args.backfill_subjects,
+        rebuild_thread_collection=args.rebuild_threads,
+        enrich_pending=args.enrich_pending,
+        skip_enrichment=args.skip_enrichment,
+        backfill_simhash=args.backfill_fingerprints,
+        refresh_responded=args.update_responded,
+        refresh_sender_stats=args.rebuild_sender_stats,
+        backfill_addresses=args.backfill_addresses
     )
     logging.info("Procesamiento de correos completado.")
 
@@ -5,6 +5,7 @@ from services.nlp_service import detect_language
 from services.gmail_service import create_draft as create_gmail_draft
 from services.imap_service import create_draft as create_imap_draft
 from insert_emails import get_credentials_from_db, call_mistral_api
+from services.ollama_client import PRIORITY_AGATTA
 from googleapiclient.discovery import build
 from services.cache_service import get_cached_result, cache_result
 import logging
@@ -93,7 +94,7 @@ def create_draft(task_id, user):
         Asunto del correo: {email['subject']}
         Cuerpo del correo: {email['body'][:500]}
         """
-        response = call_mistral_api(prompt)
+        response = call_mistral_api(prompt, priority=PRIORITY_AGATTA)
         draft_content = response.strip()
         
         mailbox_id = email['mailbox_id']
@@ -9,9 +9,9 @@ from collections import Counter
 from pymongo import MongoClient
 from services.nlp_service import normalize_text, call_ollama_api
 from services.cache_service import get_cached_result, cache_result
+from services.structured_output_service import generate_structured
 from config import MONGO_URI, MONGO_DB_NAME, MONGO_EMAILS_COLLECTION, CACHE_TTL
 import uuid
-import json
 import datetime
 import torch
 from datetime import datetime as dt, timedelta
@@ -138,21 +138,12 @@ def generate_theme_title_and_summary(emails):
     """
 
     try:
-        response = call_ollama_api(prompt)
-        cleaned_response = response.strip()
-        if cleaned_response.startswith('```json'):
-            cleaned_response = cleaned_response[7:].strip()
-        if cleaned_response.endswith('```'):
-            cleaned_response = cleaned_response[:-3].strip()
-
-        result = json.loads(cleaned_response)
-        if not all(key in result for key in ['title', 'summary']) or not all(
-            k in result['summary'] for k in ['tema', 'involucrados', 'historia', 'proximos_pasos', 'puntos_claves']
-        ):
+        result, _ = generate_structured('theme_summary', prompt, call_ollama_api)
+        if result is None:
             raise ValueError("Invalid response format")
         cache_result(cache_key, result)
         return result
-    except (json.JSONDecodeError, ValueError) as e:
+    except ValueError as e:
         logger.error(f"Error parsing LLM response: {str(e)}")
         result = {
             'title': ', '.join(extract_keywords(combined_text)) or 'Tema sin título',
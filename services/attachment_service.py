@@ -0,0 +1,238 @@
+import io
+import logging
+from logging import handlers
+import mimetypes
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeoutError
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.attachment_service')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+TESSERACT_CMD = r'/usr/bin/tesseract'
+
+MIME_PDF = 'application/pdf'
+MIME_DOCX = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+MIME_XLSX = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+PARTIAL_TIME = "[Extracción parcial: tiempo máximo alcanzado]"
+PARTIAL_PAGES = "[Extracción parcial: número máximo de páginas alcanzado]"
+PARTIAL_ROWS = "[Extracción parcial: número máximo de filas alcanzado]"
+PARTIAL_CHARS = "[Extracción parcial: longitud máxima alcanzada]"
+SKIPPED_BY_POLICY = "[Adjunto no analizado por la política de enriquecimiento]"
+
+# forkserver crea los procesos desde un servidor de un solo hilo; spawn donde no existe (Windows)
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def _join_partial(parts, marker):
+    return "\n".join(part for part in parts if part) + f"\n{marker}"
+
+
+def _extract_pdf(data, budgets, deadline):
+    from PyPDF2 import PdfReader
+    reader = PdfReader(io.BytesIO(data))
+    parts = []
+    for number, page in enumerate(reader.pages):
+        if number >= budgets['max_pages']:
+            return _join_partial(parts, PARTIAL_PAGES)
+        if time.monotonic() > deadline:
+            return _join_partial(parts, PARTIAL_TIME)
+        parts.append(page.extract_text() or "")
+    return "".join(parts)
+
+
+def _extract_image(data, budgets, deadline):
+    import pytesseract
+    from PIL import Image
+    pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+    try:
+        # pytesseract mata el proceso de tesseract al agotar el tiempo
+        return pytesseract.image_to_string(Image.open(io.BytesIO(data)), timeout=max(1, deadline - time.monotonic()))
+    except RuntimeError:
+        return PARTIAL_TIME
+
+
+def _extract_docx(data, budgets, deadline):
+    from docx import Document as DocxDocument
+    doc = DocxDocument(io.BytesIO(data))
+    parts = []
+    for paragraph in doc.paragraphs:
+        if time.monotonic() > deadline:
+            return _join_partial(parts, PARTIAL_TIME)
+        parts.append(paragraph.text)
+    return '\n'.join(parts)
+
+
+def _extract_xlsx(data, budgets, deadline):
+    import openpyxl
+    workbook = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        parts = []
+        for number, row in enumerate(workbook.active.iter_rows(values_only=True)):
+            if number >= budgets['max_rows']:
+                return _join_partial(parts, PARTIAL_ROWS)
+            if time.monotonic() > deadline:
+                return _join_partial(parts, PARTIAL_TIME)
+            parts.append(', '.join(str(cell) for cell in row))
+        return '\n'.join(parts)
+    finally:
+        workbook.close()
+
+
+_ERROR_MESSAGES = {
+    MIME_PDF: "Error al analizar PDF",
+    MIME_DOCX: "Error al analizar Word",
+    MIME_XLSX: "Error al analizar Excel",
+    'image': "Error en OCR"
+}
+
+
+def extract_text_from_bytes(filename, data, budgets):
+    """Extrae el texto de un adjunto en memoria respetando los límites de tamaño, páginas, filas y tiempo.
+
+    Se ejecuta en los procesos del pool. Si se alcanza un límite devuelve el texto obtenido
+    hasta ese momento seguido de una marca de extracción parcial.
+    """
+    mime = mimetypes.guess_type(filename or '')[0] or ''
+    kind = 'image' if mime.startswith('image/') else mime
+    if len(data) > budgets['max_bytes']:
+        return f"Adjunto demasiado grande para analizar ({len(data)} bytes)"
+    deadline = time.monotonic() + budgets['timeout']
+    try:
+        if mime == 'text/plain':
+            text = data.decode('utf-8', errors='replace')
+        elif mime == MIME_PDF:
+            text = _extract_pdf(data, budgets, deadline)
+        elif kind == 'image':
+            text = _extract_image(data, budgets, deadline)
+        elif mime == MIME_DOCX:
+            text = _extract_docx(data, budgets, deadline)
+        elif mime == MIME_XLSX:
+            text = _extract_xlsx(data, budgets, deadline)
+        else:
+            return "Tipo de archivo no soportado"
+    except Exception:
+        return _ERROR_MESSAGES.get(kind, "Error al analizar el adjunto")
+    if len(text) > budgets['max_chars']:
+        text = _join_partial([text[:budgets['max_chars']]], PARTIAL_CHARS)
+    return text
+
+
+class PoolRestartedError(RuntimeError):
+    """La extracción estaba pendiente en un pool que se ha terminado por un bloqueo."""
+
+
+class AttachmentExtractor:
+    """Extrae el texto de los adjuntos en un pool de procesos.
+
+    Cada adjunto tiene un tiempo máximo (budgets['timeout']) que la propia extracción
+    respeta devolviendo texto parcial. Si un proceso no responde ni siquiera pasado ese
+    tiempo más un margen (por ejemplo, atascado dentro de una librería), el pool se
+    termina y se crea uno nuevo; las extracciones que quedaban pendientes en él fallan
+    en ese momento en lugar de esperar a su propio tiempo máximo.
+
+    Los procesos no se crean con fork: el proceso de ingestión tiene hilos del pipeline,
+    de pymongo y de torch, y un hijo bifurcado puede heredar un lock tomado por alguno de
+    ellos. Con forkserver/spawn cada proceso importa de nuevo el script principal, por lo
+    que este no debe cargar modelos al importarse.
+    """
+
+    def __init__(self, processes=2, budgets=None, grace_seconds=30):
+        self.processes = max(1, int(processes))
+        self.budgets = budgets
+        self.grace_seconds = grace_seconds
+        self._pool = None
+        self._futures = set()
+        self._lock = threading.Lock()
+        # Aparte de _lock: los callbacks corren en el hilo de resultados del pool, que terminate() espera
+        self._futures_lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                context = multiprocessing.get_context(START_METHOD)
+                self._pool = context.Pool(self.processes, maxtasksperchild=50)
+                self._futures = set()
+            return self._pool, self._futures
+
+    def _settle(self, futures, future, setter, value):
+        with self._futures_lock:
+            futures.discard(future)
+        try:
+            setter(value)
+        except InvalidStateError:
+            # Ya se había dado por fallida al reiniciar el pool
+            pass
+
+    def _submit(self, pool, futures, filename, data):
+        future = Future()
+        with self._futures_lock:
+            futures.add(future)
+        try:
+            pool.apply_async(
+                extract_text_from_bytes, (filename, data, self.budgets),
+                callback=lambda text: self._settle(futures, future, future.set_result, text),
+                error_callback=lambda e: self._settle(futures, future, future.set_exception, e)
+            )
+        except ValueError:
+            # Otro hilo ha terminado este pool entre _get_pool y el envío
+            self._settle(futures, future, future.set_exception, PoolRestartedError("Pool de extracción terminado"))
+        return future
+
+    def _restart_pool(self, pool):
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+            futures = self._futures
+        logger.warning("Reiniciando el pool de extracción de adjuntos tras un bloqueo")
+        with self._futures_lock:
+            pending = list(futures)
+            futures.clear()
+        for future in pending:
+            self._settle(futures, future, future.set_exception, PoolRestartedError("Pool de extracción reiniciado"))
+        pool.terminate()
+
+    def extract_many(self, attachments):
+        """Recibe una lista de (filename, bytes) y devuelve el texto de cada uno en el mismo orden."""
+        pool, futures = self._get_pool()
+        pending = [
+            self._submit(pool, futures, filename, data) if data is not None else None
+            for filename, data in attachments
+        ]
+        results = []
+        for (filename, data), future in zip(attachments, pending):
+            if future is None:
+                results.append("No se pudo descargar el adjunto")
+                continue
+            try:
+                results.append(future.result(timeout=self.budgets['timeout'] + self.grace_seconds))
+            except FutureTimeoutError:
+                logger.error("Tiempo agotado extrayendo el adjunto %s (%d bytes)", filename, len(data))
+                self._restart_pool(pool)
+                results.append(PARTIAL_TIME)
+            except PoolRestartedError:
+                logger.warning("Extracción del adjunto %s interrumpida por el reinicio del pool", filename)
+                results.append("Error al analizar el adjunto")
+            except Exception as e:
+                logger.error("Error extrayendo el adjunto %s: %s", filename, str(e))
+                results.append("Error al analizar el adjunto")
+        return results
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
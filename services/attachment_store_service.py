@@ -0,0 +1,133 @@
+import hashlib
+import logging
+from logging import handlers
+import mimetypes
+from datetime import datetime, timezone
+from pymongo import UpdateOne
+from services.attachment_service import PARTIAL_TIME, PARTIAL_PAGES, PARTIAL_ROWS, PARTIAL_CHARS, SKIPPED_BY_POLICY
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.attachment_store_service')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+# Colección `attachments`: un documento por contenido, con _id = SHA-256 de los bytes,
+#   text, mime, size, filenames, partial, transient, created_at y last_seen_at.
+# Los correos guardan en `attachment_refs` los hashes, en el mismo orden que `attachments`.
+# El texto se busca con el índice de texto de esta colección (MongoDB) y con el campo
+# `attachments_content` del documento de Elasticsearch de cada correo.
+
+# Resultados que dependen de la carga del momento: se guardan, pero se vuelven a analizar
+_TRANSIENT_RESULTS = {"Error al analizar el adjunto"}
+
+
+def attachment_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_transient(text):
+    """Los límites de páginas, filas o longitud son deterministas; un tiempo agotado no."""
+    return text in _TRANSIENT_RESULTS or text.endswith(PARTIAL_TIME)
+
+
+def get_cached_texts(attachments_collection, hashes, include_transient=False):
+    """Devuelve {hash: texto} para los hashes ya analizados (una sola consulta)."""
+    hashes = list({h for h in hashes if h})
+    if not hashes:
+        return {}
+    query = {'_id': {'$in': hashes}}
+    if not include_transient:
+        query['transient'] = {'$ne': True}
+    return {doc['_id']: doc.get('text', '') for doc in attachments_collection.find(query, {'text': 1})}
+
+
+def store_texts(attachments_collection, entries):
+    """Guarda el texto extraído y registra los nombres con los que se ha visto cada adjunto.
+
+    entries es una lista de (hash, filename, size, text); text es None para los adjuntos
+    reutilizados, de los que solo se actualizan filenames y last_seen_at.
+    """
+    now = datetime.now(timezone.utc)
+    grouped = {}
+    for attachment_id, filename, size, text in entries:
+        entry = grouped.setdefault(attachment_id, {'filenames': set(), 'size': size, 'text': None})
+        entry['filenames'].add(filename)
+        if text is not None:
+            entry['text'] = text
+    operations = []
+    for attachment_id, entry in grouped.items():
+        update = {
+            '$addToSet': {'filenames': {'$each': sorted(entry['filenames'])}},
+            '$set': {'last_seen_at': now}
+        }
+        text = entry['text']
+        if text is not None:
+            update['$set'].update({
+                'text': text,
+                'mime': mimetypes.guess_type(min(entry['filenames']))[0],
+                'size': entry['size'],
+                'partial': text.endswith((PARTIAL_PAGES, PARTIAL_ROWS, PARTIAL_CHARS)),
+                'transient': is_transient(text)
+            })
+            update['$setOnInsert'] = {'created_at': now}
+        operations.append(UpdateOne({'_id': attachment_id}, update, upsert=text is not None))
+    if operations:
+        attachments_collection.bulk_write(operations, ordered=False)
+
+
+def extract_with_cache(attachments_collection, extractor, attachments, skip=None):
+    """Recibe (filename, bytes) y devuelve (hashes, textos), extrayendo solo los adjuntos no vistos.
+
+    Un adjunto que no se pudo descargar tiene hash None. Los adjuntos no vistos cuyo
+    nombre cumple skip(filename) no se analizan ni se guardan (se reutiliza el texto si
+    ya estaba guardado).
+    """
+    hashes = [attachment_hash(data) if data is not None else None for _, data in attachments]
+    cached = get_cached_texts(attachments_collection, hashes)
+
+    pending = {}
+    for (filename, data), attachment_id in zip(attachments, hashes):
+        if attachment_id and attachment_id not in cached and attachment_id not in pending and not (skip and skip(filename)):
+            pending[attachment_id] = (filename, data)
+    extracted = dict(zip(pending, extractor.extract_many(list(pending.values())))) if pending else {}
+
+    texts = []
+    entries = []
+    for (filename, data), attachment_id in zip(attachments, hashes):
+        if attachment_id is None:
+            texts.append("No se pudo descargar el adjunto")
+            continue
+        texts.append(cached[attachment_id] if attachment_id in cached else extracted.get(attachment_id, SKIPPED_BY_POLICY))
+        entries.append((attachment_id, filename or 'unnamed_attachment', len(data), extracted.get(attachment_id)))
+    store_texts(attachments_collection, entries)
+    logger.debug("Adjuntos: %d reutilizados y %d analizados", len(entries) - len(pending), len(pending))
+    return hashes, texts
+
+
+def attachment_search_text(email):
+    """Texto de los adjuntos del correo para el campo `attachments_content` de Elasticsearch.
+
+    El texto no se guarda en el correo de MongoDB; requiere haber llamado antes a load_attachment_texts.
+    """
+    return ' '.join(text for text in email.get('attachments_content', []) if text)
+
+
+def load_attachment_texts(attachments_collection, emails):
+    """Rellena `attachments_content` a partir de `attachment_refs` en los correos que no lo tienen.
+
+    Los correos antiguos siguen guardando el texto dentro del documento y se dejan como están.
+    """
+    missing = [email for email in emails if 'attachments_content' not in email and email.get('attachment_refs')]
+    if not missing:
+        return emails
+    texts = get_cached_texts(attachments_collection, [ref for email in missing for ref in email['attachment_refs']], include_transient=True)
+    for email in missing:
+        email['attachments_content'] = [texts.get(ref, "") if ref else "No se pudo descargar el adjunto" for ref in email['attachment_refs']]
+    return emails
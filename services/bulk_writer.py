@@ -0,0 +1,175 @@
+import logging
+from logging import handlers
+import threading
+import time
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from elasticsearch import helpers
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.bulk_writer')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+
+class EmailBulkWriter:
+    """Acumula correos y los escribe en bloque en MongoDB y Elasticsearch.
+
+    Cada correo se guarda con un upsert por message_id (bulk_write no ordenado) y se
+    actualiza parcialmente en Elasticsearch (update con doc_as_upsert) con
+    helpers.streaming_bulk usando un _id determinista: el es_doc_id previo del documento
+    si existe o, si no, su campo `index`. Así no hace falta leer el _id generado por
+    Elasticsearch para guardarlo después en MongoDB, y los campos que no trae es_doc
+    (por ejemplo, el enriquecimiento de un correo ya enriquecido) se conservan.
+
+    El búfer se vacía al alcanzar max_docs documentos o cuando han pasado
+    flush_interval segundos desde el último vaciado. Los errores se registran por
+    documento y se acumulan en las estadísticas. after_flush, si se indica, recibe tras
+    cada vaciado la lista de documentos guardados correctamente en MongoDB, y on_insert
+    solo los que no existían antes (insertados por el upsert). Los campos de
+    unset_fields se eliminan de los documentos ya existentes al actualizarlos, salvo que
+    add reciba su propia lista en unset_fields.
+    """
+
+    def __init__(self, collection, es, index_name='email_index', max_docs=100, flush_interval=5.0, after_flush=None, unset_fields=(), on_insert=None):
+        self.collection = collection
+        self.on_insert = on_insert
+        self.unset_fields = tuple(unset_fields)
+        self.es = es
+        self.index_name = index_name
+        self.after_flush = after_flush
+        self.max_docs = max(1, int(max_docs))
+        self.flush_interval = flush_interval
+        self.stats = {
+            'flushes': 0,
+            'mongo_upserted': 0,
+            'mongo_modified': 0,
+            'mongo_errors': 0,
+            'es_indexed': 0,
+            'es_errors': 0
+        }
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._closed = threading.Event()
+        self._timer = None
+        if self.flush_interval:
+            self._timer = threading.Thread(target=self._flush_periodically, name='bulk-writer-flush', daemon=True)
+            self._timer.start()
+
+    def add(self, document, es_doc, insert_only=None, unset_fields=None):
+        """Añade un correo (documento de MongoDB y documento de Elasticsearch) al búfer.
+
+        insert_only son campos que solo se escriben si el correo no existía ($setOnInsert).
+        """
+        with self._buffer_lock:
+            self._buffer.append((document, es_doc, insert_only or {}, self.unset_fields if unset_fields is None else tuple(unset_fields)))
+            full = len(self._buffer) >= self.max_docs
+        if full:
+            self.flush()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(min(1.0, self.flush_interval)):
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._buffer_lock:
+                batch, self._buffer = self._buffer, []
+            self._last_flush = time.monotonic()
+            if not batch:
+                return
+            self._assign_es_ids(batch)
+            failed, inserted = self._write_mongo(batch)
+            self._write_es(batch)
+            self.stats['flushes'] += 1
+            if self.after_flush:
+                try:
+                    self.after_flush([item[0] for i, item in enumerate(batch) if i not in failed])
+                except Exception as e:
+                    logger.error("Error tras la escritura en bloque: %s", str(e), exc_info=True)
+            if self.on_insert and inserted:
+                try:
+                    # Un correo insertado también tiene los campos de insert_only
+                    self.on_insert([{**batch[i][2], **batch[i][0]} for i in sorted(inserted)])
+                except Exception as e:
+                    logger.error("Error tras la inserción en bloque: %s", str(e), exc_info=True)
+            logger.debug("Vaciado de %d correos al almacenamiento", len(batch))
+
+    def _assign_es_ids(self, batch):
+        # Reutilizar el _id de los documentos que ya se indexaron con un identificador aleatorio
+        message_ids = [item[0]['message_id'] for item in batch]
+        previous_ids = {
+            doc['message_id']: doc['es_doc_id']
+            for doc in self.collection.find(
+                {'message_id': {'$in': message_ids}, 'es_doc_id': {'$exists': True}},
+                {'message_id': 1, 'es_doc_id': 1, '_id': 0}
+            )
+        }
+        for document, *_ in batch:
+            document['es_doc_id'] = previous_ids.get(document['message_id']) or document['index']
+
+    @staticmethod
+    def _update_for(document, insert_only, unset_fields):
+        update = {'$set': document}
+        if insert_only:
+            update['$setOnInsert'] = insert_only
+        unset = {field: '' for field in unset_fields if field not in document and field not in insert_only}
+        if unset:
+            update['$unset'] = unset
+        return update
+
+    def _write_mongo(self, batch):
+        """Devuelve las posiciones del lote que no se pudieron guardar y las que se insertaron."""
+        failed, inserted = set(), set()
+        operations = [
+            UpdateOne({'message_id': document['message_id']}, self._update_for(document, insert_only, unset_fields), upsert=True)
+            for document, _, insert_only, unset_fields in batch
+        ]
+        try:
+            result = self.collection.bulk_write(operations, ordered=False)
+            self.stats['mongo_upserted'] += result.upserted_count
+            self.stats['mongo_modified'] += result.modified_count
+            inserted.update(result.upserted_ids)
+        except BulkWriteError as e:
+            details = e.details
+            self.stats['mongo_upserted'] += details.get('nUpserted', 0)
+            self.stats['mongo_modified'] += details.get('nModified', 0)
+            inserted.update(upsert['index'] for upsert in details.get('upserted', []))
+            for error in details.get('writeErrors', []):
+                self.stats['mongo_errors'] += 1
+                failed.add(error['index'])
+                document = batch[error['index']][0]
+                logger.error("Error al guardar en MongoDB message_id %s (mailbox %s): %s", document['message_id'], document.get('mailbox_id'), error.get('errmsg'))
+        return failed, inserted
+
+    def _write_es(self, batch):
+        actions = (
+            {'_op_type': 'update', '_index': self.index_name, '_id': document['es_doc_id'], 'doc': es_doc, 'doc_as_upsert': True}
+            for document, es_doc, *_ in batch
+        )
+        for ok, item in helpers.streaming_bulk(self.es, actions, raise_on_error=False, raise_on_exception=False, max_retries=3):
+            if ok:
+                self.stats['es_indexed'] += 1
+                continue
+            self.stats['es_errors'] += 1
+            info = item.get('update', item)
+            logger.error("Error al indexar en Elasticsearch el documento %s: %s", info.get('_id'), info.get('error'))
+
+    def close(self):
+        """Vacía lo pendiente, detiene el vaciado periódico y devuelve las estadísticas."""
+        self._closed.set()
+        if self._timer:
+            self._timer.join()
+        self.flush()
+        logger.info("Escritura en bloque finalizada: %s", self.stats)
+        return dict(self.stats)
@@ -1,8 +1,11 @@
 import logging
 from logging import handlers
-from pymongo import MongoClient, ASCENDING
-from config import MONGO_URI, MONGO_DB_NAME, MONGO_EMAILS_COLLECTION, MONGO_TODOS_COLLECTION, MONGO_USERS_COLLECTION
+from pymongo import MongoClient
+from config import MONGO_URI, MONGO_DB_NAME, MONGO_EMAILS_COLLECTION, MONGO_TODOS_COLLECTION, MONGO_USERS_COLLECTION, MONGO_THREADS_COLLECTION
 from services.cache_service import get_cached_result, cache_result
+from services.index_manager_service import ensure_indexes
+from services.email_fields import normalize_subject, DIRECTION_INBOUND, DIRECTION_OUTBOUND, DIRECTION_INTERNAL
+from services.thread_store_service import get_thread
 from datetime import datetime, timedelta
 import re
 import base64
@@ -29,31 +32,14 @@ db = client[MONGO_DB_NAME]
 emails_collection = db[MONGO_EMAILS_COLLECTION]
 todos_collection = db[MONGO_TODOS_COLLECTION]
 users_collection = db[MONGO_USERS_COLLECTION]
+threads_collection = db[MONGO_THREADS_COLLECTION]
 
-# Función para verificar y crear índices en todos_collection
-def ensure_todos_indexes():
-    """Verifica y crea índices necesarios en la colección todos_collection."""
-    indexes = todos_collection.list_indexes()
-    index_names = [index['name'] for index in indexes]
+# Las notas a uno mismo (internal) cuentan como recibidas y como enviadas
+RECEIVED_DIRECTIONS = [DIRECTION_INBOUND, DIRECTION_INTERNAL]
+SENT_DIRECTIONS = [DIRECTION_OUTBOUND, DIRECTION_INTERNAL]
 
-    if 'username_1' not in index_names:
-        todos_collection.create_index([('username', ASCENDING)], name='username_1')
-        logger.info("Índice 'username_1' creado en todos_collection")
-
-    if 'completed_1' not in index_names:
-        todos_collection.create_index([('completed', ASCENDING)], name='completed_1')
-        logger.info("Índice 'completed_1' creado en todos_collection")
-
-    if 'mailbox_id_1' not in index_names:
-        todos_collection.create_index([('mailbox_id', ASCENDING)], name='mailbox_id_1')
-        logger.info("Índice 'mailbox_id_1' creado en todos_collection")
-
-    if 'date_1' not in index_names:
-        todos_collection.create_index([('date', ASCENDING)], name='date_1')
-        logger.info("Índice 'date_1' creado en todos_collection")
-
-# Llamar a la función para asegurarse de que los índices existan
-ensure_todos_indexes()
+# Asegurarse de que existan los índices de todos_collection declarados en config.INDEXES
+ensure_indexes(db, [MONGO_TODOS_COLLECTION])
 
 def extract_email(text):
     """Extract email address from a string using regex."""
@@ -150,11 +136,8 @@ def get_dashboard_metrics():
             # Base match criteria for received emails with date filter
             base_match_received = {
                 'mailbox_id': {'$in': user_mailboxes},
-                'to': {'$regex': '|'.join([f'\\b{re.escape(mailbox)}\\b' for mailbox in user_mailboxes]), '$options': 'i'},
-                'date': {'$ne': 'unknown'},  # Excluir fechas inválidas
-                '$expr': {
-                    '$gte': [{'$toDate': '$date'}, start_date]
-                }
+                'direction': {'$in': RECEIVED_DIRECTIONS},
+                'date_ts': {'$gte': start_date}  # Índice (mailbox_id, direction, date_ts); excluye fechas inválidas
             }
 
             # Contar documentos con fecha inválida para received
@@ -171,11 +154,8 @@ def get_dashboard_metrics():
             # Base match criteria for sent emails with date filter
             base_match_sent = {
                 'mailbox_id': {'$in': user_mailboxes},
-                'from': {'$regex': '|'.join([f'\\b{re.escape(mailbox)}\\b' for mailbox in user_mailboxes]), '$options': 'i'},
-                'date': {'$ne': 'unknown'},  # Excluir fechas inválidas
-                '$expr': {
-                    '$gte': [{'$toDate': '$date'}, start_date]
-                }
+                'direction': {'$in': SENT_DIRECTIONS},
+                'date_ts': {'$gte': start_date}
             }
 
             # Contar documentos con fecha inválida para sent
@@ -191,7 +171,6 @@ def get_dashboard_metrics():
 
             # Top 10 senders with date filter
             senders_pipeline = [
-                {'$match': {'date': {'$ne': 'unknown'}}},  # Excluir fechas inválidas
                 {'$match': base_match_received},
                 {'$group': {
                     '_id': {
@@ -216,7 +195,6 @@ def get_dashboard_metrics():
 
             # Top 10 recipients with date filter
             recipients_pipeline = [
-                {'$match': {'date': {'$ne': 'unknown'}}},  # Excluir fechas inválidas
                 {'$match': base_match_sent},
                 {'$project': {
                     'to_array': {'$split': ['$to', ',']},
@@ -325,38 +303,35 @@ def get_email_list(metric, period, sender=None, recipient=None, raw_body=None):
 
         match_criteria = {
             'mailbox_id': {'$in': user_mailboxes},
-            'date': {'$ne': 'unknown'},  # Excluir fechas inválidas
-            '$expr': {
-                '$gte': [{'$toDate': '$date'}, start_date]
-            }
+            'date_ts': {'$gte': start_date}  # Excluye también las fechas inválidas (date_ts None)
         }
 
         if sender:
             formatted_sender = format_email_field_with_fallback(sender, '')
             email_only = extract_email(sender) or ''
-            match_criteria['to'] = {'$regex': '|'.join([f'\\b{re.escape(mailbox)}\\b' for mailbox in user_mailboxes]), '$options': 'i'}
-            match_criteria['from'] = {
-                '$regex': f'^{re.escape(formatted_sender)}$|^{re.escape(email_only)}$',
-                '$options': 'i'
-            }
+            match_criteria['direction'] = {'$in': RECEIVED_DIRECTIONS}
+            if email_only:
+                match_criteria['from_addr'] = email_only.lower()
+            else:
+                match_criteria['from'] = {'$regex': f'^{re.escape(formatted_sender)}$', '$options': 'i'}
             logger.debug("Sender filter applied: formatted=%s, email=%s", formatted_sender, email_only)
         elif recipient:
             formatted_recipient = format_email_field_with_fallback(recipient, '')
             email_only = extract_email(recipient) or ''
-            match_criteria['from'] = {'$regex': '|'.join([f'\\b{re.escape(mailbox)}\\b' for mailbox in user_mailboxes]), '$options': 'i'}
-            match_criteria['to'] = {
-                '$regex': f'^{re.escape(formatted_recipient)}$|^{re.escape(email_only)}$|.*, *{re.escape(formatted_recipient)}(?:,|$)|.*, *{re.escape(email_only)}(?:,|$)',
-                '$options': 'i'
-            }
+            match_criteria['direction'] = {'$in': SENT_DIRECTIONS}
+            if email_only:
+                # Multikey: cualquier correo que tenga la dirección entre sus destinatarios
+                match_criteria['to_addrs'] = email_only.lower()
+            else:
+                match_criteria['to'] = {'$regex': f'(?:^|, *){re.escape(formatted_recipient)}(?:,|$)', '$options': 'i'}
             logger.debug("Recipient filter applied: formatted=%s, email=%s", formatted_recipient, email_only)
         else:
-            if metric == 'received':
-                match_criteria['to'] = {'$regex': '|'.join([f'\\b{re.escape(mailbox)}\\b' for mailbox in user_mailboxes]), '$options': 'i'}
-            elif metric == 'sent':
-                match_criteria['from'] = {'$regex': '|'.join([f'\\b{re.escape(mailbox)}\\b' for mailbox in user_mailboxes]), '$options': 'i'}
+            if metric == 'sent':
+                match_criteria['direction'] = {'$in': SENT_DIRECTIONS}
             else:
-                match_criteria['to'] = {'$regex': '|'.join([f'\\b{re.escape(mailbox)}\\b' for mailbox in user_mailboxes]), '$options': 'i'}
-                match_criteria[metric] = True
+                match_criteria['direction'] = {'$in': RECEIVED_DIRECTIONS}
+                if metric != 'received':
+                    match_criteria[metric] = True
 
         logger.debug("Final match criteria: %s", match_criteria)
 
@@ -486,7 +461,12 @@ def get_thread_emails(todo_id):
         
         # Intentar obtener el hilo completo
         thread_emails = []
-        if email and email.get('parent_thread_id'):
+        thread = get_thread(threads_collection, email.get('parent_thread_id'), email.get('mailbox_id')) if email else None
+        if thread:
+            # Hilo materializado: sus message_ids se buscan por el índice de message_id
+            match_criteria = {'message_id': {'$in': thread['message_ids']}, 'date': {'$ne': 'unknown'}}  # Excluir fechas inválidas
+            logger.info(f"Using threads collection entry for parent_thread_id: {email['parent_thread_id']} ({thread.get('message_count', 0)} emails)")
+        elif email and email.get('parent_thread_id'):
             # Usar parent_thread_id para encontrar el hilo
             match_criteria = {'parent_thread_id': email['parent_thread_id'], 'date': {'$ne': 'unknown'}}  # Excluir fechas inválidas
             logger.info(f"Using parent_thread_id: {email['parent_thread_id']} to fetch thread")
@@ -533,11 +513,11 @@ def get_thread_emails(todo_id):
         logger.info(f"Found {len(thread_emails)} emails in initial thread search")
         
         # Si no se encuentra el hilo, intentar con coincidencia de asunto
-        if not thread_emails and email:
-            cleaned_subject = re.sub(r'^(Re:|Fwd:)\s*', '', email.get('subject', ''), flags=re.IGNORECASE).strip()
+        normalized_subject = (email.get('normalized_subject') or normalize_subject(email.get('subject', ''))) if email else ''
+        if not thread_emails and normalized_subject:
             match_criteria = {
-                'subject': {'$regex': f"^(Re:|Fwd:)?\s*{re.escape(cleaned_subject)}", '$options': 'i'},
                 'mailbox_id': todo['mailbox_id'],
+                'normalized_subject': normalized_subject,
                 'date': {'$ne': 'unknown'}  # Excluir fechas inválidas
             }
             pipeline[0] = {'$match': match_criteria}
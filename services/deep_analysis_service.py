@@ -1,9 +1,10 @@
 import logging
 from logging import handlers
 from pymongo import MongoClient
-from config import MONGO_URI, MONGO_DB_NAME, MONGO_EMAILS_COLLECTION
+from config import MONGO_URI, MONGO_DB_NAME, MONGO_EMAILS_COLLECTION, MONGO_ATTACHMENTS_COLLECTION
 from services.nlp_service import call_ollama_api, normalize_text
 from services.cache_service import get_cached_result, cache_result
+from services.attachment_store_service import load_attachment_texts
 import json
 from collections import defaultdict, Counter
 import time
@@ -27,6 +28,7 @@ logger.addHandler(console_handler)
 client = MongoClient(MONGO_URI)
 db = client[MONGO_DB_NAME]
 emails_collection = db[MONGO_EMAILS_COLLECTION]
+attachments_collection = db[MONGO_ATTACHMENTS_COLLECTION]
 themes_collection = db['themes']
 
 # In-memory context store with expiration
@@ -127,10 +129,12 @@ def aggregate_email_data(theme_ids, max_emails=5, prompt_terms=None, user=None):
                 'body': 1,
                 'summary': 1,
                 'attachments_content': 1,
+                'attachment_refs': 1,
                 'relevant_terms': 1,
                 '_id': 0
             }
         ))
+        load_attachment_texts(attachments_collection, emails)
 
         if not emails:
             logger.warning(f"No emails found for indices: {list(email_indices)} in user's mailboxes")
@@ -1,5 +1,5 @@
 from pymongo import MongoClient
-from config import MONGO_URI, MONGO_DB_NAME, MONGO_EMAILS_COLLECTION
+from config import MONGO_URI, MONGO_DB_NAME, MONGO_EMAILS_COLLECTION, MONGO_ATTACHMENTS_COLLECTION
 import uuid
 from datetime import datetime
 from typing import List, Dict, Any
@@ -7,6 +7,7 @@ import logging
 import re
 from services.nlp_service import normalize_text, call_ollama_api
 from services.cache_service import get_cached_result, cache_result
+from services.attachment_store_service import load_attachment_texts
 from collections import Counter, defaultdict
 import json
 import time
@@ -29,6 +30,7 @@ class DeepConversationAnalysisService:
         self.client = MongoClient(MONGO_URI)
         self.db = self.client[MONGO_DB_NAME]
         self.emails_collection = self.db[MONGO_EMAILS_COLLECTION]
+        self.attachments_collection = self.db[MONGO_ATTACHMENTS_COLLECTION]
         self.themes_collection = self.db['themes']
         self.sessions = {}  # In-memory session storage
         self.context_store = defaultdict(list)  # Context store for prompts
@@ -110,28 +112,11 @@ class DeepConversationAnalysisService:
                 {
                     '$match': {
                         '$or': [
-                            {
-                                'from': {'$regex': f'\\b{re.escape(email1_addr)}\\b', '$options': 'i'},
-                                'to': {'$regex': f'\\b{re.escape(email2_addr)}\\b', '$options': 'i'}
-                            },
-                            {
-                                'from': {'$regex': f'\\b{re.escape(email2_addr)}\\b', '$options': 'i'},
-                                'to': {'$regex': f'\\b{re.escape(email1_addr)}\\b', '$options': 'i'}
-                            }
+                            {'from_addr': email1_addr.lower(), 'to_addrs': email2_addr.lower()},
+                            {'from_addr': email2_addr.lower(), 'to_addrs': email1_addr.lower()}
                         ],
-                        'mailbox_id': {'$in': user_mailboxes}
-                    }
-                },
-                {
-                    '$addFields': {
-                        'parsedDate': {
-                            '$toDate': '$date'
-                        }
-                    }
-                },
-                {
-                    '$match': {
-                        'parsedDate': {
+                        'mailbox_id': {'$in': user_mailboxes},
+                        'date_ts': {
                             '$gte': start_dt,
                             '$lte': end_dt
                         }
@@ -148,7 +133,7 @@ class DeepConversationAnalysisService:
 
             pipeline.extend([
                 {
-                    '$sort': {'parsedDate': -1}
+                    '$sort': {'date_ts': -1}
                 },
                 {
                     '$project': {
@@ -317,10 +302,12 @@ Ejemplo de respuesta:
                     'body': 1,
                     'summary': 1,
                     'attachments_content': 1,
+                    'attachment_refs': 1,
                     'relevant_terms': 1,
                     '_id': 0
                 }
             ))
+            load_attachment_texts(self.attachments_collection, emails)
 
             if not emails:
                 logger.warning(f"No emails found for indices: {email_indices} in user's mailboxes")
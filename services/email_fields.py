@@ -0,0 +1,108 @@
+import re
+from datetime import datetime, timezone
+from email.utils import getaddresses
+
+# Prefijos de respuesta y reenvío en varios idiomas: "Re:", "RE[2]:", "Fwd:", "FW:", "RV:", "[FW]"...
+_SUBJECT_PREFIX = re.compile(
+    r'^\s*(?:(?:re|fwd?|rv|res|enc|tr|aw|wg)\s*(?:\[\d+\]|\(\d+\))?\s*:|\[(?:re|fwd?|rv)\])\s*',
+    re.IGNORECASE
+)
+
+
+def normalize_subject(subject):
+    """Normaliza el asunto para agrupar hilos: sin prefijos Re:/Fwd:/RV:/[FW], espacios colapsados y en minúsculas."""
+    if not subject or not isinstance(subject, str):
+        return ""
+    previous = None
+    while previous != subject:
+        previous = subject
+        subject = _SUBJECT_PREFIX.sub('', subject, count=1)
+    return re.sub(r'\s+', ' ', subject).strip().lower()
+
+
+_QUOTED_LINE = re.compile(r'^\s*>.*$', re.MULTILINE)
+_URL = re.compile(r'https?://\S+|www\.\S+', re.IGNORECASE)
+_DIGITS = re.compile(r'\d+')
+
+
+def normalize_body(body):
+    """Normaliza el cuerpo para comparar correos casi idénticos: sin líneas citadas, URLs ni cifras concretas."""
+    if not body or not isinstance(body, str):
+        return ""
+    body = _QUOTED_LINE.sub(' ', body)
+    body = _URL.sub(' url ', body)
+    body = _DIGITS.sub('0', body)
+    return re.sub(r'\s+', ' ', re.sub(r'[^\w\s]', ' ', body.lower())).strip()
+
+
+def email_date_ts(date):
+    """Fecha ISO 8601 del campo `date` como datetime en UTC (campo date_ts), o None si no es válida."""
+    if not date or not isinstance(date, str):
+        return None
+    try:
+        parsed = datetime.fromisoformat(date)
+    except ValueError:
+        return None
+    return parsed.astimezone(timezone.utc) if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+DIRECTION_INBOUND = 'inbound'
+DIRECTION_OUTBOUND = 'outbound'
+DIRECTION_INTERNAL = 'internal'
+
+
+def parse_addresses(header):
+    """Direcciones (en minúsculas) y nombres visibles de una cabecera From/To/Cc, en el mismo orden."""
+    if not header:
+        return [], []
+    addresses, names = [], []
+    for name, address in getaddresses([str(header)]):
+        address = address.strip().lower()
+        if '@' in address and address not in addresses:
+            addresses.append(address)
+            names.append(name.strip())
+    return addresses, names
+
+
+def address_fields(from_, to, cc, own_address):
+    """Campos normalizados de remitente y destinatarios, y dirección del correo respecto al buzón.
+
+    direction es 'outbound' si lo envía el buzón, 'internal' si además solo va dirigido
+    al propio buzón (notas a uno mismo) e 'inbound' en el resto de casos.
+    """
+    from_addrs, from_names = parse_addresses(from_)
+    to_addrs, to_names = parse_addresses(to)
+    cc_addrs, cc_names = parse_addresses(cc)
+    from_addr = from_addrs[0] if from_addrs else ''
+    own = (own_address or '').lower()
+    if from_addr and from_addr == own:
+        recipients = to_addrs + cc_addrs
+        direction = DIRECTION_INTERNAL if recipients and all(address == own for address in recipients) else DIRECTION_OUTBOUND
+    else:
+        direction = DIRECTION_INBOUND
+    return {
+        'from_addr': from_addr,
+        'from_name': from_names[0] if from_names else '',
+        'to_addrs': to_addrs,
+        'to_names': to_names,
+        'cc_addrs': cc_addrs,
+        'cc_names': cc_names,
+        'direction': direction
+    }
+
+
+def header_value(headers, name):
+    """Valor de una cabecera sin distinguir mayúsculas (las de IMAP conservan las del mensaje)."""
+    name = name.lower()
+    return next((value for key, value in (headers or {}).items() if key.lower() == name), None)
+
+
+def header_from_text(headers_text, name):
+    """Valor de una cabecera en `headers_text` (líneas "Nombre: valor" de Gmail o lista de tuplas de IMAP)."""
+    if not headers_text:
+        return None
+    match = re.search(rf'^{re.escape(name)}:\s*(.*)$', headers_text, re.IGNORECASE | re.MULTILINE)
+    if match:
+        return match.group(1).strip()
+    match = re.search(rf"\('{re.escape(name)}',\s*(['\"])(.*?)\1\)", headers_text, re.IGNORECASE)
+    return match.group(2) if match else None
@@ -0,0 +1,62 @@
+import logging
+from logging import handlers
+import zlib
+import numpy as np
+from bson import Binary
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.embedding_service')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+
+def set_torch_threads(num_threads):
+    """Limita los hilos de torch en CPU (0 deja el valor por defecto de torch)."""
+    if not num_threads:
+        return
+    import torch
+    torch.set_num_threads(int(num_threads))
+    logger.info("Hilos de torch para embeddings: %d", int(num_threads))
+
+
+def compress_embedding(vector):
+    """Serializa un embedding en el formato guardado en MongoDB: float32 comprimido con zlib."""
+    return Binary(zlib.compress(np.asarray(vector, dtype=np.float32).tobytes()))
+
+
+def encode_texts(model, texts, batch_size=32, bucket_by_length=True):
+    """Codifica una lista de textos en lotes y devuelve un vector por texto (None si está vacío).
+
+    Con bucket_by_length los textos se ordenan por longitud antes de partirlos en lotes, de
+    modo que cada lote contiene textos de tamaño parecido y se desperdicia menos relleno.
+    """
+    vectors = [None] * len(texts)
+    positions = [i for i, text in enumerate(texts) if text]
+    if bucket_by_length:
+        positions.sort(key=lambda i: len(texts[i]))
+    for start in range(0, len(positions), batch_size):
+        batch = positions[start:start + batch_size]
+        encoded = model.encode([texts[i] for i in batch], batch_size=len(batch), convert_to_numpy=True, show_progress_bar=False)
+        for i, vector in zip(batch, encoded):
+            vectors[i] = vector
+    return vectors
+
+
+def generate_embeddings(model, texts, batch_size=32, bucket_by_length=True):
+    """Como encode_texts, pero devuelve los embeddings ya comprimidos para MongoDB.
+
+    Si falla la codificación se registra el error y los textos quedan sin embedding.
+    """
+    try:
+        vectors = encode_texts(model, texts, batch_size, bucket_by_length)
+    except Exception as e:
+        logger.error("Error al generar embeddings en lote para %d textos: %s", len(texts), str(e), exc_info=True)
+        return [None] * len(texts)
+    return [compress_embedding(vector) if vector is not None else None for vector in vectors]
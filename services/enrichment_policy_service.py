@@ -0,0 +1,193 @@
+import logging
+from logging import handlers
+import mimetypes
+import threading
+from email.utils import parseaddr
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.enrichment_policy_service')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+# Enriquecimientos que recibe un correo según su política
+POLICY_FULL = 'full'
+POLICY_REDUCED = 'reduced'
+POLICY_MINIMAL = 'minimal'
+POLICIES = {
+    POLICY_FULL: {'llm': True, 'ocr': True},
+    # Probablemente masivo: resumen con LLM, pero sin OCR de imágenes
+    POLICY_REDUCED: {'llm': True, 'ocr': False},
+    # Boletines y promociones: sin LLM ni OCR
+    POLICY_MINIMAL: {'llm': False, 'ocr': False}
+}
+
+_BULK_PRECEDENCE = {'bulk', 'list', 'junk'}
+
+
+def is_image(filename):
+    return (mimetypes.guess_type(filename or '')[0] or '').startswith('image/')
+
+
+def sender_address(from_):
+    return parseaddr(from_ or '')[1].lower()
+
+
+def score_email(headers, from_, body, own_address, sender_history=None, ad_probability=None, priority_senders=(), large_body_chars=50000):
+    """Puntuación de valor de un correo y motivos: negativa para correo masivo, positiva para correo personal.
+
+    sender_history es {'count': correos previos del remitente, 'ads': cuántos eran publicidad}.
+    """
+    headers = {name.lower(): str(value) for name, value in (headers or {}).items()}
+    sender = sender_address(from_)
+    score, reasons = 0, []
+
+    if 'list-unsubscribe' in headers or 'list-id' in headers:
+        score -= 2
+        reasons.append('lista_distribucion')
+    if headers.get('precedence', '').strip().lower() in _BULK_PRECEDENCE:
+        score -= 2
+        reasons.append('precedence_bulk')
+    if headers.get('auto-submitted', 'no').strip().lower() != 'no':
+        score -= 1
+        reasons.append('auto_submitted')
+    if sender_history and sender_history.get('count', 0) >= 5:
+        ad_share = sender_history.get('ads', 0) / sender_history['count']
+        if ad_share >= 0.8:
+            score -= 2
+            reasons.append('remitente_publicitario')
+        elif ad_share <= 0.2:
+            score += 1
+            reasons.append('remitente_habitual')
+    if ad_probability is not None and ad_probability >= 0.9:
+        score -= 2
+        reasons.append('clasificador_publicidad')
+    if len(body or '') > large_body_chars:
+        score -= 1
+        reasons.append('cuerpo_grande')
+
+    if own_address and sender == own_address.lower():
+        score += 3
+        reasons.append('enviado_por_el_buzon')
+    if any(priority in sender for priority in priority_senders):
+        score += 3
+        reasons.append('remitente_cualificado')
+    if 'high' in headers.get('x-priority', '').lower() or 'high' in headers.get('importance', '').lower():
+        score += 2
+        reasons.append('prioridad_alta')
+    return score, reasons
+
+
+def advertisement_signal(headers, reasons):
+    """Publicidad según señales reales: cabecera List-Unsubscribe o el modelo bayesiano ('clasificador_publicidad')."""
+    headers = {name.lower() for name in (headers or {})}
+    return 'list-unsubscribe' in headers or 'clasificador_publicidad' in reasons
+
+
+class EnrichmentBudget:
+    """Presupuesto de coste de una ejecución: segundos de LLM y páginas de OCR (None = sin límite)."""
+
+    def __init__(self, llm_seconds=None, ocr_pages=None):
+        self.limits = {'llm_seconds': llm_seconds or None, 'ocr_pages': ocr_pages or None}
+        self.spent = {'llm_seconds': 0.0, 'ocr_pages': 0}
+        self._lock = threading.Lock()
+
+    def exhausted(self, resource):
+        with self._lock:
+            limit = self.limits[resource]
+            return limit is not None and self.spent[resource] >= limit
+
+    def try_take(self, resource, amount):
+        """Reserva amount si cabe en el presupuesto; devuelve si se ha podido."""
+        with self._lock:
+            limit = self.limits[resource]
+            if limit is not None and self.spent[resource] + amount > limit:
+                return False
+            self.spent[resource] += amount
+            return True
+
+    def charge(self, resource, amount):
+        """Anota un coste ya incurrido (por ejemplo, el tiempo real de una llamada al LLM)."""
+        with self._lock:
+            self.spent[resource] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                resource: {'spent': round(self.spent[resource], 2), 'limit': self.limits[resource]}
+                for resource in self.limits
+            }
+
+
+class EnrichmentPolicyEngine:
+    """Decide qué enriquecimientos recibe cada correo de una ejecución.
+
+    Con la puntuación de score_email: por debajo de minimal_below el correo no pasa por
+    el LLM ni por el OCR, por debajo de reduced_below se omite el OCR, y el
+    resto recibe el tratamiento completo. Las páginas de OCR se reservan del presupuesto
+    al decidir; los segundos de LLM se descuentan al llamar al LLM (charge_llm).
+    """
+
+    def __init__(self, own_address, sender_history=None, ad_probability=None, priority_senders=(), budget=None,
+                 minimal_below=-3, reduced_below=0, large_body_chars=50000):
+        self.own_address = own_address
+        self.sender_history = sender_history or {}
+        self.ad_probability = ad_probability
+        self.priority_senders = tuple(priority_senders)
+        self.budget = budget or EnrichmentBudget()
+        self.minimal_below = minimal_below
+        self.reduced_below = reduced_below
+        self.large_body_chars = large_body_chars
+        self._lock = threading.Lock()
+        self.counters = {policy: 0 for policy in POLICIES}
+        self.counters.update({'skipped_llm': 0, 'skipped_ocr': 0, 'budget_llm': 0, 'budget_ocr': 0})
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def decide(self, record, image_count=0):
+        """Devuelve (política, {enriquecimiento: bool}, puntuación, motivos) para un correo parseado."""
+        text = f"{record.get('subject', '')} {record.get('body', '')}"
+        score, reasons = score_email(
+            record.get('headers'), record.get('from'), record.get('body'), self.own_address,
+            self.sender_history.get(sender_address(record.get('from'))),
+            self.ad_probability(text) if self.ad_probability else None,
+            self.priority_senders, self.large_body_chars
+        )
+        if score < self.minimal_below:
+            policy = POLICY_MINIMAL
+        elif score < self.reduced_below:
+            policy = POLICY_REDUCED
+        else:
+            policy = POLICY_FULL
+        enrichments = dict(POLICIES[policy])
+        self._count(policy)
+        if enrichments['ocr'] and image_count and not self.budget.try_take('ocr_pages', image_count):
+            enrichments['ocr'] = False
+            self._count('budget_ocr')
+        if not enrichments['llm']:
+            self._count('skipped_llm')
+        if not enrichments['ocr'] and image_count:
+            self._count('skipped_ocr')
+        return policy, enrichments, score, reasons
+
+    def llm_allowed(self):
+        if self.budget.exhausted('llm_seconds'):
+            self._count('budget_llm')
+            return False
+        return True
+
+    def charge_llm(self, seconds):
+        self.budget.charge('llm_seconds', seconds)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return {'counters': counters, 'budget': self.budget.snapshot()}
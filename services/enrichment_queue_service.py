@@ -0,0 +1,160 @@
+import logging
+from logging import handlers
+import uuid
+from datetime import datetime, timezone, timedelta
+from pymongo import UpdateOne
+from elasticsearch import helpers
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.enrichment_queue_service')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+# Estado del enriquecimiento con LLM en los correos (campo `enrichment_status`):
+#   pending    guardado y buscable por sus campos en bruto, falta el enriquecimiento
+#   processing reclamado por un worker (enrichment_claim, enrichment_claimed_at)
+#              Mientras está en la cola, `enrichment_headers` guarda las cabeceras que
+#              usan las clasificaciones (X-Priority, Importance).
+#   done       resumen, términos, dominio y clasificaciones completos
+#   failed     se agotaron los intentos (enrichment_attempts)
+#   skipped    la política de enriquecimiento decidió no pasarlo por el LLM (enrichment_policy);
+#              solo lleva `advertisement`, calculado con señales reales
+# Los correos anteriores a la cola no tienen el campo y se consideran completos.
+STATUS_PENDING = 'pending'
+STATUS_PROCESSING = 'processing'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+STATUS_SKIPPED = 'skipped'
+
+
+def _claimable(mailbox_id, claim_timeout, max_attempts):
+    stale = datetime.now(timezone.utc) - timedelta(seconds=claim_timeout)
+    query = {
+        '$or': [
+            {'enrichment_status': STATUS_PENDING},
+            # Reclamados por un worker que murió o se quedó colgado
+            {'enrichment_status': STATUS_PROCESSING, 'enrichment_claimed_at': {'$lt': stale}}
+        ],
+        'enrichment_attempts': {'$not': {'$gte': max_attempts}}
+    }
+    if mailbox_id:
+        query['mailbox_id'] = mailbox_id
+    return query
+
+
+def claim_pending(emails_collection, mailbox_id=None, limit=20, claim_timeout=1800, max_attempts=3, projection=None):
+    """Reclama hasta limit correos pendientes y los devuelve.
+
+    El reclamo se marca con un identificador único, de modo que varios procesos pueden
+    vaciar la cola a la vez sin enriquecer dos veces el mismo correo.
+    """
+    query = _claimable(mailbox_id, claim_timeout, max_attempts)
+    candidate_ids = [doc['_id'] for doc in emails_collection.find(query, {'_id': 1}).limit(limit)]
+    if not candidate_ids:
+        return []
+    claim = uuid.uuid4().hex
+    emails_collection.update_many(
+        {'_id': {'$in': candidate_ids}, **query},
+        {
+            '$set': {'enrichment_status': STATUS_PROCESSING, 'enrichment_claim': claim, 'enrichment_claimed_at': datetime.now(timezone.utc)},
+            '$inc': {'enrichment_attempts': 1}
+        }
+    )
+    return list(emails_collection.find({'enrichment_claim': claim}, projection))
+
+
+def complete_enrichments(emails_collection, es, results, index_name='email_index'):
+    """Guarda el enriquecimiento de los correos y actualiza parcialmente sus documentos de Elasticsearch.
+
+    results son diccionarios con _id, es_doc_id (opcional), updates (campos para MongoDB)
+    y es_updates (campos para Elasticsearch). Devuelve el número de correos completados.
+    """
+    if not results:
+        return 0
+    now = datetime.now(timezone.utc)
+    operations = [
+        UpdateOne(
+            {'_id': result['_id']},
+            {
+                '$set': {**result['updates'], 'enrichment_status': STATUS_DONE, 'enriched_at': now},
+                '$unset': {'enrichment_claim': '', 'enrichment_claimed_at': '', 'enrichment_headers': ''}
+            }
+        )
+        for result in results
+    ]
+    written = emails_collection.bulk_write(operations, ordered=False)
+
+    # Actualización parcial: el resto del documento de Elasticsearch ya se indexó en la ingestión
+    actions = (
+        {'_op_type': 'update', '_index': index_name, '_id': result['es_doc_id'], 'doc': result['es_updates']}
+        for result in results if result.get('es_doc_id')
+    )
+    errors = 0
+    for ok, item in helpers.streaming_bulk(es, actions, raise_on_error=False, raise_on_exception=False, max_retries=3):
+        if not ok:
+            errors += 1
+            info = item.get('update', item)
+            logger.error("Error al actualizar en Elasticsearch el documento %s: %s", info.get('_id'), info.get('error'))
+    logger.debug("Enriquecimiento guardado: %d correos, %d errores en Elasticsearch", written.modified_count, errors)
+    return written.modified_count
+
+
+def release_claims(emails_collection, ids):
+    """Devuelve a la cola correos reclamados que no se llegaron a enriquecer, sin gastar un intento."""
+    if not ids:
+        return 0
+    result = emails_collection.update_many(
+        {'_id': {'$in': list(ids)}, 'enrichment_status': STATUS_PROCESSING},
+        {'$set': {'enrichment_status': STATUS_PENDING}, '$unset': {'enrichment_claim': '', 'enrichment_claimed_at': ''}, '$inc': {'enrichment_attempts': -1}}
+    )
+    return result.modified_count
+
+
+def fail_claims(emails_collection, ids, max_attempts):
+    """Devuelve a la cola correos cuyo enriquecimiento falló (LLM caído o respuesta no válida).
+
+    A diferencia de release_claims el intento cuenta: los que ya agotaron max_attempts
+    quedan como failed. Devuelve el número de correos que pasan a failed.
+    """
+    if not ids:
+        return 0
+    claimed = {'_id': {'$in': list(ids)}, 'enrichment_status': STATUS_PROCESSING}
+    unset = {'enrichment_claim': '', 'enrichment_claimed_at': ''}
+    exhausted = emails_collection.update_many(
+        {**claimed, 'enrichment_attempts': {'$gte': max_attempts}},
+        {'$set': {'enrichment_status': STATUS_FAILED}, '$unset': unset}
+    )
+    emails_collection.update_many(claimed, {'$set': {'enrichment_status': STATUS_PENDING}, '$unset': unset})
+    if exhausted.modified_count:
+        logger.warning("%d correos marcados como failed tras %d intentos de enriquecimiento", exhausted.modified_count, max_attempts)
+    return exhausted.modified_count
+
+
+def mark_exhausted(emails_collection, max_attempts, claim_timeout=1800):
+    """Pasa a failed los correos cuyo último intento permitido caducó sin completarse."""
+    stale = datetime.now(timezone.utc) - timedelta(seconds=claim_timeout)
+    result = emails_collection.update_many(
+        {'enrichment_status': STATUS_PROCESSING, 'enrichment_claimed_at': {'$lt': stale}, 'enrichment_attempts': {'$gte': max_attempts}},
+        {'$set': {'enrichment_status': STATUS_FAILED}, '$unset': {'enrichment_claim': '', 'enrichment_claimed_at': ''}}
+    )
+    if result.modified_count:
+        logger.warning("%d correos marcados como failed tras %d intentos de enriquecimiento", result.modified_count, max_attempts)
+    return result.modified_count
+
+
+def enrichment_backlog(emails_collection, mailbox_id=None):
+    """Número de correos pendientes, en curso y fallidos de la cola de enriquecimiento."""
+    match = {'enrichment_status': {'$in': [STATUS_PENDING, STATUS_PROCESSING, STATUS_FAILED]}}
+    if mailbox_id:
+        match['mailbox_id'] = mailbox_id
+    return {
+        doc['_id']: doc['count']
+        for doc in emails_collection.aggregate([{'$match': match}, {'$group': {'_id': '$enrichment_status', 'count': {'$sum': 1}}}])
+    }
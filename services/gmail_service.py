@@ -3,12 +3,15 @@ from googleapiclient.errors import HttpError
 from email.mime.text import MIMEText
 import base64
 import re
+import random
+import time
 import logging
+from logging import handlers
 
 # Configuración del logging
 logger = logging.getLogger('email_search_app.gmail_service')
 logger.setLevel(logging.DEBUG)
-file_handler = logging.handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
 file_handler.setLevel(logging.DEBUG)
 file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
 console_handler = logging.StreamHandler()
@@ -69,4 +72,71 @@ def create_draft(service, user_id, email, proposed_action, metadata=None):
         raise
     except Exception as e:
         logger.error(f"Error inesperado al crear el borrador: {str(e)}", exc_info=True)
-        raise
\ No newline at end of file
+        raise
+
+# Códigos de error de Gmail que se reintentan con espera exponencial
+RETRYABLE_STATUS = {429, 500, 503}
+# Gmail admite hasta 100 peticiones por lote HTTP
+MAX_BATCH_SIZE = 100
+
+def batch_get_messages(service, message_ids, format='full', metadata_headers=None, batch_size=50, max_retries=5, base_delay=2):
+    """Obtiene mensajes de Gmail agrupando las peticiones `messages.get` en lotes HTTP.
+
+    Devuelve un diccionario {id de Gmail: mensaje}. Las subpeticiones que fallan con
+    429/500/503 se reintentan de forma individual en lotes posteriores con espera
+    exponencial; el resto de errores se registran y el mensaje se omite. Un 401 en
+    cualquier subpetición se propaga para que el llamante renueve las credenciales.
+    """
+    batch_size = max(1, min(int(batch_size), MAX_BATCH_SIZE))
+    results = {}
+    pending = list(dict.fromkeys(message_ids))
+    attempt = 0
+
+    while pending:
+        retry_ids = []
+        auth_errors = []
+
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    results[request_id] = response
+                    return
+                status = getattr(getattr(exception, 'resp', None), 'status', None)
+                if status == 401:
+                    auth_errors.append(exception)
+                elif status in RETRYABLE_STATUS:
+                    retry_ids.append(request_id)
+                else:
+                    logger.error(f"Error al obtener el mensaje {request_id} en lote: {exception}")
+
+            batch = service.new_batch_http_request(callback=callback)
+            for message_id in chunk:
+                kwargs = {'userId': 'me', 'id': message_id, 'format': format}
+                if format == 'metadata' and metadata_headers:
+                    kwargs['metadataHeaders'] = metadata_headers
+                batch.add(service.users().messages().get(**kwargs), request_id=message_id)
+            try:
+                batch.execute()
+            except HttpError as e:
+                if e.resp.status not in RETRYABLE_STATUS:
+                    raise
+                logger.warning(f"Error {e.resp.status} en la petición de lote, se reintentarán {len(chunk)} mensajes")
+                retry_ids.extend(chunk)
+
+        if auth_errors:
+            raise auth_errors[0]
+        if not retry_ids:
+            break
+
+        attempt += 1
+        if attempt > max_retries:
+            logger.error(f"Agotados los reintentos para {len(retry_ids)} mensajes en lote")
+            break
+        delay = min(base_delay * 2 ** (attempt - 1), 32)
+        logger.warning(f"Reintentando {len(retry_ids)} mensajes en lote tras {delay} segundos (intento {attempt})")
+        time.sleep(delay + random.uniform(0, 0.1 * delay))
+        pending = list(dict.fromkeys(retry_ids))
+
+    return results
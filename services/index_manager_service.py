@@ -0,0 +1,218 @@
+import logging
+from logging import handlers
+from datetime import datetime, timedelta
+from pymongo.errors import OperationFailure
+from config import (
+    INDEXES, MONGO_EMAILS_COLLECTION, MONGO_THREADS_COLLECTION, MONGO_SENDER_STATS_COLLECTION, MONGO_TODOS_COLLECTION,
+    MONGO_THEMES_COLLECTION, MONGO_FEEDBACK_COLLECTION, MONGO_USERS_COLLECTION
+)
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.index_manager_service')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+
+def _same_keys(existing, keys):
+    # Un índice de texto guarda su clave como {'_fts': 'text', '_ftsx': 1}, y solo puede haber uno por colección
+    if any(direction == 'text' for _, direction in keys):
+        return existing.get('key', {}).get('_fts') == 'text'
+    return list(existing.get('key', {}).items()) == [(field, direction) for field, direction in keys]
+
+
+def _same_definition(existing, definition):
+    """Compara las opciones que cambian el comportamiento del índice (no las de construcción)."""
+    text_fields = [field for field, direction in definition['keys'] if direction == 'text']
+    if text_fields:
+        weights = definition.get('weights') or {field: 1 for field in text_fields}
+        if dict(existing.get('weights', {})) != weights:
+            return False
+        if existing.get('default_language', 'english') != definition.get('default_language', 'english'):
+            return False
+    for option in ('unique', 'sparse'):
+        if bool(existing.get(option)) != bool(definition.get(option)):
+            return False
+    for option in ('partialFilterExpression', 'expireAfterSeconds'):
+        if existing.get(option) != definition.get(option):
+            return False
+    return True
+
+
+def index_status(db, collections=None, spec=None):
+    """Compara los índices declarados con los existentes, por colección.
+
+    Devuelve {colección: {'present': [...], 'missing': [...], 'renamed': {declarado: existente},
+    'changed': {declarado: existente}, 'extra': [...]}}; 'renamed' son índices con las mismas claves
+    pero otro nombre (no se vuelven a crear) y 'changed' los que existen, con ese nombre o con las
+    mismas claves, pero cuya definición (campos de texto, unique, sparse, filtro parcial...) difiere.
+    """
+    spec = spec or INDEXES
+    status = {}
+    for collection_name in collections or spec:
+        declared = spec.get(collection_name, {})
+        existing = [index for index in db[collection_name].list_indexes() if index['name'] != '_id_']
+        existing_names = {index['name'] for index in existing}
+        entry = {'present': [], 'missing': [], 'renamed': {}, 'changed': {}, 'extra': []}
+        matched = set()
+        for name, definition in declared.items():
+            current = next((index for index in existing if index['name'] == name), None)
+            if current is None:
+                current = next((index for index in existing if _same_keys(index, definition['keys'])), None)
+            if current is None:
+                entry['missing'].append(name)
+                continue
+            matched.add(current['name'])
+            if not (_same_keys(current, definition['keys']) and _same_definition(current, definition)):
+                entry['changed'][name] = current['name']
+            elif current['name'] == name:
+                entry['present'].append(name)
+            else:
+                entry['renamed'][name] = current['name']
+        entry['extra'] = sorted(existing_names - matched)
+        status[collection_name] = entry
+    return status
+
+
+def ensure_indexes(db, collections=None, spec=None, dry_run=False):
+    """Crea los índices declarados que faltan y devuelve sus nombres por colección.
+
+    Un índice cuya definición ha cambiado se elimina y se vuelve a crear; solo ese, el
+    resto de índices de la colección no se tocan. Se piden con background=True: en MongoDB
+    anteriores a 4.2 no bloquean la colección mientras se construyen; a partir de 4.2 todas
+    las construcciones son así y la opción se ignora. Un índice que no se puede crear (por
+    ejemplo, unique con duplicados) se registra como error y no impide crear el resto.
+    """
+    spec = spec or INDEXES
+    created = {}
+    for collection_name, entry in index_status(db, collections, spec).items():
+        for declared, existing in entry['renamed'].items():
+            logger.warning("Índice %s.%s ya existe con el nombre %s; no se crea de nuevo", collection_name, declared, existing)
+        pending = list(entry['missing'])
+        for declared, existing in entry['changed'].items():
+            if dry_run:
+                logger.info("[DRY RUN] Se eliminaría el índice %s.%s para recrearlo como %s", collection_name, existing, declared)
+                pending.append(declared)
+                continue
+            try:
+                db[collection_name].drop_index(existing)
+            except OperationFailure as e:
+                logger.error("No se pudo eliminar el índice %s.%s: %s", collection_name, existing, e)
+                continue
+            logger.warning("Índice %s.%s eliminado: su definición no coincide con la declarada en %s", collection_name, existing, declared)
+            pending.append(declared)
+        for name in pending:
+            definition = dict(spec[collection_name][name])
+            keys = definition.pop('keys')
+            if dry_run:
+                logger.info("[DRY RUN] Se crearía el índice %s.%s: %s", collection_name, name, keys)
+                created.setdefault(collection_name, []).append(name)
+                continue
+            try:
+                db[collection_name].create_index(keys, name=name, background=True, **definition)
+            except OperationFailure as e:
+                logger.error("No se pudo crear el índice %s.%s: %s", collection_name, name, e)
+                continue
+            logger.info("Índice %s.%s creado", collection_name, name)
+            created.setdefault(collection_name, []).append(name)
+    return created
+
+
+# Formas representativas de las consultas frecuentes de la aplicación, con valores de ejemplo.
+# El planificador elige el plan por la forma del filtro, así que sirven aunque no existan esos valores.
+_MAILBOXES = ['auditoria@example.com']
+_SINCE = datetime(2000, 1, 1)
+QUERY_SHAPES = [
+    {'name': 'correos por index o message_id (análisis, hilos)', 'collection': MONGO_EMAILS_COLLECTION,
+     'filter': {'$or': [{'index': {'$in': ['x']}}, {'message_id': {'$in': ['x']}}], 'mailbox_id': {'$in': _MAILBOXES}}},
+    {'name': 'correo por message_id', 'collection': MONGO_EMAILS_COLLECTION, 'filter': {'message_id': 'x'}},
+    {'name': 'correo por index del buzón', 'collection': MONGO_EMAILS_COLLECTION,
+     'filter': {'index': 'x', 'mailbox_id': {'$in': _MAILBOXES}}},
+    {'name': 'correos de un hilo', 'collection': MONGO_EMAILS_COLLECTION, 'filter': {'parent_thread_id': 'x'}},
+    {'name': 'respuestas a un correo', 'collection': MONGO_EMAILS_COLLECTION, 'filter': {'in_reply_to': 'x'}},
+    {'name': 'hilo sin parent_thread_id (todo)', 'collection': MONGO_EMAILS_COLLECTION,
+     'filter': {'$or': [{'message_id': 'x'}, {'in_reply_to': 'x'}], 'mailbox_id': _MAILBOXES[0], 'date': {'$ne': 'unknown'}}},
+    {'name': 'hilo por asunto normalizado', 'collection': MONGO_EMAILS_COLLECTION,
+     'filter': {'mailbox_id': _MAILBOXES[0], 'normalized_subject': 'x'}},
+    {'name': 'dashboard: recibidos con clasificación', 'collection': MONGO_EMAILS_COLLECTION,
+     'filter': {'mailbox_id': {'$in': _MAILBOXES}, 'direction': {'$in': ['inbound', 'internal']}, 'date_ts': {'$gte': _SINCE}, 'urgent': True}},
+    {'name': 'dashboard: correos de un remitente', 'collection': MONGO_EMAILS_COLLECTION,
+     'filter': {'mailbox_id': {'$in': _MAILBOXES}, 'date_ts': {'$gte': _SINCE}, 'direction': {'$in': ['inbound', 'internal']}, 'from_addr': 'x@example.com'}},
+    {'name': 'dashboard: correos a un destinatario', 'collection': MONGO_EMAILS_COLLECTION,
+     'filter': {'mailbox_id': {'$in': _MAILBOXES}, 'date_ts': {'$gte': _SINCE}, 'direction': {'$in': ['outbound', 'internal']}, 'to_addrs': 'x@example.com'}},
+    {'name': 'conversación entre dos direcciones', 'collection': MONGO_EMAILS_COLLECTION,
+     'filter': {'mailbox_id': {'$in': _MAILBOXES}, '$or': [{'from_addr': 'a@example.com', 'to_addrs': 'b@example.com'}, {'from_addr': 'b@example.com', 'to_addrs': 'a@example.com'}],
+                'date_ts': {'$gte': _SINCE, '$lte': _SINCE + timedelta(days=365)}},
+     'sort': [('date_ts', -1)]},
+    {'name': 'AGATTA: correos que requieren respuesta', 'collection': MONGO_EMAILS_COLLECTION,
+     'filter': {'date_ts': {'$gte': _SINCE}, 'requires_response': True, 'completed': {'$ne': True}, 'mailbox_id': _MAILBOXES[0], 'advertisement': {'$ne': True}}},
+    {'name': 'cola de enriquecimiento', 'collection': MONGO_EMAILS_COLLECTION,
+     'filter': {'$or': [{'enrichment_status': 'pending'}, {'enrichment_status': 'processing', 'enrichment_claimed_at': {'$lt': _SINCE}}],
+                'enrichment_attempts': {'$not': {'$gte': 3}}, 'mailbox_id': _MAILBOXES[0]}},
+    {'name': 'casi duplicados por bandas SimHash', 'collection': MONGO_EMAILS_COLLECTION,
+     'filter': {'mailbox_id': _MAILBOXES[0], 'simhash_bands': {'$in': [1, 2, 3, 4]}}},
+    {'name': 'correos enviados de la última sincronización', 'collection': MONGO_EMAILS_COLLECTION,
+     'filter': {'mailbox_id': _MAILBOXES[0], 'direction': 'outbound', 'message_id': {'$in': ['x']}}},
+    {'name': 'hilo materializado', 'collection': MONGO_THREADS_COLLECTION,
+     'filter': {'parent_thread_id': 'x', 'mailbox_id': _MAILBOXES[0]}},
+    {'name': 'remitentes principales', 'collection': MONGO_SENDER_STATS_COLLECTION,
+     'filter': {'mailbox_id': _MAILBOXES[0]}, 'sort': [('count', -1)], 'limit': 10},
+    {'name': 'tareas pendientes del usuario', 'collection': MONGO_TODOS_COLLECTION,
+     'filter': {'username': 'x', 'mailbox_id': _MAILBOXES[0], 'completed': False}},
+    {'name': 'temas del usuario', 'collection': MONGO_THEMES_COLLECTION,
+     'filter': {'theme_id': {'$in': ['x']}, 'user_id': 'x'}},
+    {'name': 'temas que contienen unos correos', 'collection': MONGO_THEMES_COLLECTION,
+     'filter': {'email_indices': {'$in': ['x']}}},
+    {'name': 'feedback del usuario', 'collection': MONGO_FEEDBACK_COLLECTION, 'filter': {'user_id': 'x'}},
+    {'name': 'pesos de feedback del usuario', 'collection': MONGO_FEEDBACK_COLLECTION, 'filter': {'type': 'weights', 'user_id': 'x'}},
+    {'name': 'usuario por nombre', 'collection': MONGO_USERS_COLLECTION, 'filter': {'username': 'x'}}
+]
+
+
+def _plan_nodes(plan):
+    """Etapas de un plan de explain() en profundidad (incluye los planes por shard y el queryPlan de SBE)."""
+    if not isinstance(plan, dict):
+        return
+    if 'stage' in plan:
+        yield plan
+    for key in ('inputStage', 'queryPlan', 'outerStage', 'innerStage', 'thenStage', 'elseStage'):
+        yield from _plan_nodes(plan.get(key))
+    for key in ('inputStages', 'shards'):
+        for child in plan.get(key, []):
+            yield from _plan_nodes(child.get('winningPlan', child))
+
+
+def audit_query_plans(db, shapes=None):
+    """Pasa cada forma de consulta por explain() y devuelve su plan ganador.
+
+    Cada resultado lleva name, collection, stages, indexes (los que usa el plan),
+    collscan (recorre la colección entera) y in_memory_sort (ordena sin índice).
+    """
+    results = []
+    for shape in shapes or QUERY_SHAPES:
+        cursor = db[shape['collection']].find(shape['filter'])
+        if shape.get('sort'):
+            cursor = cursor.sort(shape['sort'])
+        if shape.get('limit'):
+            cursor = cursor.limit(shape['limit'])
+        winning_plan = cursor.explain().get('queryPlanner', {}).get('winningPlan', {})
+        nodes = list(_plan_nodes(winning_plan))
+        stages = [node['stage'] for node in nodes]
+        results.append({
+            'name': shape['name'],
+            'collection': shape['collection'],
+            'stages': stages,
+            'indexes': sorted({node['indexName'] for node in nodes if 'indexName' in node}),
+            'collscan': 'COLLSCAN' in stages,
+            'in_memory_sort': 'SORT' in stages
+        })
+        if 'COLLSCAN' in stages:
+            logger.warning("COLLSCAN en '%s' (%s): %s", shape['name'], shape['collection'], shape['filter'])
+    return results
+
@@ -0,0 +1,204 @@
+import logging
+from logging import handlers
+import queue
+import threading
+import time
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.ingestion_pipeline')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+# Marca de fin de flujo que se propaga de una etapa a la siguiente
+_END = object()
+
+
+class PipelineStage:
+    """Etapa del pipeline: una función aplicada por N hilos a los elementos de su cola de entrada.
+
+    La función recibe un elemento y devuelve el elemento (posiblemente modificado) que pasa
+    a la siguiente etapa, o None para descartarlo. Con fan_out=True la función devuelve una
+    lista de elementos (por ejemplo, los mensajes de un lote) que se envían uno a uno.
+
+    Con batch_size > 1 cada hilo agrupa hasta batch_size elementos (esperando como mucho
+    batch_timeout segundos a que lleguen más) y la función recibe la lista completa y
+    devuelve la lista de elementos que continúan.
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=100, fan_out=False, batch_size=1, batch_timeout=0.5):
+        self.name = name
+        self.func = func
+        self.fan_out = fan_out
+        self.batch_size = max(1, int(batch_size))
+        self.batch_timeout = batch_timeout
+        self.workers = max(1, int(workers))
+        self.queue_size = max(1, int(queue_size))
+        self.input_queue = None
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.started_at = None
+        self.finished_at = None
+        self._finished_workers = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """Devuelve las métricas de rendimiento acumuladas de la etapa."""
+        with self._lock:
+            end = self.finished_at or time.monotonic()
+            elapsed = end - self.started_at if self.started_at else 0.0
+            handled = self.processed + self.dropped + self.errors
+            return {
+                'stage': self.name,
+                'workers': self.workers,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'queue_depth': self.input_queue.qsize() if self.input_queue else 0,
+                'elapsed_seconds': round(elapsed, 2),
+                'busy_seconds': round(self.busy_seconds, 2),
+                'throughput_per_second': round(handled / elapsed, 3) if elapsed > 0 else 0.0,
+                'avg_latency_seconds': round(self.busy_seconds / handled, 3) if handled else 0.0
+            }
+
+
+class IngestionPipeline:
+    """Pipeline de etapas concurrentes conectadas por colas acotadas.
+
+    Cada etapa tiene su propio número de hilos, de modo que las esperas de red
+    (Gmail/IMAP, Ollama, MongoDB/Elasticsearch) de distintos correos se solapan.
+    Las colas acotadas aplican contrapresión: una etapa lenta frena a las anteriores
+    en lugar de acumular correos en memoria.
+    """
+
+    def __init__(self, stages, name='ingestion', report_interval=60):
+        if not stages:
+            raise ValueError("El pipeline necesita al menos una etapa")
+        self.stages = stages
+        self.name = name
+        self.report_interval = report_interval
+        self._stop_reporting = threading.Event()
+
+    def _take(self, stage):
+        """Devuelve los siguientes elementos de la etapa y si se ha recibido el fin del flujo."""
+        item = stage.input_queue.get()
+        if item is _END:
+            return [], True
+        items = [item]
+        deadline = time.monotonic() + stage.batch_timeout
+        while len(items) < stage.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = stage.input_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _END:
+                return items, True
+            items.append(item)
+        return items, False
+
+    def _worker(self, index):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        batched = stage.batch_size > 1
+        finished = False
+        while not finished:
+            items, finished = self._take(stage)
+            if not items:
+                continue
+            start = time.monotonic()
+            try:
+                result = stage.func(items if batched else items[0])
+                results = [r for r in (result or []) if r is not None] if batched or stage.fan_out else [result]
+                with stage._lock:
+                    if batched:
+                        stage.processed += len(results)
+                        stage.dropped += max(0, len(items) - len(results))
+                    elif result is None:
+                        stage.dropped += 1
+                    else:
+                        stage.processed += len(results)
+            except Exception as e:
+                results = []
+                logger.error("Error en la etapa '%s' del pipeline %s: %s", stage.name, self.name, str(e), exc_info=True)
+                with stage._lock:
+                    stage.errors += len(items)
+            finally:
+                with stage._lock:
+                    stage.busy_seconds += time.monotonic() - start
+            if next_stage is not None:
+                for result in results:
+                    if result is not None:
+                        next_stage.input_queue.put(result)
+
+        # El último hilo de la etapa en terminar propaga el fin a la siguiente
+        with stage._lock:
+            stage._finished_workers += 1
+            last_worker = stage._finished_workers == stage.workers
+            if last_worker:
+                stage.finished_at = time.monotonic()
+        if last_worker and next_stage is not None:
+            for _ in range(next_stage.workers):
+                next_stage.input_queue.put(_END)
+
+    def _report_loop(self):
+        while not self._stop_reporting.wait(self.report_interval):
+            self.log_stats()
+
+    def log_stats(self):
+        for stage_stats in self.stats():
+            logger.info("Pipeline %s - %s", self.name, stage_stats)
+
+    def stats(self):
+        return [stage.stats() for stage in self.stages]
+
+    def run(self, items):
+        """Procesa todos los elementos del iterable y devuelve las métricas por etapa."""
+        threads = []
+        start = time.monotonic()
+        for stage in self.stages:
+            stage.input_queue = queue.Queue(maxsize=stage.queue_size)
+            stage.started_at = start
+        for index, stage in enumerate(self.stages):
+            for worker_number in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._worker,
+                    args=(index,),
+                    name=f"{self.name}-{stage.name}-{worker_number}",
+                    daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+
+        reporter = None
+        if self.report_interval:
+            reporter = threading.Thread(target=self._report_loop, name=f"{self.name}-report", daemon=True)
+            reporter.start()
+
+        first_stage = self.stages[0]
+        try:
+            for item in items:
+                first_stage.input_queue.put(item)
+        finally:
+            for _ in range(first_stage.workers):
+                first_stage.input_queue.put(_END)
+            for thread in threads:
+                thread.join()
+            self._stop_reporting.set()
+            if reporter:
+                reporter.join()
+
+        stats = self.stats()
+        logger.info("Pipeline %s completado en %.2f segundos", self.name, time.monotonic() - start)
+        self.log_stats()
+        return stats
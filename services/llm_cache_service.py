@@ -0,0 +1,227 @@
+import hashlib
+import json
+import logging
+from logging import handlers
+import sqlite3
+import threading
+import time
+from config import (
+    LLM_CACHE_BACKEND, LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES,
+    REDIS_HOST, REDIS_PORT, REDIS_DB
+)
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.llm_cache_service')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+
+def llm_cache_key(model, options, prompt):
+    """Clave estable de una llamada al LLM: SHA-256 de modelo, opciones y prompt."""
+    payload = json.dumps({'model': model, 'options': options or {}, 'prompt': prompt}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class _CacheStats:
+    """Contadores de aciertos y fallos del proceso actual."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'sets': 0, 'evictions': 0, 'errors': 0}
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self.counters)
+        lookups = counters['hits'] + counters['misses']
+        counters['hit_rate'] = counters['hits'] / lookups if lookups else 0.0
+        return counters
+
+
+class SQLiteLLMCache:
+    """Caché LRU de respuestas del LLM en un fichero SQLite compartido entre procesos.
+
+    Usa el modo WAL para que la ingestión, las tareas de AGATTA y los workers web puedan
+    leer a la vez que otro proceso escribe. Cada lectura actualiza last_used y, al
+    superar max_entries, se eliminan las entradas usadas hace más tiempo.
+    """
+
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max(1, int(max_entries))
+        self.stats = _CacheStats()
+        self._local = threading.local()
+        self._writes_since_trim = 0
+        self._trim_lock = threading.Lock()
+        connection = self._connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS llm_cache ('
+            'key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used)')
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        try:
+            connection = self._connection()
+            row = connection.execute('SELECT response FROM llm_cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.stats.incr('misses')
+                return None
+            connection.execute('UPDATE llm_cache SET last_used = ? WHERE key = ?', (time.time(), key))
+            connection.commit()
+            self.stats.incr('hits')
+            return row[0]
+        except sqlite3.Error as e:
+            logger.error("Error al leer del caché LLM: %s", str(e))
+            self.stats.incr('errors')
+            self.stats.incr('misses')
+            return None
+
+    def set(self, key, response):
+        now = time.time()
+        try:
+            connection = self._connection()
+            connection.execute(
+                'INSERT INTO llm_cache (key, response, created_at, last_used) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET response = excluded.response, last_used = excluded.last_used',
+                (key, response, now, now)
+            )
+            connection.commit()
+            self.stats.incr('sets')
+            self._maybe_trim(connection)
+        except sqlite3.Error as e:
+            logger.error("Error al guardar en el caché LLM: %s", str(e))
+            self.stats.incr('errors')
+
+    def _maybe_trim(self, connection):
+        # Contar filas en cada escritura sería caro; se comprueba cada 1% del tamaño máximo
+        with self._trim_lock:
+            self._writes_since_trim += 1
+            if self._writes_since_trim < max(1, self.max_entries // 100):
+                return
+            self._writes_since_trim = 0
+        excess = connection.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0] - self.max_entries
+        if excess > 0:
+            connection.execute(
+                'DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_used LIMIT ?)',
+                (excess,)
+            )
+            connection.commit()
+            self.stats.incr('evictions', excess)
+
+
+class RedisLLMCache:
+    """Caché LRU de respuestas del LLM en Redis.
+
+    Las respuestas se guardan como cadenas y un conjunto ordenado por último uso permite
+    expulsar las más antiguas al superar max_entries.
+    """
+
+    def __init__(self, client, max_entries=10000, prefix='llm_cache'):
+        self.client = client
+        self.max_entries = max(1, int(max_entries))
+        self.prefix = prefix
+        self.lru_key = f"{prefix}:lru"
+        self.stats = _CacheStats()
+
+    def get(self, key):
+        try:
+            response = self.client.get(f"{self.prefix}:{key}")
+            if response is None:
+                self.stats.incr('misses')
+                return None
+            self.client.zadd(self.lru_key, {key: time.time()})
+            self.stats.incr('hits')
+            return response
+        except Exception as e:
+            logger.error("Error al leer del caché LLM en Redis: %s", str(e))
+            self.stats.incr('errors')
+            self.stats.incr('misses')
+            return None
+
+    def set(self, key, response):
+        try:
+            pipeline = self.client.pipeline()
+            pipeline.set(f"{self.prefix}:{key}", response)
+            pipeline.zadd(self.lru_key, {key: time.time()})
+            pipeline.zcard(self.lru_key)
+            size = pipeline.execute()[-1]
+            self.stats.incr('sets')
+            if size > self.max_entries:
+                evicted = [member for member, _ in self.client.zpopmin(self.lru_key, size - self.max_entries)]
+                if evicted:
+                    self.client.delete(*[f"{self.prefix}:{member}" for member in evicted])
+                    self.stats.incr('evictions', len(evicted))
+        except Exception as e:
+            logger.error("Error al guardar en el caché LLM en Redis: %s", str(e))
+            self.stats.incr('errors')
+
+
+class NullLLMCache:
+    """Caché desactivado (LLM_CACHE_BACKEND=none)."""
+
+    def __init__(self):
+        self.stats = _CacheStats()
+
+    def get(self, key):
+        self.stats.incr('misses')
+        return None
+
+    def set(self, key, response):
+        pass
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """Devuelve el caché de respuestas del LLM configurado, creándolo la primera vez."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            backend = (LLM_CACHE_BACKEND or 'sqlite').lower()
+            if backend == 'redis':
+                import redis
+                client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
+                _cache = RedisLLMCache(client, LLM_CACHE_MAX_ENTRIES)
+            elif backend == 'none':
+                _cache = NullLLMCache()
+            else:
+                _cache = SQLiteLLMCache(LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES)
+            logger.info("Caché de respuestas LLM: %s (máximo %d entradas)", backend, LLM_CACHE_MAX_ENTRIES)
+        return _cache
+
+
+def get_cached_llm_response(model, options, prompt):
+    """Devuelve (clave, respuesta guardada o None)."""
+    key = llm_cache_key(model, options, prompt)
+    return key, get_llm_cache().get(key)
+
+
+def cache_llm_response(key, response):
+    get_llm_cache().set(key, response)
+
+
+def llm_cache_stats():
+    return get_llm_cache().stats.snapshot()
@@ -0,0 +1,243 @@
+import logging
+from logging import handlers
+import os
+import pickle
+import threading
+import time
+import zlib
+import numpy as np
+from scipy.sparse import csr_matrix, hstack
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.local_classifier_service')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+CLASSIFICATION_KEYS = ['requires_response', 'urgent', 'important', 'advertisement']
+# Origen del dominio y las clasificaciones de un correo (campo `classified_by`). Los
+# clasificadores locales solo se entrenan con las etiquetas del LLM, para no aprender
+# de sus propias predicciones ni de las de la política.
+CLASSIFIED_BY_LLM = 'llm'
+CLASSIFIED_BY_LOCAL = 'local'
+CLASSIFIED_BY_REUSED = 'reused'  # copiadas de un casi duplicado
+CLASSIFIED_BY_POLICY = 'policy'  # solo `advertisement`, con señales de la política
+# Caracteres del cuerpo que entran en las características TF-IDF
+TFIDF_BODY_CHARS = 2000
+
+
+def classifier_text(subject, body):
+    """Texto del correo para las características TF-IDF: asunto y comienzo del cuerpo."""
+    return f"{subject or ''} {(body or '')[:TFIDF_BODY_CHARS]}".strip()
+
+
+def _unit_vector(embedding):
+    """Embedding guardado en MongoDB (float32 comprimido) como vector normalizado, o None."""
+    if not embedding:
+        return None
+    vector = np.frombuffer(zlib.decompress(embedding), dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
+
+class LocalEmailClassifier:
+    """Clasificadores locales de un buzón entrenados con las etiquetas ya guardadas en MongoDB.
+
+    - semantic_domain: centroide más cercano (similitud coseno) de los embeddings de cada
+      dominio; la confianza es la probabilidad softmax de las similitudes.
+    - requires_response, urgent, important, advertisement: regresión logística sobre el
+      embedding más las características TF-IDF de asunto y cuerpo (palabras como
+      "urgente", "baja" o "factura" que el embedding diluye); la confianza es max(p, 1 - p).
+
+    Un dominio o una clase con menos de min_examples correos no se entrena y el correo
+    correspondiente se resuelve siempre con el LLM. Si los correos de entrenamiento no
+    tienen texto suficiente para el vocabulario TF-IDF se usa solo el embedding.
+    """
+
+    def __init__(self, min_examples=20, min_domain_confidence=0.6, temperature=0.05, max_tfidf_features=5000):
+        self.min_examples = min_examples
+        self.min_domain_confidence = min_domain_confidence
+        self.temperature = temperature
+        self.max_tfidf_features = max_tfidf_features
+        self.domains = []
+        self.centroids = None
+        self.vectorizer = None
+        self.flag_models = {}
+        self.trained_on = 0
+
+    def _features(self, vectors, texts):
+        matrix = csr_matrix(np.atleast_2d(vectors))
+        if self.vectorizer is None:
+            return matrix
+        return hstack([matrix, self.vectorizer.transform(texts)], format='csr')
+
+    def train(self, emails):
+        vectors, labeled = [], []
+        for email in emails:
+            vector = _unit_vector(email.get('embedding'))
+            if vector is not None:
+                vectors.append(vector)
+                labeled.append(email)
+        if not vectors:
+            return self
+        matrix = np.vstack(vectors)
+        self.trained_on = len(labeled)
+        texts = [classifier_text(email.get('subject'), email.get('body')) for email in labeled]
+        try:
+            self.vectorizer = TfidfVectorizer(max_features=self.max_tfidf_features, min_df=2, sublinear_tf=True, strip_accents='unicode').fit(texts)
+        except ValueError:
+            # Vocabulario vacío tras el filtrado (correos sin texto o todos distintos)
+            self.vectorizer = None
+        features = self._features(matrix, texts)
+
+        # Los dominios asignados por la heurística (confianza baja) no sirven como etiqueta
+        by_domain = {}
+        for row, email in enumerate(labeled):
+            if email.get('semantic_domain') and (email.get('domain_confidence') or 0) >= self.min_domain_confidence:
+                by_domain.setdefault(email['semantic_domain'], []).append(row)
+        self.domains = sorted(domain for domain, rows in by_domain.items() if len(rows) >= self.min_examples)
+        if len(self.domains) >= 2:
+            centroids = np.vstack([matrix[by_domain[domain]].mean(axis=0) for domain in self.domains])
+            self.centroids = centroids / np.linalg.norm(centroids, axis=1, keepdims=True)
+        else:
+            self.domains, self.centroids = [], None
+
+        for key in CLASSIFICATION_KEYS:
+            rows = [row for row, email in enumerate(labeled) if isinstance(email.get(key), bool)]
+            labels = np.array([labeled[row][key] for row in rows], dtype=int)
+            if min(labels.sum(), len(labels) - labels.sum()) < self.min_examples:
+                continue
+            model = LogisticRegression(max_iter=1000, class_weight='balanced')
+            model.fit(features[rows], labels)
+            self.flag_models[key] = model
+        return self
+
+    def predict(self, embedding, text=''):
+        """Devuelve ((dominio, confianza) o None, {clave: probabilidad}) para un embedding guardado y el texto del correo."""
+        vector = _unit_vector(embedding)
+        if vector is None:
+            return None, {}
+        domain = None
+        if self.centroids is not None:
+            scores = self.centroids @ vector / self.temperature
+            probabilities = np.exp(scores - scores.max())
+            probabilities /= probabilities.sum()
+            best = int(probabilities.argmax())
+            domain = (self.domains[best], float(probabilities[best]))
+        features = self._features(vector, [text or '']) if self.flag_models else None
+        flags = {key: float(model.predict_proba(features)[0][1]) for key, model in self.flag_models.items()}
+        return domain, flags
+
+
+def resolve_locally(classifier, embedding, threshold, text=''):
+    """Dominio y clasificaciones si todos los clasificadores locales superan threshold; si no, None."""
+    if classifier is None:
+        return None
+    domain, flags = classifier.predict(embedding, text)
+    if domain is None or domain[1] < threshold or set(flags) != set(CLASSIFICATION_KEYS):
+        return None
+    if any(max(p, 1 - p) < threshold for p in flags.values()):
+        return None
+    return {
+        'semantic_domain': domain[0],
+        'domain_confidence': round(domain[1], 4),
+        'classifications': {key: p >= 0.5 for key, p in flags.items()}
+    }
+
+
+class _CascadeStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {'local': 0, 'llm': 0}
+
+    def incr(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+_stats = _CascadeStats()
+_classifiers = {}
+_classifiers_lock = threading.Lock()
+
+
+def training_query(mailbox_id):
+    """Correos del buzón con embedding y clasificaciones del LLM.
+
+    Los correos anteriores a la cola de enriquecimiento no tienen classified_by ni
+    enrichment_status; de ellos solo valen los que obtuvieron resumen del LLM.
+    """
+    return {
+        'mailbox_id': mailbox_id,
+        'embedding': {'$exists': True},
+        '$or': [
+            {'classified_by': CLASSIFIED_BY_LLM},
+            {'classified_by': {'$exists': False}, 'enrichment_status': {'$exists': False}, 'summary': {'$exists': True, '$ne': "Resumen no disponible"}}
+        ]
+    }
+
+
+def get_local_classifier(emails_collection, mailbox_id, min_examples=20, max_training=5000, retrain_seconds=3600):
+    """Clasificador del buzón, entrenado la primera vez y de nuevo cada retrain_seconds.
+
+    Se entrena con los max_training correos más recientes del buzón clasificados por el
+    LLM (training_query). Devuelve None si no hay correos suficientes.
+    """
+    with _classifiers_lock:
+        entry = _classifiers.get(mailbox_id)
+        if entry and time.monotonic() - entry[1] < retrain_seconds:
+            return entry[0]
+        projection = {'embedding': 1, 'subject': 1, 'body': 1, 'semantic_domain': 1, 'domain_confidence': 1, **{key: 1 for key in CLASSIFICATION_KEYS}}
+        emails = list(emails_collection.find(training_query(mailbox_id), projection).sort('_id', -1).limit(max_training))
+        classifier = None
+        if len(emails) >= min_examples:
+            start = time.monotonic()
+            classifier = LocalEmailClassifier(min_examples).train(emails)
+            logger.info(
+                "Clasificador local de %s entrenado con %d correos en %.2f s: %d dominios, clases %s, %d términos TF-IDF",
+                mailbox_id, classifier.trained_on, time.monotonic() - start, len(classifier.domains), sorted(classifier.flag_models),
+                len(classifier.vectorizer.vocabulary_) if classifier.vectorizer else 0
+            )
+        _classifiers[mailbox_id] = (classifier, time.monotonic())
+        return classifier
+
+
+def record_resolution(local):
+    _stats.incr('local' if local else 'llm')
+
+
+def cascade_stats():
+    """Correos cuyo dominio y clasificaciones se resolvieron en local o con el LLM en este proceso."""
+    return _stats.snapshot()
+
+
+_bayesian_model = None
+_bayesian_model_mtime = None
+_bayesian_model_lock = threading.Lock()
+
+
+def load_bayesian_model(path):
+    """Modelo bayesiano de publicidad, cargado una vez y recargado solo si el fichero cambia."""
+    global _bayesian_model, _bayesian_model_mtime
+    with _bayesian_model_lock:
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            _bayesian_model, _bayesian_model_mtime = None, None
+            return None
+        if mtime != _bayesian_model_mtime:
+            with open(path, 'rb') as f:
+                _bayesian_model = pickle.load(f)
+            _bayesian_model_mtime = mtime
+        return _bayesian_model
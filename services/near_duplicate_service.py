@@ -0,0 +1,156 @@
+import hashlib
+import logging
+from logging import handlers
+import threading
+from services.email_fields import normalize_body
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.near_duplicate_service')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+# SimHash de 64 bits del cuerpo normalizado, partido en SIMHASH_BANDS bandas de 16 bits.
+# Dos huellas a distancia de Hamming <= SIMHASH_BANDS - 1 comparten al menos una banda
+# completa, así que basta buscar por `simhash_bands` con un índice multikey.
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 4
+_BAND_BITS = SIMHASH_BITS // SIMHASH_BANDS
+_SHINGLE_SIZE = 3
+
+# Campos del enriquecimiento que se copian de un casi duplicado ya enriquecido
+REUSABLE_FIELDS = ['summary', 'relevant_terms', 'semantic_domain', 'domain_confidence', 'requires_response', 'urgent', 'important', 'advertisement']
+
+
+def _feature_hash(feature):
+    return int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def simhash(text, min_shingles=8):
+    """SimHash de 64 bits (entero sin signo) de los trigramas de palabras del cuerpo normalizado.
+
+    Devuelve None si el texto tiene menos de min_shingles trigramas: en correos muy
+    cortos casi cualquier par de mensajes se parece y la huella no discrimina.
+    """
+    words = normalize_body(text).split()
+    shingles = {' '.join(words[i:i + _SHINGLE_SIZE]) for i in range(len(words) - _SHINGLE_SIZE + 1)}
+    if len(shingles) < min_shingles:
+        return None
+    weights = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        value = _feature_hash(shingle)
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def to_signed(value):
+    """MongoDB y Elasticsearch guardan enteros de 64 bits con signo."""
+    return value - (1 << SIMHASH_BITS) if value >= 1 << (SIMHASH_BITS - 1) else value
+
+
+def hamming_distance(a, b):
+    return bin((a ^ b) & ((1 << SIMHASH_BITS) - 1)).count('1')
+
+
+def simhash_bands(value):
+    """Bandas de la huella como enteros distintos por posición (banda * 2^16 + valor)."""
+    value &= (1 << SIMHASH_BITS) - 1
+    mask = (1 << _BAND_BITS) - 1
+    return [band << _BAND_BITS | (value >> (band * _BAND_BITS)) & mask for band in range(SIMHASH_BANDS)]
+
+
+def body_fingerprint(body, min_shingles=8):
+    """Campos `simhash` y `simhash_bands` de un correo, o {} si el cuerpo es demasiado corto."""
+    value = simhash(body, min_shingles)
+    if value is None:
+        return {}
+    return {'simhash': to_signed(value), 'simhash_bands': simhash_bands(value)}
+
+
+def find_near_duplicate(emails_collection, mailbox_id, fingerprint, max_distance=3, exclude_message_id=None, limit=50):
+    """Correo ya enriquecido del buzón más parecido a fingerprint, o None.
+
+    Solo se consideran correos enriquecidos por el LLM (ni pendientes ni resueltos con
+    heurísticas) a distancia de Hamming <= max_distance; max_distance no debería superar
+    SIMHASH_BANDS - 1, porque por encima la búsqueda por bandas puede no encontrarlos.
+    """
+    if not fingerprint:
+        return None
+    query = {
+        'mailbox_id': mailbox_id,
+        'simhash_bands': {'$in': fingerprint['simhash_bands']},
+        'summary': {'$exists': True, '$ne': "Resumen no disponible"},
+        'enrichment_status': {'$nin': ['pending', 'processing', 'failed']}
+    }
+    if exclude_message_id:
+        query['message_id'] = {'$ne': exclude_message_id}
+    projection = {'message_id': 1, 'simhash': 1, **{field: 1 for field in REUSABLE_FIELDS}}
+    best, best_distance = None, None
+    for doc in emails_collection.find(query, projection).limit(limit):
+        distance = hamming_distance(doc['simhash'], fingerprint['simhash'])
+        if distance <= max_distance and (best_distance is None or distance < best_distance):
+            best, best_distance = doc, distance
+            if distance == 0:
+                break
+    if best is not None:
+        best['distance'] = best_distance
+    return best
+
+
+def collapse_near_duplicates(results, max_distance=3):
+    """Deja solo el primero (el mejor clasificado) de cada grupo de resultados casi duplicados.
+
+    results es una lista ya ordenada de diccionarios con `simhash` (opcional); a los que
+    se conservan se les añade `duplicates` con el número de correos agrupados con ellos.
+    """
+    kept, buckets = [], {}
+    for result in results:
+        value = result.get('simhash')
+        if value is None:
+            kept.append(result)
+            continue
+        bands = simhash_bands(value)
+        match = next((
+            candidate for band in bands for candidate in buckets.get(band, [])
+            if hamming_distance(candidate['simhash'], value) <= max_distance
+        ), None)
+        if match is not None:
+            match['duplicates'] = match.get('duplicates', 0) + 1
+            continue
+        kept.append(result)
+        for band in bands:
+            buckets.setdefault(band, []).append(result)
+    return kept
+
+
+class _ReuseStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {'reused': 0, 'missed': 0, 'no_fingerprint': 0}
+
+    def incr(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+_stats = _ReuseStats()
+
+
+def record_reuse(name):
+    _stats.incr(name)
+
+
+def reuse_stats():
+    """Correos que copiaron el enriquecimiento de un casi duplicado, que no lo encontraron o sin huella, en este proceso."""
+    return _stats.snapshot()
@@ -1,11 +1,12 @@
-import hashlib
-import json
 import re
 import requests
 import zlib
 import numpy as np
 from sentence_transformers import SentenceTransformer
-from config import OLLAMA_URL, OLLAMA_MODEL, OLLAMA_TEMPERATURE, OLLAMA_MAX_TOKENS, OLLAMA_CONTEXT_SIZE
+from config import OLLAMA_MODEL, OLLAMA_TEMPERATURE, OLLAMA_MAX_TOKENS
+from services.llm_cache_service import get_cached_llm_response, cache_llm_response
+from services.ollama_client import ollama_generate, PRIORITY_INTERACTIVE
+from services.structured_output_service import generate_structured
 import logging
 from logging import handlers
 import unicodedata
@@ -31,10 +32,6 @@ logger.info("Cargando modelo de embeddings: %s", 'paraphrase-multilingual-MiniLM
 embedding_model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
 logger.info("Modelo de embeddings cargado exitosamente")
 
-# Caché en memoria para respuestas de Ollama
-response_cache = {}
-CACHE_LIMIT = 1000
-
 # Diccionario dinámico de sinónimos expandido
 SYNONYMS = {
     "reservas": ["booking", "reservations", "reservaciones", "reserva"],
@@ -72,39 +69,33 @@ def normalize_text(text):
         logger.error("Error al normalizar texto: %s", str(e), exc_info=True)
         return text
 
-def call_ollama_api(prompt):
-    """Llama a la API de Ollama para procesar el prompt."""
-    logger.info("Llamando a la API de Ollama con prompt: %s", prompt[:50] + '...' if len(prompt) > 50 else prompt)
-    prompt_hash = hashlib.md5(prompt.encode('utf-8')).hexdigest()
-    
-    if prompt_hash in response_cache:
-        logger.debug("Respuesta obtenida del caché para prompt_hash: %s", prompt_hash)
-        return response_cache[prompt_hash]
+def call_ollama_api(prompt, format=None, accept=None):
+    """Llama a la API de Ollama para procesar el prompt.
 
-    payload = {
-        "model": OLLAMA_MODEL,
-        "prompt": prompt,
-        "stream": False,
-        "temperature": OLLAMA_TEMPERATURE,
-        "num_predict": OLLAMA_MAX_TOKENS,
-        "num_ctx": OLLAMA_CONTEXT_SIZE
-    }
+    Con format (esquema JSON) la salida queda restringida al esquema, solo se guardan en
+    caché las respuestas que acepta accept y un error de la API devuelve None.
+    """
+    logger.info("Llamando a la API de Ollama con prompt: %s", prompt[:50] + '...' if len(prompt) > 50 else prompt)
+    options = {"temperature": OLLAMA_TEMPERATURE, "num_predict": OLLAMA_MAX_TOKENS}
+    if format is not None:
+        options["format"] = format
+    cache_key, cached = get_cached_llm_response(OLLAMA_MODEL, options, prompt)
+    if cached is not None and (accept is None or accept(cached)):
+        logger.debug("Respuesta obtenida del caché para la clave: %s", cache_key)
+        return cached
 
     try:
-        logger.debug("Enviando solicitud a Ollama con payload: %s", payload)
-        response = requests.post(OLLAMA_URL, json=payload)
-        response.raise_for_status()
-        result = response.json()['response']
+        logger.debug("Enviando solicitud a Ollama con opciones: %s", options)
+        result = ollama_generate(prompt, options, PRIORITY_INTERACTIVE, model=OLLAMA_MODEL)
         logger.debug("Respuesta de Ollama: %s", result[:100] + '...' if len(result) > 100 else result)
         
-        if len(response_cache) >= CACHE_LIMIT:
-            response_cache.pop(list(response_cache.keys())[0])
-        response_cache[prompt_hash] = result
-        logger.debug("Respuesta almacenada en caché para prompt_hash: %s", prompt_hash)
+        if accept is None or accept(result):
+            cache_llm_response(cache_key, result)
+            logger.debug("Respuesta almacenada en caché para la clave: %s", cache_key)
         return result
     except requests.RequestException as e:
         logger.error("Error al contactar con Ollama: %s", str(e), exc_info=True)
-        return f"Error: {str(e)}"
+        return None if format is not None else f"Error: {str(e)}"
 
 def generate_embedding(text):
     """Genera un embedding comprimido para el texto proporcionado."""
@@ -279,29 +270,15 @@ def process_query(query, return_names=False):
     {query}
     """
 
-    response = call_ollama_api(prompt)
-    try:
-        cleaned_response = response.strip()
-        if cleaned_response.startswith('```json'):
-            cleaned_response = cleaned_response[7:].strip()
-        if cleaned_response.endswith('```'):
-            cleaned_response = cleaned_response[:-3].strip()
-        result = json.loads(cleaned_response)
-        
-        intent = result.get('intent', 'general')
-        terms = result.get('terms', [])
-        conditions = result.get('conditions', {})
-        metadata_filters = result.get('metadata_filters', {})
-        names = result.get('names', [])
-    except json.JSONDecodeError as e:
-        logger.error("Error al parsear respuesta de Ollama: %s", str(e))
-        intent = "general"
-        terms = re.findall(r'\b\w+\b', query)
-        conditions = {}
-        metadata_filters = {}
-        names = []
-    except Exception as e:
-        logger.error("Error al procesar respuesta de Ollama: %s", str(e), exc_info=True)
+    result, _ = generate_structured('query_analysis', prompt, call_ollama_api)
+    if result is not None:
+        intent = result['intent'] or 'general'
+        terms = result['terms']
+        conditions = result['conditions']
+        metadata_filters = result['metadata_filters']
+        names = result['names']
+    else:
+        logger.error("No se obtuvo un análisis válido de la consulta; usando términos literales")
         intent = "general"
         terms = re.findall(r'\b\w+\b', query)
         conditions = {}
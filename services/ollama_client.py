@@ -0,0 +1,258 @@
+import itertools
+import logging
+from logging import handlers
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from config import (
+    OLLAMA_URL, OLLAMA_MODEL, OLLAMA_TIMEOUT, OLLAMA_MAX_IN_FLIGHT,
+    OLLAMA_AGATTA_MAX_IN_FLIGHT, OLLAMA_BACKFILL_MAX_IN_FLIGHT, OLLAMA_MAX_QUEUE, OLLAMA_QUEUE_TIMEOUT,
+    OLLAMA_MAX_TOKENS, OLLAMA_CONTEXT_SIZE, OLLAMA_CONTEXT_BUCKETS, OLLAMA_CHARS_PER_TOKEN, OLLAMA_CONTEXT_STICKY_FACTOR
+)
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.ollama_client')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+# Carriles de prioridad: un número menor se atiende antes
+PRIORITY_INTERACTIVE = 0
+PRIORITY_AGATTA = 1
+PRIORITY_BACKFILL = 2
+LANE_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_AGATTA: 'agatta', PRIORITY_BACKFILL: 'backfill'}
+
+
+class OllamaOverloadedError(requests.exceptions.RequestException):
+    """La petición no se admite: la cola de su carril está llena o se agotó la espera."""
+
+
+class ContextBudgeter:
+    """Elige num_ctx entre unos pocos tamaños fijos según la longitud del prompt.
+
+    Los tokens se estiman a partir de los caracteres (chars_per_token) y se reserva sitio
+    para num_predict. Se usa el tamaño más pequeño que cabe, salvo que el último usado
+    también quepa y no sea más de sticky_factor veces mayor: cambiar num_ctx obliga a
+    Ollama a recargar el modelo, así que se evita alternar entre tamaños vecinos.
+    """
+
+    def __init__(self, buckets, max_size=32768, chars_per_token=3.0, sticky_factor=2.0, default_num_predict=512):
+        self.buckets = sorted({size for size in buckets if size <= max_size} or {max_size})
+        self.max_size = max_size
+        self.chars_per_token = chars_per_token
+        self.sticky_factor = sticky_factor
+        self.default_num_predict = default_num_predict
+        self._last = None
+        self._lock = threading.Lock()
+        self.counts = {size: 0 for size in self.buckets}
+        self.saved_tokens = 0
+        self.overflows = 0
+
+    def estimate_tokens(self, prompt):
+        return int(len(prompt) / self.chars_per_token) + 1
+
+    def choose(self, prompt, num_predict=None):
+        needed = self.estimate_tokens(prompt) + (num_predict or self.default_num_predict)
+        fitting = next((size for size in self.buckets if size >= needed), None)
+        with self._lock:
+            if fitting is None:
+                self.overflows += 1
+                size = self.buckets[-1]
+                logger.warning("Prompt de ~%d tokens mayor que el contexto máximo (%d); Ollama lo recortará", needed, size)
+            elif self._last is not None and fitting <= self._last <= fitting * self.sticky_factor:
+                size = self._last
+            else:
+                size = fitting
+            self._last = size
+            self.counts[size] += 1
+            self.saved_tokens += self.max_size - size
+        logger.debug("num_ctx %d para ~%d tokens (%d menos que %d)", size, needed, self.max_size - size, self.max_size)
+        return size
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'buckets': {str(size): count for size, count in self.counts.items()},
+                'overflows': self.overflows,
+                'saved_context_tokens': self.saved_tokens
+            }
+
+
+class OllamaGateway:
+    """Cliente compartido de Ollama con sesión HTTP reutilizable y control de admisión.
+
+    Como mucho max_in_flight peticiones están en curso a la vez. Las que esperan se
+    atienden por prioridad (interactive > agatta > backfill) y, dentro de un carril, por
+    orden de llegada. Los carriles agatta y backfill tienen además su propio límite de
+    peticiones en curso, de modo que nunca ocupan todas las plazas de Ollama y una
+    consulta interactiva, de este u otro proceso, encuentra sitio libre. Si la cola de
+    un carril está llena, o la espera supera queue_timeout, se lanza OllamaOverloadedError.
+    """
+
+    def __init__(self, url, model, timeout=120, max_in_flight=2, lane_limits=None, max_queue=100, queue_timeout=300, budgeter=None):
+        self.url = url
+        self.budgeter = budgeter
+        self.model = model
+        self.timeout = timeout
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.lane_limits = {lane: self.max_in_flight for lane in LANE_NAMES}
+        for lane, limit in (lane_limits or {}).items():
+            self.lane_limits[lane] = max(1, min(self.max_in_flight, int(limit)))
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        self._waiting = []  # (prioridad, secuencia) en orden de atención
+        self._in_flight = 0
+        self._lane_in_flight = {lane: 0 for lane in LANE_NAMES}
+        self._metrics = {
+            lane: {'requests': 0, 'errors': 0, 'rejected': 0, 'queue_wait_total': 0.0, 'queue_wait_max': 0.0, 'latency_total': 0.0, 'latency_max': 0.0}
+            for lane in LANE_NAMES
+        }
+
+    def _next_admissible(self):
+        if self._in_flight >= self.max_in_flight:
+            return None
+        for entry in self._waiting:
+            if self._lane_in_flight[entry[0]] < self.lane_limits[entry[0]]:
+                return entry
+        return None
+
+    def _acquire(self, priority):
+        with self._condition:
+            if sum(1 for lane, _ in self._waiting if lane == priority) >= self.max_queue:
+                self._metrics[priority]['rejected'] += 1
+                raise OllamaOverloadedError(f"Cola de Ollama llena en el carril {LANE_NAMES[priority]}")
+            entry = (priority, next(self._sequence))
+            self._waiting.append(entry)
+            self._waiting.sort()
+            start = time.monotonic()
+            deadline = start + self.queue_timeout
+            while self._next_admissible() != entry:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(entry)
+                    self._metrics[priority]['rejected'] += 1
+                    self._condition.notify_all()
+                    raise OllamaOverloadedError(f"Tiempo de espera agotado en la cola de Ollama ({LANE_NAMES[priority]})")
+                self._condition.wait(remaining)
+            self._waiting.remove(entry)
+            self._in_flight += 1
+            self._lane_in_flight[priority] += 1
+            waited = time.monotonic() - start
+            metrics = self._metrics[priority]
+            metrics['queue_wait_total'] += waited
+            metrics['queue_wait_max'] = max(metrics['queue_wait_max'], waited)
+            # Puede haber otra petición admisible en otro carril
+            self._condition.notify_all()
+
+    def _release(self, priority, latency, failed):
+        with self._condition:
+            self._in_flight -= 1
+            self._lane_in_flight[priority] -= 1
+            metrics = self._metrics[priority]
+            metrics['requests'] += 1
+            metrics['errors'] += int(failed)
+            metrics['latency_total'] += latency
+            metrics['latency_max'] = max(metrics['latency_max'], latency)
+            self._condition.notify_all()
+
+    def generate(self, prompt, options=None, priority=PRIORITY_INTERACTIVE, model=None, timeout=None, retries=0, base_delay=2, **extra):
+        """Llama a /api/generate y devuelve el texto de la respuesta.
+
+        options son las opciones del modelo (temperature, num_predict...); si no incluyen
+        num_ctx lo elige el ContextBudgeter. 'format' (esquema JSON) va aparte en la petición.
+        Cada intento pasa por la cola de admisión; entre reintentos se espera con retroceso
+        exponencial fuera de la cola. Los errores de red y HTTP se propagan como
+        requests.exceptions.RequestException (incluido OllamaOverloadedError).
+        """
+        options = dict(options or {})
+        response_format = options.pop('format', None)
+        if 'num_ctx' not in options and self.budgeter:
+            options['num_ctx'] = self.budgeter.choose(prompt, options.get('num_predict'))
+        payload = {'model': model or self.model, 'prompt': prompt, 'stream': False, 'options': options, **extra}
+        if response_format is not None:
+            payload['format'] = response_format
+        for attempt in range(retries + 1):
+            self._acquire(priority)
+            start = time.monotonic()
+            failed = True
+            try:
+                response = self.session.post(self.url, json=payload, timeout=timeout or self.timeout)
+                response.raise_for_status()
+                result = response.json()['response']
+                failed = False
+                return result
+            except OllamaOverloadedError:
+                raise
+            except requests.exceptions.RequestException as e:
+                if attempt >= retries:
+                    raise
+                delay = base_delay * (2 ** attempt) + random.uniform(0, 0.1 * base_delay)
+                logger.warning("Intento %d fallido al contactar con Ollama (%s): %s. Reintentando en %.2f segundos...", attempt + 1, LANE_NAMES[priority], str(e), delay)
+            finally:
+                self._release(priority, time.monotonic() - start, failed)
+            time.sleep(delay)
+
+    def metrics(self):
+        """Profundidad de cola, peticiones en curso y latencias por carril."""
+        with self._condition:
+            lanes = {}
+            for lane, name in LANE_NAMES.items():
+                metrics = self._metrics[lane]
+                lanes[name] = {
+                    'queue_depth': sum(1 for waiting_lane, _ in self._waiting if waiting_lane == lane),
+                    'in_flight': self._lane_in_flight[lane],
+                    'limit': self.lane_limits[lane],
+                    'requests': metrics['requests'],
+                    'errors': metrics['errors'],
+                    'rejected': metrics['rejected'],
+                    'avg_queue_wait_seconds': round(metrics['queue_wait_total'] / metrics['requests'], 3) if metrics['requests'] else 0.0,
+                    'max_queue_wait_seconds': round(metrics['queue_wait_max'], 3),
+                    'avg_latency_seconds': round(metrics['latency_total'] / metrics['requests'], 3) if metrics['requests'] else 0.0,
+                    'max_latency_seconds': round(metrics['latency_max'], 3)
+                }
+            metrics = {'in_flight': self._in_flight, 'max_in_flight': self.max_in_flight, 'lanes': lanes}
+        if self.budgeter:
+            metrics['context'] = self.budgeter.metrics()
+        return metrics
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_ollama_gateway():
+    """Devuelve el cliente de Ollama del proceso, creándolo la primera vez."""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = OllamaGateway(
+                OLLAMA_URL, OLLAMA_MODEL, OLLAMA_TIMEOUT, OLLAMA_MAX_IN_FLIGHT,
+                lane_limits={PRIORITY_AGATTA: OLLAMA_AGATTA_MAX_IN_FLIGHT, PRIORITY_BACKFILL: OLLAMA_BACKFILL_MAX_IN_FLIGHT},
+                max_queue=OLLAMA_MAX_QUEUE, queue_timeout=OLLAMA_QUEUE_TIMEOUT,
+                budgeter=ContextBudgeter(OLLAMA_CONTEXT_BUCKETS, OLLAMA_CONTEXT_SIZE, OLLAMA_CHARS_PER_TOKEN, OLLAMA_CONTEXT_STICKY_FACTOR, OLLAMA_MAX_TOKENS)
+            )
+        return _gateway
+
+
+def ollama_generate(prompt, options=None, priority=PRIORITY_INTERACTIVE, **kwargs):
+    return get_ollama_gateway().generate(prompt, options, priority, **kwargs)
+
+
+def ollama_metrics():
+    return get_ollama_gateway().metrics()
@@ -0,0 +1,80 @@
+import logging
+from logging import handlers
+import time
+from datetime import datetime, timezone
+from services.email_fields import DIRECTION_INBOUND, DIRECTION_OUTBOUND
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.responded_service')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+
+def update_responded_status(emails_collection, mailbox_id, outbound_message_ids=None):
+    """Marca como respondidos los correos recibidos a los que el buzón contestó, con una sola agregación.
+
+    Un correo recibido (direction 'inbound') está respondido si un correo enviado desde
+    el buzón (direction 'outbound') contesta a su Message-ID (In-Reply-To) o es posterior
+    en el mismo hilo (parent_thread_id). Con outbound_message_ids solo se parte de esos correos
+    enviados (los guardados en la última sincronización); sin él se recalcula el buzón
+    entero. El resultado se escribe con $merge en la propia colección (MongoDB 5.0+).
+
+    Los correos marcados en esta llamada reciben responded_at con la fecha que se
+    devuelve (None si no había correos enviados que revisar).
+    """
+    outbound = {'mailbox_id': mailbox_id, 'direction': DIRECTION_OUTBOUND}
+    if outbound_message_ids is not None:
+        if not outbound_message_ids:
+            return None
+        outbound['message_id'] = {'$in': list(outbound_message_ids)}
+    inbound = {'mailbox_id': mailbox_id, 'direction': DIRECTION_INBOUND, 'responded': {'$ne': True}}
+    collection_name = emails_collection.name
+    # Precisión de milisegundos, como las fechas BSON, para poder buscar por responded_at
+    now = datetime.now(timezone.utc)
+    responded_at = now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+    pipeline = [
+        {'$match': outbound},
+        {'$project': {'in_reply_to': 1, 'parent_thread_id': 1, 'sent_at': '$date_ts'}},
+        # Correo al que contesta directamente
+        {'$lookup': {
+            'from': collection_name,
+            'localField': 'in_reply_to',
+            'foreignField': 'message_id',
+            'pipeline': [{'$match': inbound}, {'$project': {'_id': 1}}],
+            'as': 'replied'
+        }},
+        # Correos recibidos antes en el mismo hilo; sin fecha válida no se marcan
+        {'$lookup': {
+            'from': collection_name,
+            'localField': 'parent_thread_id',
+            'foreignField': 'parent_thread_id',
+            'let': {'sent_at': '$sent_at'},
+            'pipeline': [
+                {'$match': inbound},
+                {'$match': {'$expr': {'$lt': [{'$ifNull': ['$date_ts', '$$sent_at']}, '$$sent_at']}}},
+                {'$project': {'_id': 1}}
+            ],
+            'as': 'earlier'
+        }},
+        {'$project': {'_id': 0, 'ids': {'$setUnion': ['$replied._id', '$earlier._id']}}},
+        {'$unwind': '$ids'},
+        {'$group': {'_id': '$ids'}},
+        {'$set': {'responded': True, 'responded_at': responded_at}},
+        {'$merge': {'into': collection_name, 'on': '_id', 'whenMatched': 'merge', 'whenNotMatched': 'discard'}}
+    ]
+    start = time.monotonic()
+    emails_collection.aggregate(pipeline, allowDiskUse=True)
+    logger.info(
+        "Estado de respuesta de %s actualizado a partir de %s en %.2f s",
+        mailbox_id, f"{len(outbound_message_ids)} correos enviados" if outbound_message_ids is not None else "todo el buzón",
+        time.monotonic() - start
+    )
+    return responded_at
@@ -2,9 +2,12 @@ import unicodedata
 import zlib
 import numpy as np
 from pymongo import MongoClient
-from config import MONGO_URI, MONGO_DB_NAME, MONGO_EMAILS_COLLECTION, ELASTICSEARCH_HOST, ELASTICSEARCH_PORT
+from config import MONGO_URI, MONGO_DB_NAME, MONGO_EMAILS_COLLECTION, MONGO_ATTACHMENTS_COLLECTION, ELASTICSEARCH_HOST, ELASTICSEARCH_PORT
+from config import SEARCH_COLLAPSE_DUPLICATES, NEAR_DUPLICATE_MAX_DISTANCE
 from sentence_transformers import SentenceTransformer, util
 from services.feedback_service import get_feedback_weights, save_feedback
+from services.attachment_store_service import load_attachment_texts
+from services.near_duplicate_service import collapse_near_duplicates
 import logging
 from logging import handlers
 import re
@@ -28,6 +31,7 @@ logger.addHandler(console_handler)
 client = MongoClient(MONGO_URI)
 db = client[MONGO_DB_NAME]
 emails_collection = db[MONGO_EMAILS_COLLECTION]
+attachments_collection = db[MONGO_ATTACHMENTS_COLLECTION]
 es = Elasticsearch([{'host': ELASTICSEARCH_HOST, 'port': ELASTICSEARCH_PORT, 'scheme': 'http'}])
 
 logger.info("Cargando modelo de embeddings: %s", 'paraphrase-multilingual-MiniLM-L12-v2')
@@ -154,41 +158,25 @@ def get_conversation_emails(email1, email2, start_date, end_date, user=None):
         except ValueError as e:
             logger.error(f"Formato de fecha inválido: {str(e)}")
             return []
-        email1_escaped = re.escape(email1_addr)
-        email2_escaped = re.escape(email2_addr)
+        email1_addr = email1_addr.lower()
+        email2_addr = email2_addr.lower()
         pipeline = [
             {
                 '$match': {
                     'mailbox_id': {'$in': user_mailboxes},
                     '$or': [
-                        {
-                            'from': {'$regex': f'\\b{email1_escaped}\\b', '$options': 'i'},
-                            'to': {'$regex': f'\\b{email2_escaped}\\b', '$options': 'i'}
-                        },
-                        {
-                            'from': {'$regex': f'\\b{email2_escaped}\\b', '$options': 'i'},
-                            'to': {'$regex': f'\\b{email1_escaped}\\b', '$options': 'i'}
-                        }
-                    ]
-                }
-            },
-            {
-                '$addFields': {
-                    'parsedDate': {
-                        '$toDate': '$date'
-                    }
-                }
-            },
-            {
-                '$match': {
-                    'parsedDate': {
+                        # Igualdad sobre from_addr y to_addrs (multikey), ambos indexados
+                        {'from_addr': email1_addr, 'to_addrs': email2_addr},
+                        {'from_addr': email2_addr, 'to_addrs': email1_addr}
+                    ],
+                    'date_ts': {
                         '$gte': start_dt,
                         '$lte': end_dt
                     }
                 }
             },
             {
-                '$sort': {'parsedDate': -1}
+                '$sort': {'date_ts': -1}
             },
             {
                 '$project': {
@@ -211,19 +199,13 @@ def get_conversation_emails(email1, email2, start_date, end_date, user=None):
         if not emails:
             logger.warning("No se encontraron correos. Verificando datos en la colección...")  # Reduced: no per-sample log
             sample_emails = list(emails_collection.find(
-                {'mailbox_id': {'$in': user_mailboxes}, '$or': [
-                    {'from': {'$regex': email1_escaped, '$options': 'i'}},
-                    {'to': {'$regex': email1_escaped, '$options': 'i'}}
-                ]},
+                {'mailbox_id': {'$in': user_mailboxes}, '$or': [{'from_addr': email1_addr}, {'to_addrs': email1_addr}]},
                 {'from': 1, 'to': 1, 'date': 1}
             ).limit(5))
             if logger.isEnabledFor(logging.DEBUG):
                 logger.debug(f"Muestra de correos para email1: {len(sample_emails)} items")
             sample_emails = list(emails_collection.find(
-                {'mailbox_id': {'$in': user_mailboxes}, '$or': [
-                    {'from': {'$regex': email2_escaped, '$options': 'i'}},
-                    {'to': {'$regex': email2_escaped, '$options': 'i'}}
-                ]},
+                {'mailbox_id': {'$in': user_mailboxes}, '$or': [{'from_addr': email2_addr}, {'to_addrs': email2_addr}]},
                 {'from': 1, 'to': 1, 'date': 1}
             ).limit(5))
             if logger.isEnabledFor(logging.DEBUG):
@@ -265,6 +247,7 @@ def get_email_by_id(identifier, is_index=False):
                 'body': 1,
                 'attachments': 1,
                 'attachments_content': 1,
+                'attachment_refs': 1,
                 'summary': 1,
                 'relevant_terms': 1,
                 'semantic_domain': 1,
@@ -277,6 +260,7 @@ def get_email_by_id(identifier, is_index=False):
         if not email:
             logger.warning("Correo no encontrado: %s=%s", query_field, identifier)
             return None
+        load_attachment_texts(attachments_collection, [email])
         email['index'] = str(email.get('index', 'N/A'))
         email['message_id'] = str(email.get('message_id', 'N/A'))
         if not email['message_id'] or email['message_id'] == 'N/A':
@@ -333,6 +317,11 @@ def submit_bulk_feedback(query, filter_data, processed_query, intent, terms, que
                 '$language': 'spanish'
             }
         } if terms else {}
+        if terms:
+            # El texto de los adjuntos está en la colección attachments (uno por contenido), no en el correo
+            attachment_ids = [doc['_id'] for doc in attachments_collection.find(text_query, {'_id': 1}).limit(1000)]
+            if attachment_ids:
+                text_query = {'$or': [text_query, {'attachment_refs': {'$in': attachment_ids}}]}
         conditions = {'message_id': {'$exists': True}}
         if intent == 'negociaciones':
             conditions['semantic_domain'] = {'$in': DOMAIN_SYNONYMS.get('negociaciones', ['negociaciones'])}
@@ -507,6 +496,18 @@ def is_complex_query(processed_query, term_groups, intent, query_embedding):
     has_metadata = bool(processed_query.get('metadata_filters', {}))
     return num_terms > 3 or intent != 'general' or has_semantic or has_metadata
 
+def collapse_duplicate_results(results):
+    """Agrupa los resultados casi duplicados (misma huella SimHash) bajo el mejor clasificado."""
+    before = len(results)
+    if SEARCH_COLLAPSE_DUPLICATES:
+        results = collapse_near_duplicates(results, NEAR_DUPLICATE_MAX_DISTANCE)
+    for result in results:
+        # La huella es un entero de 64 bits que no se puede representar en JSON/JavaScript
+        result.pop('simhash', None)
+    if len(results) < before:
+        logger.info("Agrupados %d resultados casi duplicados", before - len(results))
+    return results
+
 def process_hits_light(hits, page, results_per_page, min_relevance=25):
     """Procesa hits en modo light: formato simple sin explain full."""
     results = []
@@ -530,8 +531,10 @@ def process_hits_light(hits, page, results_per_page, min_relevance=25):
             'total_score': total_score,
             'relevance': relevance,
             'explanation': 'Búsqueda por keywords + cribado bayesiano. Coincidencias en asunto, cuerpo y términos relevantes.',
-            'semantic_domain': source.get('semantic_domain', 'desconocido')
+            'semantic_domain': source.get('semantic_domain', 'desconocido'),
+            'simhash': source.get('simhash')
         })
+    results = collapse_duplicate_results(results)
     # Paginación
     start = (page - 1) * results_per_page
     return results[start:start + results_per_page]
@@ -578,7 +581,7 @@ def search_emails(processed_query, intent, term_groups, query_embedding, min_rel
                 "query": {
                     "multi_match": {
                         "query": query_str,
-                        "fields": ["subject^3", "body^2", "summary^1.5", "relevant_terms_array^1"],
+                        "fields": ["subject^3", "body^2", "summary^1.5", "relevant_terms_array^1", "attachments_content^1"],
                         "type": "cross_fields"
                     }
                 },
@@ -608,14 +611,14 @@ def search_emails(processed_query, intent, term_groups, query_embedding, min_rel
                 for f in remove_filters:
                     for term in f['terms']:
                         base_query_light["query"]["bool"]["must_not"].append({
-                            "multi_match": {"query": term, "fields": ["subject", "body", "summary", "relevant_terms_array", "from", "to"], "type": "cross_fields"}
+                            "multi_match": {"query": term, "fields": ["subject", "body", "summary", "relevant_terms_array", "attachments_content", "from", "to"], "type": "cross_fields"}
                         })
             if add_filters:
                 base_query_light["query"]["bool"]["must"] = base_query_light["query"]["bool"]["must"] or []
                 for f in add_filters:
                     for term in f['terms']:
                         base_query_light["query"]["bool"]["must"].append({
-                            "multi_match": {"query": term, "fields": ["subject", "body", "summary", "relevant_terms_array", "from", "to"], "type": "cross_fields"}
+                            "multi_match": {"query": term, "fields": ["subject", "body", "summary", "relevant_terms_array", "attachments_content", "from", "to"], "type": "cross_fields"}
                         })
             # Ejecutar
             es_results = es.search(index='email_index', body=base_query_light)
@@ -641,7 +644,7 @@ def search_emails(processed_query, intent, term_groups, query_embedding, min_rel
                 count_query = {"query": {"match_all": {}}, "filter": [{"terms": {"mailbox_id": user_mailboxes}}]}
                 for term in f['terms']:
                     count_query["query"]["bool"]["must"] = count_query["query"]["bool"]["must"] or []
-                    count_query["query"]["bool"]["must"].append({"multi_match": {"query": term, "fields": ["subject", "body", "summary", "relevant_terms_array", "from", "to"]}})
+                    count_query["query"]["bool"]["must"].append({"multi_match": {"query": term, "fields": ["subject", "body", "summary", "relevant_terms_array", "attachments_content", "from", "to"]}})
                 if f['action'] == 'remove':
                     count_query["query"]["bool"]["must_not"] = [{"match": {"_id": "dummy"}}] # Placeholder, adjust if needed
                 count_result = es.count(index='email_index', body=count_query)
@@ -690,7 +693,7 @@ def search_emails(processed_query, intent, term_groups, query_embedding, min_rel
                     group_should["bool"]["should"].append({
                         "multi_match": {
                             "query": term,
-                            "fields": ["body^2", "summary^1.5", "relevant_terms_array^1", "subject^3"],
+                            "fields": ["body^2", "summary^1.5", "relevant_terms_array^1", "subject^3", "attachments_content^1"],
                             "type": "cross_fields",
                             "boost": term_boost
                         }
@@ -841,7 +844,8 @@ def search_emails(processed_query, intent, term_groups, query_embedding, min_rel
                 'relevant_terms': hit['_source'].get('relevant_terms_array', []),
                 'total_score': total_score,
                 'explanation': explanation_text,
-                'semantic_domain': semantic_domain
+                'semantic_domain': semantic_domain,
+                'simhash': hit['_source'].get('simhash')
             })
         # Normalización sigmoide para relevancia
         scores = [email['total_score'] for email in results]
@@ -853,6 +857,7 @@ def search_emails(processed_query, intent, term_groups, query_embedding, min_rel
         min_score_threshold = 1.0
         ranked_results = [email for email in results if email['relevance'] >= min_relevance and email['total_score'] >= min_score_threshold]
         ranked_results.sort(key=lambda x: x['relevance'], reverse=True)
+        ranked_results = collapse_duplicate_results(ranked_results)
         logger.info(f"Ranked results: %d docs post-relevance filter, avg relevance %.2f", len(ranked_results), np.mean([r['relevance'] for r in ranked_results]) if ranked_results else 0)  # Nuevo: Ranking flow
         # Generar all_email_ids a partir de ranked_results
         all_email_ids = [
@@ -0,0 +1,169 @@
+import logging
+from logging import handlers
+import threading
+import time
+from datetime import datetime, timezone
+from pymongo import DESCENDING, UpdateOne
+from services.enrichment_policy_service import sender_address
+from services.email_fields import email_date_ts
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.sender_stats_service')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+# Un documento por (mailbox_id, sender), con sender la dirección del remitente en minúsculas:
+#   name        último From completo visto
+#   count       correos del remitente en el buzón
+#   ads         de ellos, clasificados como publicidad
+#   replied     de ellos, respondidos desde el buzón
+#   first_seen, last_seen  fechas del primer y último correo
+# La ingestión los actualiza con $inc; rebuild_sender_stats los recalcula desde los correos.
+
+
+def _sender_update(mailbox_id, sender, inc, name=None, dates=()):
+    update = {'$inc': inc, '$set': {'updated_at': datetime.now(timezone.utc)}}
+    if name:
+        update['$set']['name'] = name
+    dates = [date for date in dates if date]
+    if dates:
+        update['$min'] = {'first_seen': min(dates)}
+        update['$max'] = {'last_seen': max(dates)}
+    return UpdateOne({'mailbox_id': mailbox_id, 'sender': sender}, update, upsert=True)
+
+
+def record_new_emails(sender_stats_collection, documents):
+    """Suma a las estadísticas los correos recién insertados (no los que se actualizan)."""
+    senders = {}
+    for document in documents:
+        sender = sender_address(document.get('from'))
+        if not sender or not document.get('mailbox_id'):
+            continue
+        entry = senders.setdefault((document['mailbox_id'], sender), {'count': 0, 'ads': 0, 'name': None, 'dates': []})
+        entry['count'] += 1
+        entry['ads'] += int(bool(document.get('advertisement')))
+        entry['name'] = document.get('from')
+        entry['dates'].append(document.get('date_ts') or email_date_ts(document.get('date')))
+    operations = [
+        _sender_update(mailbox_id, sender, {'count': entry['count'], 'ads': entry['ads']}, entry['name'], entry['dates'])
+        for (mailbox_id, sender), entry in senders.items()
+    ]
+    if operations:
+        sender_stats_collection.bulk_write(operations, ordered=False)
+        for mailbox_id in {mailbox_id for mailbox_id, _ in senders}:
+            invalidate_top_senders(mailbox_id)
+
+
+def record_sender_counter(sender_stats_collection, mailbox_id, from_values, counter):
+    """Incrementa counter ('ads' o 'replied') una vez por cada valor de From."""
+    totals = {}
+    for from_ in from_values:
+        sender = sender_address(from_)
+        if sender:
+            totals[sender] = totals.get(sender, 0) + 1
+    operations = [_sender_update(mailbox_id, sender, {counter: amount}) for sender, amount in totals.items()]
+    if operations:
+        sender_stats_collection.bulk_write(operations, ordered=False)
+
+
+def record_replies(emails_collection, sender_stats_collection, mailbox_id, responded_at):
+    """Suma como respondidos los correos que update_responded_status marcó en responded_at."""
+    from_values = [doc.get('from') for doc in emails_collection.find({'mailbox_id': mailbox_id, 'responded_at': responded_at}, {'from': 1})]
+    record_sender_counter(sender_stats_collection, mailbox_id, from_values, 'replied')
+    return len(from_values)
+
+
+def rebuild_sender_stats(emails_collection, sender_stats_collection, mailbox_id):
+    """Recalcula desde cero las estadísticas de remitentes del buzón (una agregación por From)."""
+    start = time.monotonic()
+    pipeline = [
+        {'$match': {'mailbox_id': mailbox_id}},
+        {'$group': {
+            '_id': '$from',
+            'count': {'$sum': 1},
+            'ads': {'$sum': {'$cond': [{'$eq': ['$advertisement', True]}, 1, 0]}},
+            'replied': {'$sum': {'$cond': [{'$eq': ['$responded', True]}, 1, 0]}},
+            'first_seen': {'$min': '$date_ts'},
+            'last_seen': {'$max': '$date_ts'}
+        }}
+    ]
+    senders = {}
+    for doc in emails_collection.aggregate(pipeline, allowDiskUse=True):
+        sender = sender_address(doc['_id'])
+        if not sender:
+            continue
+        entry = senders.setdefault(sender, {'mailbox_id': mailbox_id, 'sender': sender, 'name': doc['_id'], 'count': 0, 'ads': 0, 'replied': 0, 'first_seen': None, 'last_seen': None})
+        for counter in ('count', 'ads', 'replied'):
+            entry[counter] += doc[counter]
+        # Un mismo remitente puede aparecer con varios From distintos (nombre, mayúsculas)
+        if doc['first_seen'] and (entry['first_seen'] is None or doc['first_seen'] < entry['first_seen']):
+            entry['first_seen'] = doc['first_seen']
+        if doc['last_seen'] and (entry['last_seen'] is None or doc['last_seen'] > entry['last_seen']):
+            entry['last_seen'] = doc['last_seen']
+    now = datetime.now(timezone.utc)
+    documents = [{**entry, 'updated_at': now} for entry in senders.values()]
+    sender_stats_collection.delete_many({'mailbox_id': mailbox_id})
+    if documents:
+        sender_stats_collection.insert_many(documents, ordered=False)
+    invalidate_top_senders(mailbox_id)
+    logger.info("Estadísticas de %d remitentes de %s recalculadas en %.2f s", len(documents), mailbox_id, time.monotonic() - start)
+    return len(documents)
+
+
+def ensure_sender_stats(emails_collection, sender_stats_collection, mailbox_id):
+    """Construye las estadísticas del buzón la primera vez (correos anteriores a la colección)."""
+    if sender_stats_collection.find_one({'mailbox_id': mailbox_id}, {'_id': 1}) is None and emails_collection.find_one({'mailbox_id': mailbox_id}, {'_id': 1}):
+        rebuild_sender_stats(emails_collection, sender_stats_collection, mailbox_id)
+
+
+def get_sender_stats(sender_stats_collection, mailbox_id, from_):
+    """Estadísticas de un remitente (por su dirección) con su tasa de respuesta, o None."""
+    sender = sender_address(from_)
+    if not sender:
+        return None
+    stats = sender_stats_collection.find_one({'mailbox_id': mailbox_id, 'sender': sender}, {'_id': 0})
+    if stats:
+        stats['reply_rate'] = round(stats.get('replied', 0) / stats['count'], 4) if stats.get('count') else 0.0
+    return stats
+
+
+def sender_history(sender_stats_collection, mailbox_id):
+    """{dirección: {'count', 'ads', 'replied'}} de todos los remitentes del buzón."""
+    return {
+        doc['sender']: {'count': doc.get('count', 0), 'ads': doc.get('ads', 0), 'replied': doc.get('replied', 0)}
+        for doc in sender_stats_collection.find({'mailbox_id': mailbox_id}, {'sender': 1, 'count': 1, 'ads': 1, 'replied': 1})
+    }
+
+
+_top_senders = {}
+_top_senders_lock = threading.Lock()
+
+
+def top_senders(sender_stats_collection, mailbox_id, limit=10, max_age=300):
+    """Direcciones de los limit remitentes con más correos del buzón.
+
+    Se leen del índice (mailbox_id, count) y se guardan en memoria max_age segundos;
+    las escrituras de este proceso que pueden cambiar el orden invalidan la entrada.
+    """
+    key = (mailbox_id, limit)
+    with _top_senders_lock:
+        entry = _top_senders.get(key)
+        if entry and time.monotonic() - entry[1] < max_age:
+            return entry[0]
+    senders = [doc['sender'] for doc in sender_stats_collection.find({'mailbox_id': mailbox_id}, {'sender': 1}).sort('count', DESCENDING).limit(limit)]
+    with _top_senders_lock:
+        _top_senders[key] = (senders, time.monotonic())
+    return senders
+
+
+def invalidate_top_senders(mailbox_id):
+    with _top_senders_lock:
+        for key in [key for key in _top_senders if key[0] == mailbox_id]:
+            del _top_senders[key]
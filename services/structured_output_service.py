@@ -0,0 +1,224 @@
+import json
+import logging
+from logging import handlers
+import threading
+from config import STRUCTURED_OUTPUT_MAX_ATTEMPTS
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.structured_output_service')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+_RELEVANT_TERMS = {
+    'type': 'object',
+    'additionalProperties': {
+        'type': 'object',
+        'properties': {
+            'frequency': {'type': 'integer', 'minimum': 0},
+            'context': {'type': 'string'},
+            'type': {'type': 'string', 'enum': ['acción', 'nombre_propio', 'url', 'definición_temporal']}
+        },
+        'required': ['frequency', 'context', 'type']
+    }
+}
+
+# Esquemas JSON por tipo de prompt. Se envían a Ollama en el campo `format`, que restringe
+# la generación a JSON con esa forma, y se usan después para validar la respuesta.
+SCHEMAS = {
+    'email_enrichment': {
+        'type': 'object',
+        'properties': {
+            'summary': {'type': 'string'},
+            'relevant_terms': _RELEVANT_TERMS,
+            'semantic_domain': {'type': 'string'},
+            'confidence': {'type': 'number', 'minimum': 0, 'maximum': 1},
+            'requires_response': {'type': 'boolean'},
+            'urgent': {'type': 'boolean'},
+            'important': {'type': 'boolean'},
+            'advertisement': {'type': 'boolean'}
+        },
+        'required': ['summary', 'relevant_terms', 'semantic_domain', 'confidence', 'requires_response', 'urgent', 'important', 'advertisement']
+    },
+    # Con dominio y clasificaciones resueltos por los clasificadores locales solo se pide esto
+    'email_summary': {
+        'type': 'object',
+        'properties': {
+            'summary': {'type': 'string'},
+            'relevant_terms': _RELEVANT_TERMS
+        },
+        'required': ['summary', 'relevant_terms']
+    },
+    'query_analysis': {
+        'type': 'object',
+        'properties': {
+            'intent': {'type': 'string'},
+            'terms': {'type': 'array', 'items': {'type': 'string'}},
+            'conditions': {'type': 'object'},
+            'metadata_filters': {'type': 'object'},
+            'names': {'type': 'array', 'items': {'type': 'string'}}
+        },
+        'required': ['intent', 'terms', 'conditions', 'metadata_filters', 'names']
+    },
+    'theme_summary': {
+        'type': 'object',
+        'properties': {
+            'title': {'type': 'string'},
+            'summary': {
+                'type': 'object',
+                'properties': {
+                    'tema': {'type': 'string'},
+                    'involucrados': {'type': 'array', 'items': {'type': 'string'}},
+                    'historia': {'type': 'string'},
+                    'proximos_pasos': {'type': 'string'},
+                    'puntos_claves': {'type': 'array', 'items': {'type': 'string'}}
+                },
+                'required': ['tema', 'involucrados', 'historia', 'proximos_pasos', 'puntos_claves']
+            }
+        },
+        'required': ['title', 'summary']
+    },
+    'thread_summary': {
+        'type': 'object',
+        'properties': {'summary': {'type': 'string'}},
+        'required': ['summary']
+    },
+    'proposed_action': {
+        'type': 'object',
+        'properties': {'action': {'type': 'string'}},
+        'required': ['action']
+    }
+}
+
+_TYPES = {
+    'object': dict,
+    'array': list,
+    'string': str,
+    'boolean': bool,
+    'integer': int,
+    'number': (int, float)
+}
+
+
+def validate(instance, schema, path='$'):
+    """Valida instance contra el subconjunto de JSON Schema usado en SCHEMAS.
+
+    Devuelve la lista de errores (vacía si es válido).
+    """
+    expected = schema.get('type')
+    if expected:
+        # bool es subclase de int en Python, pero no es un número en JSON
+        if not isinstance(instance, _TYPES[expected]) or (expected in ('integer', 'number') and isinstance(instance, bool)):
+            return [f"{path}: se esperaba {expected}"]
+    errors = []
+    if 'enum' in schema and instance not in schema['enum']:
+        errors.append(f"{path}: valor fuera de {schema['enum']}")
+    if 'minimum' in schema and instance < schema['minimum']:
+        errors.append(f"{path}: menor que {schema['minimum']}")
+    if 'maximum' in schema and instance > schema['maximum']:
+        errors.append(f"{path}: mayor que {schema['maximum']}")
+    if isinstance(instance, dict):
+        for key in schema.get('required', []):
+            if key not in instance:
+                errors.append(f"{path}: falta '{key}'")
+        properties = schema.get('properties', {})
+        for key, value in instance.items():
+            if key in properties:
+                errors.extend(validate(value, properties[key], f"{path}.{key}"))
+            elif isinstance(schema.get('additionalProperties'), dict):
+                errors.extend(validate(value, schema['additionalProperties'], f"{path}.{key}"))
+    if isinstance(instance, list) and 'items' in schema:
+        for i, item in enumerate(instance):
+            errors.extend(validate(item, schema['items'], f"{path}[{i}]"))
+    return errors
+
+
+def parse_json_response(text):
+    """json.loads tolerando solo las vallas ```json que algunos modelos añaden."""
+    text = (text or '').strip()
+    if text.startswith('```'):
+        text = text[3:]
+        if text.startswith('json'):
+            text = text[4:]
+        if text.endswith('```'):
+            text = text[:-3]
+    return json.loads(text)
+
+
+class _StructuredStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+
+    def incr(self, prompt_type, name):
+        with self._lock:
+            counters = self.counters.setdefault(prompt_type, {'calls': 0, 'attempts': 0, 'parse_failures': 0, 'schema_failures': 0, 'exhausted': 0, 'unavailable': 0})
+            counters[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {}
+            for prompt_type, counters in self.counters.items():
+                failures = counters['parse_failures'] + counters['schema_failures']
+                snapshot[prompt_type] = {
+                    **counters,
+                    'failure_rate': round(failures / counters['attempts'], 4) if counters['attempts'] else 0.0
+                }
+            return snapshot
+
+
+_stats = _StructuredStats()
+
+
+def generate_structured(prompt_type, prompt, call, max_attempts=None):
+    """Pide al LLM una respuesta con el esquema de prompt_type y la devuelve ya validada.
+
+    call(prompt, format, accept) debe devolver el texto generado, o None si el LLM no está
+    disponible; format es el esquema para Ollama y accept una función que indica si un
+    texto es válido (para no guardar en caché respuestas inválidas). Se reintenta hasta
+    max_attempts veces; si ninguna respuesta es válida devuelve (None, último texto
+    recibido) para que el llamante aplique su alternativa.
+    """
+    schema = SCHEMAS[prompt_type]
+    max_attempts = max(1, max_attempts or STRUCTURED_OUTPUT_MAX_ATTEMPTS)
+
+    def accept(text):
+        try:
+            return not validate(parse_json_response(text), schema)
+        except (json.JSONDecodeError, TypeError):
+            return False
+
+    _stats.incr(prompt_type, 'calls')
+    text = None
+    for attempt in range(max_attempts):
+        _stats.incr(prompt_type, 'attempts')
+        text = call(prompt, schema, accept)
+        if text is None:
+            # Los reintentos de red ya los hace el cliente de Ollama
+            _stats.incr(prompt_type, 'unavailable')
+            break
+        try:
+            parsed = parse_json_response(text)
+        except (json.JSONDecodeError, TypeError) as e:
+            _stats.incr(prompt_type, 'parse_failures')
+            logger.warning("Respuesta no JSON para %s (intento %d/%d): %s", prompt_type, attempt + 1, max_attempts, str(e))
+            continue
+        errors = validate(parsed, schema)
+        if not errors:
+            return parsed, text
+        _stats.incr(prompt_type, 'schema_failures')
+        logger.warning("Respuesta fuera de esquema para %s (intento %d/%d): %s", prompt_type, attempt + 1, max_attempts, '; '.join(errors[:5]))
+    else:
+        _stats.incr(prompt_type, 'exhausted')
+    return None, text
+
+
+def structured_output_stats():
+    """Intentos, fallos de parseo y de esquema por tipo de prompt en este proceso."""
+    return _stats.snapshot()
@@ -0,0 +1,127 @@
+import logging
+import re
+from logging import handlers
+from datetime import datetime, timezone
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.sync_state_service')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+# Marcas de sincronización incremental guardadas en cada buzón del usuario (`mailboxes.$.sync_state`):
+#   history_id    último historyId de Gmail hasta el que está sincronizado el buzón
+#   last_sync     momento en que se guardó la marca
+#   imap_folders  por carpeta IMAP: UIDVALIDITY y último UID sincronizado
+# Una marca solo avanza tras una ejecución sin fallos; si no, la siguiente vuelve a
+# recorrer los mismos cambios y descarta los correos que ya se guardaron.
+
+
+def get_mailbox_sync_state(users_collection, username, mailbox_id):
+    user = users_collection.find_one(
+        {"username": username, "mailboxes.mailbox_id": mailbox_id},
+        {"mailboxes": 1}
+    )
+    for mailbox in (user or {}).get('mailboxes', []):
+        if mailbox.get('mailbox_id') == mailbox_id:
+            return mailbox.get('sync_state', {})
+    return {}
+
+
+def save_gmail_history_id(users_collection, username, mailbox_id, history_id):
+    """Guarda en el buzón del usuario la marca historyId hasta la que está sincronizado."""
+    users_collection.update_one(
+        {"username": username, "mailboxes.mailbox_id": mailbox_id},
+        {"$set": {
+            "mailboxes.$.sync_state.history_id": str(history_id),
+            "mailboxes.$.sync_state.last_sync": datetime.now(timezone.utc).isoformat()
+        }}
+    )
+    logger.info("Marca historyId %s guardada para %s", history_id, mailbox_id)
+
+
+def advance_gmail_history_id(users_collection, username, mailbox_id, history_id, failures, dry_run=False):
+    """Guarda la nueva marca historyId si la ejecución no tuvo fallos; devuelve si se ha guardado."""
+    if failures:
+        logger.warning("%d fallos al sincronizar %s; no se avanza la marca historyId", failures, mailbox_id)
+        return False
+    if dry_run or not history_id:
+        return False
+    save_gmail_history_id(users_collection, username, mailbox_id, history_id)
+    return True
+
+
+def uid_ranges(uids):
+    """Compacta una lista de UIDs en un conjunto IMAP (p. ej. '1:5,7,9:12')."""
+    ranges = []
+    uids = sorted(set(uids))
+    start = prev = None
+    for uid in uids:
+        if start is None:
+            start = prev = uid
+        elif uid == prev + 1:
+            prev = uid
+        else:
+            ranges.append(f"{start}:{prev}" if start != prev else str(start))
+            start = prev = uid
+    if start is not None:
+        ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ','.join(ranges)
+
+
+def parse_uid_fetch_response(data):
+    """Devuelve [(uid, bytes)] de una respuesta UID FETCH, con el UID antes o después del literal."""
+    results = []
+    for i, item in enumerate(data):
+        if not isinstance(item, tuple) or len(item) < 2:
+            continue
+        match = re.search(rb'UID (\d+)', item[0])
+        if not match and i + 1 < len(data) and isinstance(data[i + 1], bytes):
+            match = re.search(rb'UID (\d+)', data[i + 1])
+        if match:
+            results.append((int(match.group(1)), item[1]))
+    return results
+
+
+def uids_after(search_response, last_uid):
+    """UIDs de una respuesta UID SEARCH posteriores a la marca, ordenados."""
+    # 'n:*' siempre incluye el mayor UID existente aunque sea menor que n
+    return sorted(uid for uid in map(int, search_response.split()) if uid > last_uid)
+
+
+def imap_folder_state_key(folder):
+    # Los puntos y '$' no están permitidos en claves de MongoDB
+    return folder.replace('.', '_').replace('$', '_')
+
+
+def save_imap_folder_state(users_collection, username, mailbox_id, folder, uidvalidity, last_uid):
+    """Guarda en el buzón del usuario el UIDVALIDITY y el último UID sincronizado de la carpeta."""
+    users_collection.update_one(
+        {"username": username, "mailboxes.mailbox_id": mailbox_id},
+        {"$set": {
+            f"mailboxes.$.sync_state.imap_folders.{imap_folder_state_key(folder)}": {
+                'folder': folder,
+                'uidvalidity': uidvalidity,
+                'last_uid': last_uid,
+                'last_sync': datetime.now(timezone.utc).isoformat()
+            }
+        }}
+    )
+    logger.info("Estado IMAP guardado para %s/%s: UIDVALIDITY %s, último UID %s", mailbox_id, folder, uidvalidity, last_uid)
+
+
+def advance_imap_folder_state(users_collection, username, mailbox_id, folder, uidvalidity, last_uid, uids, failures, dry_run=False):
+    """Avanza la marca de la carpeta hasta el mayor UID procesado si la ejecución no tuvo fallos; devuelve si se ha guardado."""
+    if failures:
+        logger.warning("%d fallos al procesar %s/%s; se mantiene la marca en UID %s", failures, mailbox_id, folder, last_uid)
+        return False
+    if dry_run or not uids:
+        return False
+    save_imap_folder_state(users_collection, username, mailbox_id, folder, uidvalidity, max(max(uids), last_uid))
+    return True
@@ -0,0 +1,189 @@
+import hashlib
+import logging
+import threading
+from logging import handlers
+from datetime import datetime, timezone
+from email.utils import getaddresses
+from pymongo import UpdateOne, ReplaceOne
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.thread_store_service')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+# Colección `threads`: un documento por (parent_thread_id, mailbox_id) con
+#   message_ids, message_count, first_date, last_date, last_sender, last_message_id,
+#   participants, normalized_subject, content_hash y updated_at.
+# Las fechas son las mismas cadenas ISO que el campo `date` de los correos.
+
+
+def participants_of(email):
+    """Direcciones (en minúsculas) de remitente y destinatarios de un correo."""
+    fields = [email.get('from') or '', email.get('to') or '']
+    return sorted({address.lower() for _, address in getaddresses(fields) if address})
+
+
+def content_hash(message_ids, last_date):
+    """Huella del contenido del hilo: cambia cuando se añade un correo."""
+    payload = '\n'.join(sorted(message_ids)) + f"\n{last_date or ''}"
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _valid_date(date):
+    return date if date and date not in ('unknown', 'Unknown') else None
+
+
+def thread_member_update(email):
+    """Operación de upsert que incorpora un correo a su hilo sin leer antes el documento."""
+    # Los valores van en $literal para que una cadena que empiece por '$' no se tome como campo
+    date = _valid_date(email.get('date'))
+    fields = {
+        'parent_thread_id': {'$literal': email['parent_thread_id']},
+        'mailbox_id': {'$literal': email['mailbox_id']},
+        'message_ids': {'$setUnion': [{'$ifNull': ['$message_ids', []]}, {'$literal': [email['message_id']]}]},
+        'participants': {'$setUnion': [{'$ifNull': ['$participants', []]}, {'$literal': participants_of(email)}]},
+        'normalized_subject': {'$ifNull': ['$normalized_subject', {'$literal': email.get('normalized_subject', '')}]},
+        'updated_at': datetime.now(timezone.utc)
+    }
+    if date:
+        # Todas las expresiones de la etapa ven el documento anterior, así que last_date es el previo
+        date = {'$literal': date}
+        is_latest = {'$gte': [date, {'$ifNull': ['$last_date', '']}]}
+        fields.update({
+            'first_date': {'$min': [{'$ifNull': ['$first_date', date]}, date]},
+            'last_date': {'$max': [{'$ifNull': ['$last_date', date]}, date]},
+            'last_sender': {'$cond': [is_latest, {'$literal': email.get('from', '')}, '$last_sender']},
+            'last_message_id': {'$cond': [is_latest, {'$literal': email['message_id']}, '$last_message_id']}
+        })
+    return UpdateOne(
+        {'parent_thread_id': email['parent_thread_id'], 'mailbox_id': email['mailbox_id']},
+        [{'$set': fields}, {'$set': {'message_count': {'$size': '$message_ids'}}}],
+        upsert=True
+    )
+
+
+class RunThreadIndex:
+    """Hilos asignados por asunto normalizado durante una ejecución de ingestión.
+
+    El escritor en bloque retrasa las escrituras en MongoDB, así que find_thread_by_subject
+    no ve los correos de la misma ejecución; este índice los hace visibles al momento,
+    como el índice vectorial del buzón. El primer hilo registrado para un asunto se conserva.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_subject = {}
+
+    def find(self, mailbox_id, normalized_subject):
+        if not normalized_subject:
+            return None
+        with self._lock:
+            return self._by_subject.get((mailbox_id, normalized_subject))
+
+    def add(self, mailbox_id, normalized_subject, parent_thread_id):
+        if normalized_subject and parent_thread_id:
+            with self._lock:
+                self._by_subject.setdefault((mailbox_id, normalized_subject), parent_thread_id)
+
+
+def update_threads(threads_collection, emails):
+    """Incorpora a la colección `threads` los correos recién guardados (una escritura en bloque)."""
+    emails = [email for email in emails if email.get('parent_thread_id') and email.get('mailbox_id')]
+    if not emails:
+        return
+    threads_collection.bulk_write([thread_member_update(email) for email in emails], ordered=True)
+    refresh_content_hashes(threads_collection, {(email['parent_thread_id'], email['mailbox_id']) for email in emails})
+
+
+def refresh_content_hashes(threads_collection, keys):
+    threads = threads_collection.find(
+        {'$or': [{'parent_thread_id': parent_thread_id, 'mailbox_id': mailbox_id} for parent_thread_id, mailbox_id in keys]},
+        {'message_ids': 1, 'last_date': 1}
+    )
+    operations = [
+        UpdateOne({'_id': thread['_id']}, {'$set': {'content_hash': content_hash(thread['message_ids'], thread.get('last_date'))}})
+        for thread in threads
+    ]
+    if operations:
+        threads_collection.bulk_write(operations, ordered=False)
+
+
+def remove_thread_member(threads_collection, message_id, parent_thread_id, mailbox_id):
+    """Quita un correo de un hilo (cuando pasa a otro) y borra el hilo si queda vacío."""
+    query = {'parent_thread_id': parent_thread_id, 'mailbox_id': mailbox_id}
+    threads_collection.update_one(query, [
+        {'$set': {'message_ids': {'$setDifference': [{'$ifNull': ['$message_ids', []]}, {'$literal': [message_id]}]}, 'updated_at': datetime.now(timezone.utc)}},
+        {'$set': {'message_count': {'$size': '$message_ids'}}}
+    ])
+    threads_collection.delete_one({**query, 'message_count': 0})
+
+
+def get_thread(threads_collection, parent_thread_id, mailbox_id=None):
+    """Devuelve el documento del hilo o None si no está materializado."""
+    if not parent_thread_id:
+        return None
+    query = {'parent_thread_id': parent_thread_id}
+    if mailbox_id:
+        query['mailbox_id'] = mailbox_id
+    return threads_collection.find_one(query)
+
+
+def build_thread_document(parent_thread_id, mailbox_id, emails):
+    dated = sorted((email for email in emails if _valid_date(email.get('date'))), key=lambda email: email['date'])
+    message_ids = sorted({email['message_id'] for email in emails})
+    participants = sorted({address for email in emails for address in participants_of(email)})
+    last_date = dated[-1]['date'] if dated else None
+    return {
+        'parent_thread_id': parent_thread_id,
+        'mailbox_id': mailbox_id,
+        'message_ids': message_ids,
+        'message_count': len(message_ids),
+        'first_date': dated[0]['date'] if dated else None,
+        'last_date': last_date,
+        'last_sender': dated[-1].get('from', '') if dated else None,
+        'last_message_id': dated[-1]['message_id'] if dated else None,
+        'participants': participants,
+        'normalized_subject': next((email.get('normalized_subject') for email in emails if email.get('normalized_subject')), ''),
+        'content_hash': content_hash(message_ids, last_date),
+        'updated_at': datetime.now(timezone.utc)
+    }
+
+
+def rebuild_threads(emails_collection, threads_collection, mailbox_id, batch_size=500):
+    """Reconstruye desde los correos todos los hilos de un buzón (migración y reparación)."""
+    started_at = datetime.now(timezone.utc)
+    pipeline = [
+        {'$match': {'mailbox_id': mailbox_id, 'parent_thread_id': {'$nin': [None, '']}}},
+        {'$group': {
+            '_id': '$parent_thread_id',
+            'emails': {'$push': {
+                'message_id': '$message_id',
+                'date': '$date',
+                'from': '$from',
+                'to': '$to',
+                'normalized_subject': '$normalized_subject'
+            }}
+        }}
+    ]
+    operations = []
+    rebuilt = 0
+    for group in emails_collection.aggregate(pipeline, allowDiskUse=True):
+        document = build_thread_document(group['_id'], mailbox_id, group['emails'])
+        operations.append(ReplaceOne({'parent_thread_id': group['_id'], 'mailbox_id': mailbox_id}, document, upsert=True))
+        rebuilt += 1
+        if len(operations) >= batch_size:
+            threads_collection.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        threads_collection.bulk_write(operations, ordered=False)
+    # Hilos que ya no tienen correos (p. ej. tras reasignar parent_thread_id) no se han tocado
+    removed = threads_collection.delete_many({'mailbox_id': mailbox_id, 'updated_at': {'$lt': started_at}}).deleted_count
+    logger.info("Hilos del buzón %s reconstruidos: %d hilos, %d eliminados", mailbox_id, rebuilt, removed)
+    return rebuilt
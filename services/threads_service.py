@@ -14,15 +14,16 @@ from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle
 from reportlab.lib import colors
 from datetime import datetime
-from config import MONGO_URI, MONGO_DB_NAME, MONGO_EMAILS_COLLECTION
+from config import MONGO_URI, MONGO_DB_NAME, MONGO_EMAILS_COLLECTION, MONGO_THREADS_COLLECTION
 from services.nlp_service import process_query, decompress_embedding
 from services.cache_service import get_cached_result, cache_result
+from services.thread_store_service import get_thread
+from services.ollama_client import ollama_generate, PRIORITY_INTERACTIVE
 from fuzzywuzzy import fuzz
 import re
 import torch
 import os
 from collections import Counter
-import requests
 
 # Configuración inicial de PyTorch
 torch.cuda.empty_cache()
@@ -46,6 +47,7 @@ client = MongoClient(MONGO_URI)
 db = client[MONGO_DB_NAME]
 emails_collection = db[MONGO_EMAILS_COLLECTION]
 feedback_collection = db['feedback']
+threads_collection = db[MONGO_THREADS_COLLECTION]
 
 # Carga del modelo de embeddings
 logger.info("Cargando modelo de embeddings: 'paraphrase-multilingual-MiniLM-L12-v2'")
@@ -57,23 +59,12 @@ bayesian_filter = MultinomialNB()
 filter_weights = {'summary': 0.2, 'terms': 0.2, 'subject': 0.2, 'thread_id': 0.2, 'names': 0.2}
 tfidf_vectorizer = TfidfVectorizer(max_features=1000, stop_words='english')
 
-# URL de la API del LLM
-LLM_API_URL = "http://localhost:11434/api/generate"
-
 def generate_synonyms(term):
     """Genera sinónimos para un término usando un LLM y los limpia."""
     prompt = f"Genera sinónimos para el término '{term}' en español."
-    payload = {
-        "model": "mistral-custom",
-        "prompt": prompt,
-        "stream": False,
-        "temperature": 0.3,
-        "num_predict": 10
-    }
+    options = {"temperature": 0.3, "num_predict": 10}
     try:
-        response = requests.post(LLM_API_URL, json=payload)
-        response.raise_for_status()
-        result = response.json()['response']
+        result = ollama_generate(prompt, options, PRIORITY_INTERACTIVE, model="mistral-custom")
         synonyms = re.findall(r'(?<=: ).*?(?=\n|$)', result)
         cleaned_synonyms = [syn.strip().lower() for syn in synonyms if syn.strip().lower() != term.lower()]
         logger.debug(f"Sinónimos limpios para '{term}': {cleaned_synonyms}")
@@ -255,6 +246,7 @@ def fetch_relevant_emails_with_synonyms(query, expanded_terms, names, query_embe
                     'summary': 1,
                     'body': 1,
                     'thread_id': 1,
+                    'parent_thread_id': 1,
                     'in_reply_to': 1,
                     'references': 1,
                     'relevant_terms': 1
@@ -266,6 +258,19 @@ def fetch_relevant_emails_with_synonyms(query, expanded_terms, names, query_embe
         emails = list(emails_collection.aggregate(pipeline))
         for email in emails:
             email.pop('_id', None)
+
+        # Los correos de hilos reales (más de un mensaje en la colección threads) se agrupan por su hilo
+        parent_thread_ids = list({email['parent_thread_id'] for email in emails if email.get('parent_thread_id')})
+        multi_message_threads = {
+            thread['parent_thread_id']
+            for thread in threads_collection.find(
+                {'parent_thread_id': {'$in': parent_thread_ids}, 'mailbox_id': {'$in': user_mailboxes}, 'message_count': {'$gt': 1}},
+                {'parent_thread_id': 1}
+            )
+        }
+        for email in emails:
+            if not email.get('thread_id') and email.get('parent_thread_id') in multi_message_threads:
+                email['thread_id'] = email['parent_thread_id']
         logger.debug(f"Fetched {len(emails)} candidate emails for user")
         return emails
     except Exception as e:
@@ -535,8 +540,9 @@ def process_feedback(email_index, query, action, user):
         terms_count = sum(1 for term in terms for t in term if t.lower() in email.get('relevant_terms', []))
         terms_score = terms_count / max(len([t for g in terms for t in g]), 1)
         subject_score = cosine_similarity(tfidf_vectorizer.transform([query or "default_query"]), tfidf_vectorizer.transform([email.get('subject', '') or "default_subject"]))[0][0]
-        thread_count = emails_collection.count_documents({'thread_id': email.get('thread_id'), 'mailbox_id': {'$in': [mailbox['mailbox_id'] for mailbox in user.mailboxes]}})
-        thread_score = min(thread_count / 10, 1.0) if email.get('thread_id') else 0.0
+        thread = get_thread(threads_collection, email.get('parent_thread_id'), email.get('mailbox_id'))
+        thread_count = thread.get('message_count', 0) if thread else 0
+        thread_score = min(thread_count / 10, 1.0) if thread_count > 1 else 0.0
         name_score = max(
             [fuzz.partial_ratio(name.lower(), email.get('from', '').lower()) / 100 for name in names] +
             [fuzz.partial_ratio(name.lower(), email.get('to', '').lower()) / 100 for name in names]
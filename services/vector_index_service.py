@@ -0,0 +1,130 @@
+import logging
+from logging import handlers
+import threading
+import time
+import zlib
+import numpy as np
+
+# Configurar logging
+logger = logging.getLogger('email_search_app.vector_index_service')
+logger.setLevel(logging.DEBUG)
+file_handler = handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=5)
+file_handler.setLevel(logging.DEBUG)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s:%(funcName)s] %(message)s'))
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+# Índices ya construidos, uno por buzón
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _to_vector(embedding):
+    """Convierte un embedding (Binary comprimido o secuencia de floats) en un vector float32 normalizado."""
+    if embedding is None:
+        return None
+    if isinstance(embedding, (bytes, bytearray)):
+        vector = np.frombuffer(zlib.decompress(embedding), dtype=np.float32)
+    else:
+        vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if not vector.size or norm == 0:
+        return None
+    return vector / norm
+
+
+class MailboxVectorIndex:
+    """Índice exacto en memoria de los embeddings de un buzón.
+
+    Guarda los vectores normalizados en una matriz float32 que crece por duplicación, de
+    modo que la similitud coseno con todos los correos del buzón es un único producto
+    matriz-vector. Junto a cada fila se guardan from, to y parent_thread_id para filtrar
+    sin volver a MongoDB.
+    """
+
+    def __init__(self, mailbox_id, dims=384):
+        self.mailbox_id = mailbox_id
+        self.dims = dims
+        self.size = 0
+        self._matrix = np.zeros((1024, dims), dtype=np.float32)
+        self._from = np.empty(1024, dtype=object)
+        self._to = np.empty(1024, dtype=object)
+        self._threads = np.empty(1024, dtype=object)
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def _grow(self):
+        capacity = self._matrix.shape[0] * 2
+        self._matrix = np.resize(self._matrix, (capacity, self.dims))
+        self._from = np.resize(self._from, capacity)
+        self._to = np.resize(self._to, capacity)
+        self._threads = np.resize(self._threads, capacity)
+
+    def add(self, message_id, embedding, from_, to, parent_thread_id):
+        """Añade o actualiza un correo. Devuelve False si no tiene un embedding utilizable."""
+        vector = _to_vector(embedding)
+        if vector is None or vector.shape[0] != self.dims:
+            return False
+        with self._lock:
+            row = self._rows.get(message_id)
+            if row is None:
+                if self.size == self._matrix.shape[0]:
+                    self._grow()
+                row = self.size
+                self._rows[message_id] = row
+                self.size += 1
+            self._matrix[row] = vector
+            self._from[row] = from_
+            self._to[row] = to
+            self._threads[row] = parent_thread_id
+        return True
+
+    def search(self, embedding, k=10, threshold=0.0, from_=None, to=None, exclude_message_id=None):
+        """Devuelve hasta k pares (similitud, parent_thread_id) ordenados de mayor a menor similitud.
+
+        Si se indican from_ o to, solo se consideran los correos con el mismo remitente o
+        el mismo destinatario. exclude_message_id permite omitir el propio correo.
+        """
+        vector = _to_vector(embedding)
+        if vector is None or vector.shape[0] != self.dims:
+            return []
+        with self._lock:
+            if not self.size:
+                return []
+            similarities = self._matrix[:self.size] @ vector
+            mask = similarities > threshold
+            if from_ is not None or to is not None:
+                mask &= (self._from[:self.size] == from_) | (self._to[:self.size] == to)
+            excluded = self._rows.get(exclude_message_id)
+            if excluded is not None:
+                mask[excluded] = False
+            candidates = np.flatnonzero(mask)
+            if not candidates.size:
+                return []
+            if candidates.size > k:
+                candidates = candidates[np.argpartition(-similarities[candidates], k - 1)[:k]]
+            candidates = candidates[np.argsort(-similarities[candidates])]
+            return [(float(similarities[row]), self._threads[row]) for row in candidates]
+
+
+def get_mailbox_index(collection, mailbox_id):
+    """Devuelve el índice del buzón, construyéndolo desde MongoDB la primera vez que se pide."""
+    with _indexes_lock:
+        index = _indexes.get(mailbox_id)
+        if index is not None:
+            return index
+        start = time.monotonic()
+        index = MailboxVectorIndex(mailbox_id)
+        cursor = collection.find(
+            {'mailbox_id': mailbox_id, 'embedding': {'$ne': None}},
+            {'message_id': 1, 'embedding': 1, 'from': 1, 'to': 1, 'parent_thread_id': 1}
+        )
+        for doc in cursor:
+            index.add(doc.get('message_id'), doc['embedding'], doc.get('from'), doc.get('to'), doc.get('parent_thread_id'))
+        _indexes[mailbox_id] = index
+        logger.info("Índice vectorial del buzón %s construido con %d correos en %.2f segundos", mailbox_id, index.size, time.monotonic() - start)
+        return index
+
@@ -0,0 +1,30 @@
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+from services.attachment_store_service import load_attachment_texts, attachment_search_text
+
+
+@pytest.fixture
+def attachments():
+    collection = mongomock.MongoClient().db.attachments
+    collection.insert_many([
+        {'_id': 'h1', 'text': 'factura número 42'},
+        {'_id': 'h2', 'text': 'contrato de alquiler'}
+    ])
+    return collection
+
+
+def test_load_attachment_texts_follows_refs(attachments):
+    emails = [{'attachment_refs': ['h2', None, 'h1']}, {'attachments_content': ['antiguo'], 'attachment_refs': ['h1']}]
+    load_attachment_texts(attachments, emails)
+    assert emails[0]['attachments_content'] == ['contrato de alquiler', 'No se pudo descargar el adjunto', 'factura número 42']
+    # Los correos antiguos conservan el texto guardado en el documento
+    assert emails[1]['attachments_content'] == ['antiguo']
+
+
+def test_attachment_search_text_joins_non_empty_texts(attachments):
+    email = {'attachment_refs': ['h1', 'desconocido', 'h2']}
+    load_attachment_texts(attachments, [email])
+    assert attachment_search_text(email) == 'factura número 42 contrato de alquiler'
+    assert attachment_search_text({}) == ''
@@ -0,0 +1,31 @@
+from services.ollama_client import ContextBudgeter
+
+
+def test_budgeter_picks_smallest_fitting_bucket():
+    budgeter = ContextBudgeter([2048, 4096, 8192], max_size=8192, chars_per_token=4, default_num_predict=512)
+    assert budgeter.choose('x' * 400) == 2048
+    assert budgeter.choose('x' * 10000) == 4096
+
+
+def test_budgeter_keeps_last_size_within_sticky_factor():
+    budgeter = ContextBudgeter([2048, 4096, 16384], max_size=16384, chars_per_token=4, sticky_factor=2.0, default_num_predict=512)
+    assert budgeter.choose('x' * 10000) == 4096
+    # Cabría en 2048, pero 4096 no es más del doble: no se recarga el modelo
+    assert budgeter.choose('x' * 400) == 4096
+    assert budgeter.choose('x' * 40000) == 16384
+    # 16384 es más de 2 veces 2048: se vuelve al tamaño pequeño
+    assert budgeter.choose('x' * 400) == 2048
+
+
+def test_budgeter_overflow_uses_largest_bucket_and_counts():
+    budgeter = ContextBudgeter([2048, 4096, 65536], max_size=8192, chars_per_token=4)
+    assert budgeter.buckets == [2048, 4096]
+    assert budgeter.choose('x' * 40000) == 4096
+    assert budgeter.metrics()['overflows'] == 1
+
+
+def test_budgeter_reserves_num_predict():
+    budgeter = ContextBudgeter([2048, 4096], max_size=4096, chars_per_token=4)
+    assert budgeter.choose('x' * 400, num_predict=100) == 2048
+    budgeter = ContextBudgeter([2048, 4096], max_size=4096, chars_per_token=4)
+    assert budgeter.choose('x' * 400, num_predict=3000) == 4096
@@ -0,0 +1,59 @@
+from datetime import datetime, timezone
+
+from services.email_fields import (
+    DIRECTION_INBOUND, DIRECTION_OUTBOUND, DIRECTION_INTERNAL,
+    normalize_subject, normalize_body, email_date_ts, parse_addresses, address_fields, header_value, header_from_text
+)
+
+OWN = 'yo@example.com'
+
+
+def test_normalize_subject_strips_reply_prefixes():
+    assert normalize_subject('RE: Fwd: RV:  Presupuesto   2024') == 'presupuesto 2024'
+    assert normalize_subject('Re[2]: [FW] Reunión') == 'reunión'
+    assert normalize_subject('Resumen anual') == 'resumen anual'
+    assert normalize_subject(None) == ''
+
+
+def test_normalize_body():
+    assert normalize_body('Pedido 1234\n> citado\nVer https://x.example.com/a') == 'pedido 0 ver url'
+    assert normalize_body(None) == ''
+
+
+def test_email_date_ts():
+    assert email_date_ts('2024-03-01T10:00:00+02:00') == datetime(2024, 3, 1, 8, 0, tzinfo=timezone.utc)
+    assert email_date_ts('2024-03-01T10:00:00') == datetime(2024, 3, 1, 10, 0, tzinfo=timezone.utc)
+    assert email_date_ts('unknown') is None
+    assert email_date_ts(None) is None
+
+
+def test_parse_addresses_dedupes_and_lowercases():
+    addresses, names = parse_addresses('Ana <Ana@Example.com>, "Luis, Pérez" <luis@example.com>, ana@example.com, sin-arroba')
+    assert addresses == ['ana@example.com', 'luis@example.com']
+    assert names == ['Ana', 'Luis, Pérez']
+    assert parse_addresses(None) == ([], [])
+
+
+def test_address_fields_direction():
+    inbound = address_fields('Ana <ana@example.com>', f'Yo <{OWN}>', None, OWN)
+    assert inbound['direction'] == DIRECTION_INBOUND
+    assert inbound['from_addr'] == 'ana@example.com'
+    assert inbound['from_name'] == 'Ana'
+    assert inbound['to_addrs'] == [OWN]
+
+    outbound = address_fields(f'Yo <{OWN.upper()}>', 'ana@example.com', f'{OWN}', OWN)
+    assert outbound['direction'] == DIRECTION_OUTBOUND
+    assert outbound['cc_addrs'] == [OWN]
+
+    assert address_fields(OWN, OWN, None, OWN)['direction'] == DIRECTION_INTERNAL
+    # Sin destinatarios no es una nota a uno mismo
+    assert address_fields(OWN, None, None, OWN)['direction'] == DIRECTION_OUTBOUND
+    assert address_fields('Unknown', None, None, OWN)['from_addr'] == ''
+
+
+def test_header_lookup():
+    assert header_value({'X-Priority': '1'}, 'x-priority') == '1'
+    assert header_value(None, 'Cc') is None
+    assert header_from_text('From: ana@example.com\nCc: luis@example.com', 'cc') == 'luis@example.com'
+    assert header_from_text("[('From', 'ana@example.com'), ('Cc', \"luis@example.com\")]", 'Cc') == 'luis@example.com'
+    assert header_from_text('From: ana@example.com', 'Cc') is None
@@ -0,0 +1,80 @@
+from services.enrichment_policy_service import (
+    EnrichmentBudget, EnrichmentPolicyEngine, POLICY_FULL, POLICY_REDUCED, POLICY_MINIMAL, score_email, advertisement_signal
+)
+
+OWN = 'yo@example.com'
+NEWSLETTER_HEADERS = {'List-Unsubscribe': '<mailto:baja@news.example.com>', 'Precedence': 'bulk'}
+
+
+def _record(from_='ana@example.com', headers=None, body='Hola, ¿revisamos el contrato mañana?'):
+    return {'subject': 'Contrato', 'from': from_, 'body': body, 'headers': headers or {}}
+
+
+def test_score_email_reasons():
+    score, reasons = score_email({'Importance': 'High'}, f'Yo <{OWN}>', 'cuerpo', OWN)
+    assert score == 5
+    assert reasons == ['enviado_por_el_buzon', 'prioridad_alta']
+    score, reasons = score_email(NEWSLETTER_HEADERS, 'news@news.example.com', 'x' * 60000, OWN, large_body_chars=50000)
+    assert score == -5
+    assert set(reasons) == {'lista_distribucion', 'precedence_bulk', 'cuerpo_grande'}
+
+
+def test_decide_policies():
+    engine = EnrichmentPolicyEngine(OWN)
+    assert engine.decide(_record())[0] == POLICY_FULL
+    assert engine.decide(_record(headers={'List-Id': 'equipo.example.com'}))[0] == POLICY_REDUCED
+
+    policy, enrichments, _, reasons = engine.decide(_record('news@news.example.com', NEWSLETTER_HEADERS))
+    assert policy == POLICY_MINIMAL
+    assert enrichments == {'llm': False, 'ocr': False}
+    assert 'lista_distribucion' in reasons
+    assert engine.stats()['counters']['skipped_llm'] == 1
+
+
+def test_decide_uses_sender_history_and_ad_probability():
+    history = {'promo@tienda.example.com': {'count': 10, 'ads': 9}}
+    engine = EnrichmentPolicyEngine(OWN, sender_history=history, ad_probability=lambda text: 0.95)
+    policy, _, score, reasons = engine.decide(_record('Tienda <promo@tienda.example.com>'))
+    assert policy == POLICY_MINIMAL
+    assert score == -4
+    assert {'remitente_publicitario', 'clasificador_publicidad'} <= set(reasons)
+
+
+def test_decide_reserves_ocr_pages_from_budget():
+    engine = EnrichmentPolicyEngine(OWN, budget=EnrichmentBudget(ocr_pages=3))
+    assert engine.decide(_record(), image_count=2)[1]['ocr'] is True
+    assert engine.decide(_record(), image_count=2)[1]['ocr'] is False
+    assert engine.decide(_record(), image_count=1)[1]['ocr'] is True
+    counters = engine.stats()['counters']
+    assert counters['budget_ocr'] == 1
+    assert counters['skipped_ocr'] == 1
+    assert engine.stats()['budget']['ocr_pages'] == {'spent': 3, 'limit': 3}
+
+
+def test_budget_limits():
+    budget = EnrichmentBudget(llm_seconds=10)
+    assert not budget.exhausted('llm_seconds')
+    assert budget.try_take('llm_seconds', 6)
+    assert not budget.try_take('llm_seconds', 6)
+    budget.charge('llm_seconds', 6)
+    assert budget.exhausted('llm_seconds')
+    # 0 o None: sin límite
+    unlimited = EnrichmentBudget(llm_seconds=0)
+    assert unlimited.try_take('llm_seconds', 10 ** 6)
+    assert not unlimited.exhausted('llm_seconds')
+
+
+def test_llm_allowed_stops_when_budget_is_spent():
+    engine = EnrichmentPolicyEngine(OWN, budget=EnrichmentBudget(llm_seconds=1))
+    assert engine.llm_allowed()
+    engine.charge_llm(1.5)
+    assert not engine.llm_allowed()
+    assert engine.stats()['counters']['budget_llm'] == 1
+
+
+def test_advertisement_signal_needs_unsubscribe_header_or_bayesian_model():
+    assert advertisement_signal({'list-unsubscribe': '<mailto:baja@example.com>'}, [])
+    assert advertisement_signal({}, ['clasificador_publicidad'])
+    # Las demás señales de correo masivo bajan la política, pero no lo convierten en publicidad
+    assert not advertisement_signal({'List-Id': '<equipo.example.com>', 'Precedence': 'bulk'}, ['lista_distribucion', 'precedence_bulk', 'remitente_publicitario'])
+    assert not advertisement_signal(None, [])
@@ -0,0 +1,88 @@
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+from services.enrichment_queue_service import (
+    STATUS_PENDING, STATUS_PROCESSING, STATUS_DONE, STATUS_FAILED, claim_pending, release_claims, fail_claims, mark_exhausted,
+    enrichment_backlog
+)
+
+
+@pytest.fixture
+def emails():
+    collection = mongomock.MongoClient().db.emails
+    collection.insert_many([
+        {'_id': i, 'mailbox_id': 'a@example.com' if i < 5 else 'b@example.com', 'enrichment_status': STATUS_PENDING}
+        for i in range(8)
+    ])
+    return collection
+
+
+def test_claim_pending_marks_and_limits(emails):
+    batch = claim_pending(emails, 'a@example.com', limit=3)
+    assert len(batch) == 3
+    assert all(doc['enrichment_status'] == STATUS_PROCESSING and doc['enrichment_attempts'] == 1 for doc in batch)
+    assert len({doc['enrichment_claim'] for doc in batch}) == 1
+
+    rest = claim_pending(emails, 'a@example.com', limit=10)
+    assert {doc['_id'] for doc in rest} == {0, 1, 2, 3, 4} - {doc['_id'] for doc in batch}
+    assert claim_pending(emails, 'a@example.com', limit=10) == []
+    # Los de otro buzón siguen pendientes
+    assert emails.count_documents({'mailbox_id': 'b@example.com', 'enrichment_status': STATUS_PENDING}) == 3
+
+
+def test_claim_pending_projection(emails):
+    emails.update_many({}, {'$set': {'summary': 'antiguo', 'body': 'cuerpo'}})
+    batch = claim_pending(emails, 'b@example.com', limit=1, projection={'summary': 0})
+    assert 'summary' not in batch[0]
+    assert batch[0]['body'] == 'cuerpo'
+
+
+def test_stale_claims_are_reclaimed_until_attempts_run_out(emails):
+    stale = datetime.now(timezone.utc) - timedelta(hours=2)
+    emails.update_one({'_id': 0}, {'$set': {'enrichment_status': STATUS_PROCESSING, 'enrichment_claimed_at': stale, 'enrichment_attempts': 1}})
+    emails.update_one({'_id': 1}, {'$set': {'enrichment_status': STATUS_PROCESSING, 'enrichment_claimed_at': stale, 'enrichment_attempts': 3}})
+    emails.update_one({'_id': 2}, {'$set': {'enrichment_status': STATUS_PROCESSING, 'enrichment_claimed_at': datetime.now(timezone.utc), 'enrichment_attempts': 1}})
+
+    claimed = {doc['_id']: doc for doc in claim_pending(emails, 'a@example.com', limit=10, claim_timeout=1800, max_attempts=3)}
+    assert set(claimed) == {0, 3, 4}
+    assert claimed[0]['enrichment_attempts'] == 2
+
+    assert mark_exhausted(emails, max_attempts=3, claim_timeout=1800) == 1
+    assert emails.find_one({'_id': 1})['enrichment_status'] == STATUS_FAILED
+
+
+def test_release_claims_returns_emails_without_spending_an_attempt(emails):
+    batch = claim_pending(emails, 'a@example.com', limit=2)
+    ids = [doc['_id'] for doc in batch]
+    assert release_claims(emails, ids + [7]) == 2
+    for doc in emails.find({'_id': {'$in': ids}}):
+        assert doc['enrichment_status'] == STATUS_PENDING
+        assert doc['enrichment_attempts'] == 0
+        assert 'enrichment_claim' not in doc
+    assert release_claims(emails, []) == 0
+    assert {doc['_id'] for doc in claim_pending(emails, 'a@example.com', limit=2)} == set(ids)
+
+
+def test_enrichment_backlog(emails):
+    claim_pending(emails, 'a@example.com', limit=2)
+    assert enrichment_backlog(emails, 'a@example.com') == {STATUS_PENDING: 3, STATUS_PROCESSING: 2}
+
+
+def test_fail_claims_spends_the_attempt_and_fails_at_the_limit(emails):
+    batch = claim_pending(emails, 'a@example.com', limit=2, max_attempts=2)
+    ids = [doc['_id'] for doc in batch]
+    assert fail_claims(emails, ids, max_attempts=2) == 0
+    for doc in emails.find({'_id': {'$in': ids}}):
+        assert doc['enrichment_status'] == STATUS_PENDING
+        assert doc['enrichment_attempts'] == 1
+        assert 'enrichment_claim' not in doc
+
+    emails.update_many({'_id': {'$nin': ids}}, {'$set': {'enrichment_status': STATUS_DONE}})
+    assert {doc['_id'] for doc in claim_pending(emails, 'a@example.com', limit=10, max_attempts=2)} == set(ids)
+    assert fail_claims(emails, ids, max_attempts=2) == 2
+    assert emails.count_documents({'_id': {'$in': ids}, 'enrichment_status': STATUS_FAILED}) == 2
+    assert claim_pending(emails, 'a@example.com', limit=10, max_attempts=2) == []
+    assert fail_claims(emails, [], max_attempts=2) == 0
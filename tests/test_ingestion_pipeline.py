@@ -0,0 +1,95 @@
+import threading
+
+import pytest
+
+from services.ingestion_pipeline import IngestionPipeline, PipelineStage
+
+
+def _pipeline(*stages):
+    return IngestionPipeline(list(stages), name='test', report_interval=0)
+
+
+def _by_stage(stats):
+    return {stage['stage']: stage for stage in stats}
+
+
+def test_requires_stages():
+    with pytest.raises(ValueError):
+        IngestionPipeline([])
+
+
+def test_items_flow_through_all_stages():
+    results = []
+    lock = threading.Lock()
+
+    def collect(item):
+        with lock:
+            results.append(item)
+        return item
+
+    stats = _pipeline(
+        PipelineStage('double', lambda item: item * 2, workers=3),
+        PipelineStage('collect', collect, workers=2)
+    ).run(range(50))
+    assert sorted(results) == [item * 2 for item in range(50)]
+    assert [stage['processed'] for stage in stats] == [50, 50]
+
+
+def test_none_drops_item_and_errors_are_counted():
+    seen = []
+
+    def fragile(item):
+        if item % 5 == 0:
+            raise RuntimeError("fallo")
+        return item if item % 2 else None
+
+    stats = _by_stage(_pipeline(
+        PipelineStage('fragile', fragile, workers=2),
+        PipelineStage('sink', seen.append)
+    ).run(range(20)))
+    assert stats['fragile']['errors'] == 4
+    assert stats['fragile']['dropped'] == 8
+    assert stats['fragile']['processed'] == 8
+    assert sorted(seen) == [1, 3, 7, 9, 11, 13, 17, 19]
+
+
+def test_fan_out_and_batches():
+    batches = []
+
+    def record_batch(items):
+        batches.append(len(items))
+        return [item for item in items if item != 'x-0']
+
+    stats = _by_stage(_pipeline(
+        PipelineStage('fetch', lambda chunk: [f"{chunk}-{i}" for i in range(3)], fan_out=True),
+        PipelineStage('batch', record_batch, batch_size=4, batch_timeout=1)
+    ).run(['x', 'y', 'z']))
+    assert stats['fetch']['processed'] == 9
+    assert sum(batches) == 9
+    assert max(batches) <= 4
+    assert stats['batch']['processed'] == 8
+    assert stats['batch']['dropped'] == 1
+
+
+def test_failed_batch_counts_every_item():
+    def broken(items):
+        raise RuntimeError("fallo")
+
+    stats = _by_stage(_pipeline(PipelineStage('batch', broken, batch_size=10, batch_timeout=1)).run(range(7)))
+    assert stats['batch']['errors'] == 7
+
+
+def test_source_error_still_shuts_down_workers():
+    seen = []
+
+    def source():
+        yield 1
+        yield 2
+        raise RuntimeError("origen roto")
+
+    pipeline = _pipeline(PipelineStage('first', lambda item: item, workers=2), PipelineStage('sink', seen.append, workers=2))
+    with pytest.raises(RuntimeError):
+        pipeline.run(source())
+    # Los elementos ya encolados se procesan y todos los hilos terminan
+    assert sorted(seen) == [1, 2]
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('test-')]
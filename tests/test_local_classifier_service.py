@@ -0,0 +1,112 @@
+import zlib
+
+import numpy as np
+import pytest
+
+pytest.importorskip('sklearn')
+
+from services.local_classifier_service import (
+    CLASSIFICATION_KEYS, LocalEmailClassifier, classifier_text, resolve_locally, training_query,
+    CLASSIFIED_BY_LLM, CLASSIFIED_BY_LOCAL, CLASSIFIED_BY_REUSED, CLASSIFIED_BY_POLICY
+)
+
+
+def _embedding(vector):
+    return zlib.compress(np.asarray(vector, dtype=np.float32).tobytes())
+
+
+def _emails(count=120, seed=0):
+    """Dos grupos separables: publicidad (eje 0) y soporte (eje 1)."""
+    rng = np.random.default_rng(seed)
+    emails = []
+    for i in range(count):
+        ad = i % 2 == 0
+        vector = rng.normal(scale=0.1, size=8)
+        vector[0 if ad else 1] += 1
+        emails.append({
+            'embedding': _embedding(vector),
+            'subject': 'Oferta exclusiva' if ad else 'Incidencia en el servidor',
+            'body': 'Descuento del 50% solo hoy' if ad else 'El servicio no responde, ¿podéis revisarlo?',
+            'semantic_domain': 'marketing' if ad else 'soporte',
+            'domain_confidence': 0.9,
+            'requires_response': not ad,
+            'urgent': not ad,
+            'important': not ad,
+            'advertisement': ad
+        })
+    return emails
+
+
+def test_classifier_text_truncates_body():
+    assert classifier_text('Asunto', 'x' * 5000) == 'Asunto ' + 'x' * 2000
+    assert classifier_text(None, None) == ''
+
+
+def test_train_and_predict():
+    emails = _emails()
+    classifier = LocalEmailClassifier(min_examples=20).train(emails)
+    assert classifier.domains == ['marketing', 'soporte']
+    assert set(classifier.flag_models) == set(CLASSIFICATION_KEYS)
+    assert classifier.vectorizer is not None
+
+    domain, flags = classifier.predict(emails[0]['embedding'], classifier_text(emails[0]['subject'], emails[0]['body']))
+    assert domain[0] == 'marketing'
+    assert flags['advertisement'] > 0.5 > flags['requires_response']
+
+
+def test_train_without_text_uses_embedding_only():
+    emails = [{**email, 'subject': '', 'body': ''} for email in _emails()]
+    classifier = LocalEmailClassifier(min_examples=20).train(emails)
+    assert classifier.vectorizer is None
+    assert set(classifier.predict(emails[1]['embedding'])[1]) == set(CLASSIFICATION_KEYS)
+
+
+def test_low_confidence_labels_and_small_classes_are_not_trained():
+    emails = _emails()
+    for email in emails:
+        email['domain_confidence'] = 0.3
+        email['urgent'] = False
+    classifier = LocalEmailClassifier(min_examples=20).train(emails)
+    assert classifier.centroids is None
+    assert 'urgent' not in classifier.flag_models
+
+
+def test_resolve_locally():
+    emails = _emails()
+    classifier = LocalEmailClassifier(min_examples=20).train(emails)
+    email = emails[1]
+    text = classifier_text(email['subject'], email['body'])
+
+    local = resolve_locally(classifier, email['embedding'], 0.8, text)
+    assert local['semantic_domain'] == 'soporte'
+    assert local['classifications'] == {'requires_response': True, 'urgent': True, 'important': True, 'advertisement': False}
+    # Umbral imposible: se resuelve con el LLM
+    assert resolve_locally(classifier, email['embedding'], 1.01, text) is None
+    assert resolve_locally(None, email['embedding'], 0.8) is None
+    assert resolve_locally(classifier, None, 0.8) is None
+
+
+def test_resolve_locally_requires_every_flag_model():
+    emails = _emails()
+    for email in emails:
+        email['urgent'] = False
+    classifier = LocalEmailClassifier(min_examples=20).train(emails)
+    assert resolve_locally(classifier, emails[1]['embedding'], 0.5) is None
+
+
+def test_training_query_only_selects_llm_labels():
+    mongomock = pytest.importorskip('mongomock')
+    emails = mongomock.MongoClient().db.emails
+    embedding = _embedding([1.0])
+    emails.insert_many([
+        {'_id': 'llm', 'mailbox_id': 'a', 'embedding': embedding, 'classified_by': CLASSIFIED_BY_LLM, 'enrichment_status': 'done'},
+        {'_id': 'local', 'mailbox_id': 'a', 'embedding': embedding, 'classified_by': CLASSIFIED_BY_LOCAL, 'enrichment_status': 'done'},
+        {'_id': 'reused', 'mailbox_id': 'a', 'embedding': embedding, 'classified_by': CLASSIFIED_BY_REUSED, 'enrichment_status': 'done'},
+        {'_id': 'policy', 'mailbox_id': 'a', 'embedding': embedding, 'classified_by': CLASSIFIED_BY_POLICY, 'enrichment_status': 'skipped'},
+        {'_id': 'pending', 'mailbox_id': 'a', 'embedding': embedding, 'enrichment_status': 'pending'},
+        {'_id': 'legacy', 'mailbox_id': 'a', 'embedding': embedding, 'summary': 'Reunión del lunes'},
+        {'_id': 'legacy_fallback', 'mailbox_id': 'a', 'embedding': embedding, 'summary': 'Resumen no disponible'},
+        {'_id': 'other_mailbox', 'mailbox_id': 'b', 'embedding': embedding, 'classified_by': CLASSIFIED_BY_LLM},
+        {'_id': 'no_embedding', 'mailbox_id': 'a', 'classified_by': CLASSIFIED_BY_LLM}
+    ])
+    assert {doc['_id'] for doc in emails.find(training_query('a'))} == {'llm', 'legacy'}
@@ -0,0 +1,47 @@
+from services.near_duplicate_service import (
+    SIMHASH_BANDS, SIMHASH_BITS, simhash, simhash_bands, hamming_distance, to_signed, body_fingerprint
+)
+
+BODY = (
+    "Hola equipo, adjunto el informe semanal de incidencias del servicio de correo. "
+    "Esta semana se han resuelto doce incidencias y quedan tres abiertas pendientes de revisión."
+)
+
+
+def test_simhash_ignores_quotes_urls_and_digits():
+    assert simhash(BODY) == simhash(BODY + "\n> texto citado de otro correo\n> más texto")
+    assert simhash(BODY + " https://example.com/a?id=1") == simhash(BODY + " https://example.org/b")
+    assert simhash(BODY.replace('semanal', 'semanal 2024')) == simhash(BODY.replace('semanal', 'semanal 1999'))
+
+
+def test_simhash_short_body_has_no_fingerprint():
+    assert simhash("Gracias, recibido") is None
+    assert body_fingerprint("Gracias, recibido") == {}
+
+
+def test_bands_are_position_tagged():
+    value = (1 << SIMHASH_BITS) - 1
+    bands = simhash_bands(value)
+    assert len(bands) == SIMHASH_BANDS == len(set(bands))
+    # Mismo valor en posiciones distintas no debe coincidir
+    assert simhash_bands(0) != [0] * SIMHASH_BANDS
+
+
+def test_close_fingerprints_share_a_band():
+    value = simhash(BODY)
+    for bits in [(0,), (0, 20), (3, 30, 60), (15, 31, 47)]:
+        other = value
+        for bit in bits:
+            other ^= 1 << bit
+        assert hamming_distance(value, other) == len(bits)
+        assert set(simhash_bands(value)) & set(simhash_bands(other))
+
+
+def test_bands_accept_signed_values():
+    value = simhash(BODY) | 1 << (SIMHASH_BITS - 1)
+    signed = to_signed(value)
+    assert signed < 0
+    assert simhash_bands(signed) == simhash_bands(value)
+    assert hamming_distance(signed, value) == 0
+    fingerprint = body_fingerprint(BODY)
+    assert fingerprint['simhash_bands'] == simhash_bands(fingerprint['simhash'])
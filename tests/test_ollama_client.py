@@ -0,0 +1,118 @@
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from services.ollama_client import (
+    ContextBudgeter, OllamaGateway, OllamaOverloadedError,
+    PRIORITY_INTERACTIVE, PRIORITY_AGATTA, PRIORITY_BACKFILL, LANE_NAMES
+)
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condición no alcanzada")
+        time.sleep(0.005)
+
+
+def _queue_depth(gateway, priority):
+    return gateway.metrics()['lanes'][LANE_NAMES[priority]]['queue_depth']
+
+
+def test_gateway_admits_waiters_by_priority_then_arrival():
+    gateway = OllamaGateway('http://ollama', 'model', max_in_flight=1)
+    gateway._acquire(PRIORITY_BACKFILL)
+    order = []
+
+    def worker(priority, name):
+        gateway._acquire(priority)
+        order.append(name)
+        gateway._release(priority, 0.0, False)
+
+    arrivals = [
+        (PRIORITY_BACKFILL, 'backfill-1'),
+        (PRIORITY_AGATTA, 'agatta'),
+        (PRIORITY_BACKFILL, 'backfill-2'),
+        (PRIORITY_INTERACTIVE, 'interactive')
+    ]
+    threads = []
+    for priority, name in arrivals:
+        depth = _queue_depth(gateway, priority)
+        thread = threading.Thread(target=worker, args=(priority, name))
+        thread.start()
+        threads.append(thread)
+        _wait_for(lambda: _queue_depth(gateway, priority) == depth + 1)
+
+    gateway._release(PRIORITY_BACKFILL, 0.0, False)
+    for thread in threads:
+        thread.join(5)
+    assert order == ['interactive', 'agatta', 'backfill-1', 'backfill-2']
+
+
+def test_gateway_lane_limit_leaves_room_for_interactive():
+    gateway = OllamaGateway('http://ollama', 'model', max_in_flight=2, lane_limits={PRIORITY_BACKFILL: 1})
+    gateway._acquire(PRIORITY_BACKFILL)
+    admitted = threading.Event()
+
+    def second_backfill():
+        gateway._acquire(PRIORITY_BACKFILL)
+        admitted.set()
+        gateway._release(PRIORITY_BACKFILL, 0.0, False)
+
+    thread = threading.Thread(target=second_backfill)
+    thread.start()
+    _wait_for(lambda: _queue_depth(gateway, PRIORITY_BACKFILL) == 1)
+    assert not admitted.is_set()
+
+    # Hay una plaza libre que el carril backfill no puede usar
+    gateway._acquire(PRIORITY_INTERACTIVE)
+    assert gateway.metrics()['in_flight'] == 2
+    gateway._release(PRIORITY_INTERACTIVE, 0.0, False)
+    assert not admitted.is_set()
+
+    gateway._release(PRIORITY_BACKFILL, 0.0, False)
+    thread.join(5)
+    assert admitted.is_set()
+
+
+def test_gateway_rejects_when_lane_queue_is_full():
+    gateway = OllamaGateway('http://ollama', 'model', max_in_flight=1, max_queue=1)
+    gateway._acquire(PRIORITY_BACKFILL)
+    thread = threading.Thread(target=lambda: (gateway._acquire(PRIORITY_BACKFILL), gateway._release(PRIORITY_BACKFILL, 0.0, False)))
+    thread.start()
+    _wait_for(lambda: _queue_depth(gateway, PRIORITY_BACKFILL) == 1)
+
+    with pytest.raises(OllamaOverloadedError):
+        gateway._acquire(PRIORITY_BACKFILL)
+    assert gateway.metrics()['lanes']['backfill']['rejected'] == 1
+
+    gateway._release(PRIORITY_BACKFILL, 0.0, False)
+    thread.join(5)
+
+
+def test_gateway_queue_timeout_removes_waiter():
+    gateway = OllamaGateway('http://ollama', 'model', max_in_flight=1, queue_timeout=0.05)
+    gateway._acquire(PRIORITY_INTERACTIVE)
+    with pytest.raises(OllamaOverloadedError):
+        gateway._acquire(PRIORITY_AGATTA)
+    assert _queue_depth(gateway, PRIORITY_AGATTA) == 0
+    gateway._release(PRIORITY_INTERACTIVE, 0.0, False)
+    gateway._acquire(PRIORITY_AGATTA)
+
+
+def test_generate_sets_num_ctx_and_releases_slot():
+    gateway = OllamaGateway('http://ollama', 'model', max_in_flight=1, budgeter=ContextBudgeter([2048, 4096], max_size=4096))
+    response = MagicMock()
+    response.json.return_value = {'response': 'hola'}
+    gateway.session.post = MagicMock(return_value=response)
+
+    assert gateway.generate('prompt', {'temperature': 0, 'format': 'json'}, priority=PRIORITY_AGATTA) == 'hola'
+    payload = gateway.session.post.call_args.kwargs['json']
+    assert payload['options'] == {'temperature': 0, 'num_ctx': 2048}
+    assert payload['format'] == 'json'
+    metrics = gateway.metrics()
+    assert metrics['in_flight'] == 0
+    assert metrics['lanes']['agatta']['requests'] == 1
@@ -0,0 +1,83 @@
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+from services.sync_state_service import (
+    get_mailbox_sync_state, save_gmail_history_id, advance_gmail_history_id, advance_imap_folder_state,
+    imap_folder_state_key, uid_ranges, uids_after, parse_uid_fetch_response
+)
+
+USER, MAILBOX = 'usuario', 'yo@example.com'
+
+
+@pytest.fixture
+def users():
+    collection = mongomock.MongoClient().db.users
+    collection.insert_one({'username': USER, 'mailboxes': [{'mailbox_id': 'otro@example.com'}, {'mailbox_id': MAILBOX, 'sync_state': {'imap_folders': {}}}]})
+    return collection
+
+
+def test_sync_state_of_unknown_mailbox_is_empty(users):
+    assert get_mailbox_sync_state(users, USER, 'otro@example.com') == {}
+    assert get_mailbox_sync_state(users, USER, 'nadie@example.com') == {}
+
+
+def test_save_gmail_history_id_targets_the_mailbox(users):
+    save_gmail_history_id(users, USER, MAILBOX, 123)
+    assert get_mailbox_sync_state(users, USER, MAILBOX)['history_id'] == '123'
+    assert get_mailbox_sync_state(users, USER, 'otro@example.com') == {}
+
+
+def test_history_id_advances_only_after_clean_run(users):
+    save_gmail_history_id(users, USER, MAILBOX, '100')
+    assert not advance_gmail_history_id(users, USER, MAILBOX, '200', failures=2)
+    assert get_mailbox_sync_state(users, USER, MAILBOX)['history_id'] == '100'
+
+    assert advance_gmail_history_id(users, USER, MAILBOX, '200', failures=0)
+    assert get_mailbox_sync_state(users, USER, MAILBOX)['history_id'] == '200'
+
+
+def test_history_id_not_saved_in_dry_run_or_without_mark(users):
+    assert not advance_gmail_history_id(users, USER, MAILBOX, '200', failures=0, dry_run=True)
+    assert not advance_gmail_history_id(users, USER, MAILBOX, None, failures=0)
+    assert 'history_id' not in get_mailbox_sync_state(users, USER, MAILBOX)
+
+
+def test_uid_ranges_compacts_consecutive_uids():
+    assert uid_ranges([9, 1, 2, 3, 5, 10, 3]) == '1:3,5,9:10'
+    assert uid_ranges([]) == ''
+
+
+def test_parse_uid_fetch_response_with_uid_before_or_after_literal():
+    data = [
+        (b'1 (UID 7 BODY[] {3}', b'abc'), b')',
+        (b'2 (BODY[] {3}', b'def'), b' UID 8)',
+        b'basura',
+    ]
+    assert parse_uid_fetch_response(data) == [(7, b'abc'), (8, b'def')]
+
+
+def test_uids_after_drops_the_mark_returned_by_open_range():
+    # 'UID 11:*' devuelve el UID 10 si no hay mensajes nuevos
+    assert uids_after(b'10', 10) == []
+    assert uids_after(b'13 11 10', 10) == [11, 13]
+
+
+def test_imap_folder_state_key_is_a_valid_mongo_key():
+    assert imap_folder_state_key('INBOX.Sent$') == 'INBOX_Sent_'
+
+
+def imap_state(users, folder):
+    return get_mailbox_sync_state(users, USER, MAILBOX).get('imap_folders', {}).get(imap_folder_state_key(folder))
+
+
+def test_imap_mark_kept_on_failures_and_dry_run(users):
+    assert not advance_imap_folder_state(users, USER, MAILBOX, 'INBOX', 1, 10, [11, 12], failures=1)
+    assert not advance_imap_folder_state(users, USER, MAILBOX, 'INBOX', 1, 10, [11, 12], failures=0, dry_run=True)
+    assert imap_state(users, 'INBOX') is None
+
+
+def test_imap_mark_advances_to_highest_uid(users):
+    assert advance_imap_folder_state(users, USER, MAILBOX, 'INBOX.Sent', 5, 10, [12, 11], failures=0)
+    state = imap_state(users, 'INBOX.Sent')
+    assert (state['folder'], state['uidvalidity'], state['last_uid']) == ('INBOX.Sent', 5, 12)
@@ -0,0 +1,19 @@
+from services.thread_store_service import RunThreadIndex
+
+
+def test_run_thread_index_keeps_first_thread_per_subject():
+    index = RunThreadIndex()
+    assert index.find('a@example.com', 'presupuesto') is None
+    index.add('a@example.com', 'presupuesto', '<m1>')
+    index.add('a@example.com', 'presupuesto', '<m2>')
+    assert index.find('a@example.com', 'presupuesto') == '<m1>'
+    # Cada buzón tiene sus propios hilos
+    assert index.find('b@example.com', 'presupuesto') is None
+
+
+def test_run_thread_index_ignores_empty_subjects():
+    index = RunThreadIndex()
+    index.add('a@example.com', '', '<m1>')
+    index.add('a@example.com', 'factura', None)
+    assert index.find('a@example.com', '') is None
+    assert index.find('a@example.com', 'factura') is None
@@ -4,6 +4,9 @@ from pymongo import MongoClient
 import logging
 import numpy as np
 import zlib
+from config import EMBEDDING_BATCH_SIZE, EMBEDDING_LENGTH_BUCKETING, EMBEDDING_TORCH_THREADS
+from services.embedding_service import encode_texts, set_torch_threads
+from services.attachment_store_service import load_attachment_texts, attachment_search_text
 
 # Configuración del logging
 logging.basicConfig(filename='index_emails.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -12,16 +15,19 @@ logging.basicConfig(filename='index_emails.log', level=logging.INFO, format='%(a
 MONGO_URI = 'mongodb://localhost:27017'
 MONGO_DB_NAME = 'email_database_metis2'
 MONGO_EMAILS_COLLECTION = 'emails'
+MONGO_ATTACHMENTS_COLLECTION = 'attachments'
 
 client = MongoClient(MONGO_URI)
 db = client[MONGO_DB_NAME]
 emails_collection = db[MONGO_EMAILS_COLLECTION]
+attachments_collection = db[MONGO_ATTACHMENTS_COLLECTION]
 
 # Configuración de Elasticsearch
 es = elasticsearch.Elasticsearch(["http://localhost:9200"])
 
 # Cargar el modelo de embeddings
 embedding_model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+set_torch_threads(EMBEDDING_TORCH_THREADS)
 
 INDEX_NAME = 'email_index'
 
@@ -37,8 +43,10 @@ mapping = {
             "to": {"type": "keyword"},
             "date": {"type": "date"},
             "summary": {"type": "text"},
+            "attachments_content": {"type": "text"},
             "relevant_terms_array": {"type": "keyword"},
             "semantic_domain": {"type": "keyword"},
+            "simhash": {"type": "long"},
             "embedding": {
                 "type": "dense_vector",
                 "dims": 384
@@ -55,6 +63,26 @@ logging.info(f"Índice {INDEX_NAME} creado con el mapeo actualizado.")
 def index_all_emails():
     logging.info("Iniciando indexación de todos los correos...")
     emails = emails_collection.find()
+    batch = []
+    for email in emails:
+        batch.append(email)
+        if len(batch) >= EMBEDDING_BATCH_SIZE:
+            index_email_batch(batch)
+            batch = []
+    if batch:
+        index_email_batch(batch)
+
+def index_email_batch(emails):
+    load_attachment_texts(attachments_collection, emails)
+    # Los correos sin embedding guardado se codifican juntos en una sola llamada al modelo
+    missing = [email for email in emails if not email.get('embedding')]
+    try:
+        vectors = encode_texts(embedding_model, [f"{email.get('subject', '')} {email.get('body', '')}" for email in missing], EMBEDDING_BATCH_SIZE, EMBEDDING_LENGTH_BUCKETING)
+    except Exception as e:
+        logging.error(f"Error al generar embeddings para {len(missing)} correos: {e}")
+        vectors = [None] * len(missing)
+    generated = {id(email): vector for email, vector in zip(missing, vectors)}
+
     for email in emails:
         try:
             # Obtener o generar embedding
@@ -62,8 +90,8 @@ def index_all_emails():
             if embedding:
                 embedding = np.frombuffer(zlib.decompress(embedding), dtype=np.float32).tolist()
             else:
-                text = f"{email.get('subject', '')} {email.get('body', '')}"
-                embedding = embedding_model.encode(text).tolist()
+                vector = generated.get(id(email))
+                embedding = vector.tolist() if vector is not None else []
 
             # Documento para Elasticsearch
             es_doc = {
@@ -77,6 +105,8 @@ def index_all_emails():
                 'summary': email.get('summary', 'Sin resumen'),
                 'relevant_terms_array': email.get('relevant_terms_array', []),
                 'semantic_domain': email.get('semantic_domain', 'general'),
+                'attachments_content': attachment_search_text(email),
+                'simhash': email.get('simhash'),
                 'embedding': embedding
             }
             es.index(index=INDEX_NAME, id=email.get('message_id'), body=es_doc)
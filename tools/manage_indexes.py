@@ -0,0 +1,57 @@
+import argparse
+import logging
+import sys
+from pymongo import MongoClient
+from config import MONGO_URI, MONGO_DB_NAME, INDEXES
+from services.index_manager_service import index_status, ensure_indexes, audit_query_plans
+
+# Configuración del logging
+logging.basicConfig(level=logging.INFO)
+
+# Conexión a MongoDB
+client = MongoClient(MONGO_URI)
+db = client[MONGO_DB_NAME]
+
+
+def show_status(collections):
+    for collection_name, entry in index_status(db, collections).items():
+        print(f"{collection_name}: {len(entry['present'])} presentes, {len(entry['missing'])} pendientes")
+        for name in entry['missing']:
+            print(f"  falta      {name} {INDEXES[collection_name][name]['keys']}")
+        for declared, existing in entry['renamed'].items():
+            print(f"  renombrado {declared} (existe como {existing})")
+        for declared, existing in entry['changed'].items():
+            print(f"  distinto   {declared} (existe como {existing} con otra definición; -create lo recrea)")
+        for name in entry['extra']:
+            print(f"  no declarado {name}")
+
+
+def show_audit():
+    """Muestra el plan de cada consulta habitual; devuelve cuántas recorren la colección entera."""
+    results = audit_query_plans(db)
+    for result in results:
+        flag = 'COLLSCAN' if result['collscan'] else ('SORT' if result['in_memory_sort'] else 'ok')
+        print(f"[{flag:8}] {result['collection']}: {result['name']} -> {', '.join(result['indexes']) or '-'} ({' > '.join(result['stages'])})")
+    collscans = sum(result['collscan'] for result in results)
+    print(f"{collscans} de {len(results)} consultas sin índice")
+    return collscans
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Crear y auditar los índices de MongoDB declarados en config.INDEXES.")
+    parser.add_argument('-create', action='store_true', help="Crear los índices que faltan y recrear los que han cambiado (en segundo plano)")
+    parser.add_argument('-dryrun', action='store_true', help="Con -create, solo mostrar los índices que se crearían")
+    parser.add_argument('-audit', action='store_true', help="Pasar las consultas habituales por explain() y señalar las que hacen COLLSCAN")
+    parser.add_argument('-collection', action='append', choices=sorted(INDEXES), help="Limitar a esta colección (se puede repetir)")
+    args = parser.parse_args()
+
+    if args.create:
+        created = ensure_indexes(db, args.collection, dry_run=args.dryrun)
+        logging.info(f"Índices {'por crear' if args.dryrun else 'creados'}: {sum(len(names) for names in created.values())}")
+    show_status(args.collection)
+    if args.audit and show_audit():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()